@@ -0,0 +1,202 @@
+"""Time-to-first-byte after a cold start, with and without template caches.
+
+Each run starts a fresh Python process serving the app through waitress.
+It then records when the port accepts connections and when the first
+byte of ``GET /`` arrives, both measured from process launch, plus how
+long the first and second requests take. The scenarios compare:
+
+    baseline        no bytecode cache
+    bytecode-cold   bytecode cache enabled, empty directory
+    bytecode-warm   bytecode cache already filled by an earlier process
+    precompile      warm cache + templates.precompile
+    warmup          warm cache + precompile + templates.warmup
+
+    DATABASE_URL=postgresql:///lj_bench \\
+        python benchmarks/cold_start.py --runs 5 --output cold.json
+
+The database is seeded with --corpus synthetic entries unless --no-seed
+is given.
+"""
+import argparse
+import json
+import os
+import platform
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(HERE)
+
+SCENARIOS = (
+    ('baseline', {'jinja2.bytecode_caching': 'false'}, None),
+    ('bytecode-cold', {'jinja2.bytecode_caching': 'true'}, 'clear'),
+    ('bytecode-warm', {'jinja2.bytecode_caching': 'true'}, 'keep'),
+    ('precompile', {'jinja2.bytecode_caching': 'true',
+                    'templates.precompile': 'true'}, 'keep'),
+    ('warmup', {'jinja2.bytecode_caching': 'true',
+                'templates.precompile': 'true',
+                'templates.warmup': 'true'}, 'keep'),
+)
+DEFAULTS = {'templates.precompile': 'false', 'templates.warmup': 'false',
+            'pyramid.reload_templates': 'false'}
+
+
+def serve(config, port, options):
+    """Child process: build the app and serve it on port."""
+    sys.path.insert(0, ROOT)
+    from pyramid.paster import get_appsettings
+    from waitress import serve as waitress_serve
+
+    from learning_journal import main as make_app
+    from learning_journal.models import settings_from_environ
+
+    settings = settings_from_environ(get_appsettings(config))
+    settings.update(dict(option.split('=', 1) for option in options))
+    app = make_app({}, **settings)
+    waitress_serve(app, host='127.0.0.1', port=port, _quiet=True)
+
+
+def free_port():
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+def connect(port, deadline):
+    while True:
+        try:
+            return socket.create_connection(('127.0.0.1', port))
+        except socket.error:
+            if time.time() > deadline:
+                raise
+            time.sleep(0.002)
+
+
+def fetch(sock, path='/'):
+    """Send a GET; return (seconds to the first byte, total seconds)."""
+    started = time.time()
+    sock.sendall(('GET %s HTTP/1.1\r\nHost: localhost\r\n'
+                  'Connection: close\r\n\r\n' % path).encode('ascii'))
+    sock.recv(1)
+    first_byte = time.time() - started
+    while sock.recv(65536):
+        pass
+    sock.close()
+    return first_byte, time.time() - started
+
+
+def measure(config, options, timeout):
+    """Start a server process and time its first requests, in ms."""
+    port = free_port()
+    command = [sys.executable, os.path.abspath(__file__), '--serve',
+               str(port), '--config', config]
+    for option in options:
+        command.extend(['--set', option])
+    launched = time.time()
+    child = subprocess.Popen(command)
+    try:
+        sock = connect(port, launched + timeout)
+        ready = time.time() - launched
+        first_byte, first_total = fetch(sock)
+        ttfb = time.time() - launched - (first_total - first_byte)
+        second_total = fetch(connect(port, time.time() + timeout))[1]
+    finally:
+        child.terminate()
+        child.wait()
+    return {'ready_ms': ready * 1000,
+            'ttfb_ms': ttfb * 1000,
+            'first_request_ms': first_total * 1000,
+            'second_request_ms': second_total * 1000}
+
+
+def median(values):
+    values = sorted(values)
+    middle = len(values) // 2
+    if len(values) % 2:
+        return values[middle]
+    return (values[middle - 1] + values[middle]) / 2.0
+
+
+def run_scenario(args, settings, cache, directory):
+    options = ['%s=%s' % item for item in sorted(DEFAULTS.items())]
+    options.extend('%s=%s' % item for item in sorted(settings.items()))
+    options.append('jinja2.bytecode_caching_directory=%s' % directory)
+    options.extend(args.set)
+    if cache == 'keep':
+        # fill the cache from an earlier process, as after a deploy
+        measure(args.config, options, args.timeout)
+    runs = []
+    for _ in range(args.runs):
+        if cache == 'clear':
+            shutil.rmtree(directory, ignore_errors=True)
+        runs.append(measure(args.config, options, args.timeout))
+    return dict((key, round(median([run[key] for run in runs]), 2))
+                for key in runs[0])
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--config', default=os.path.join(ROOT,
+                                                         'production.ini'))
+    parser.add_argument('--set', action='append', default=[],
+                        metavar='key=value', help='override an app setting')
+    parser.add_argument('--corpus', type=int, default=100,
+                        help='synthetic entries to seed')
+    parser.add_argument('--no-seed', action='store_true',
+                        help='use the existing data instead')
+    parser.add_argument('--runs', type=int, default=5,
+                        help='cold starts per scenario')
+    parser.add_argument('--timeout', type=float, default=60,
+                        help='seconds to wait for the server to start')
+    parser.add_argument('--scenario', dest='scenarios', action='append',
+                        help='only run this scenario (repeatable)')
+    parser.add_argument('--output', help='write results JSON here')
+    parser.add_argument('--serve', type=int, metavar='PORT',
+                        help=argparse.SUPPRESS)
+    return parser.parse_args(argv)
+
+
+def main(argv=sys.argv[1:]):
+    args = parse_args(argv)
+    if args.serve:
+        return serve(args.config, args.serve, args.set)
+    if not args.no_seed:
+        from http_bench import seed
+        sys.path.insert(0, ROOT)
+        from pyramid.paster import get_appsettings
+        from learning_journal.models import settings_from_environ
+        settings = settings_from_environ(get_appsettings(args.config))
+        settings.update(dict(option.split('=', 1) for option in args.set))
+        seed(settings, args.corpus)
+    directory = tempfile.mkdtemp(prefix='lj-jinja2-')
+    results = {}
+    try:
+        for name, settings, cache in SCENARIOS:
+            if args.scenarios and name not in args.scenarios:
+                continue
+            results[name] = result = run_scenario(args, settings, cache,
+                                                  directory)
+            sys.stdout.write(
+                '%-14s ready %8.1fms  ttfb %8.1fms  first %7.1fms  '
+                'second %6.1fms\n' % (
+                    name, result['ready_ms'], result['ttfb_ms'],
+                    result['first_request_ms'],
+                    result['second_request_ms']))
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'meta': {'runs': args.runs,
+                                'python': platform.python_version()},
+                       'results': results}, f, indent=2, sort_keys=True)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,402 @@
+"""HTTP load benchmark for every journal route.
+
+Seeds the database named by DATABASE_URL with a synthetic corpus, builds
+the WSGI app with ``learning_journal.main`` and drives each route either
+in-process (WebTest) or over real sockets through waitress. For every
+route it reports throughput, p50/p95/p99 latency and SQL statements per
+request, writes the results as JSON and can flag regressions against a
+stored baseline.
+
+    DATABASE_URL=postgresql:///lj_bench \\
+        python benchmarks/http_bench.py --corpus 100000 --mode both \\
+        --output bench.json --baseline benchmarks/baseline.json
+
+The database is dropped and re-seeded unless --no-seed is given.
+"""
+import argparse
+import json
+import logging
+import os
+import platform
+import random
+import re
+import sys
+import threading
+import time
+from datetime import date
+
+try:
+    from http.client import HTTPConnection
+    from urllib.parse import urlencode
+except ImportError:  # pragma: no cover - python 2
+    from httplib import HTTPConnection
+    from urllib import urlencode
+
+from pyramid.paster import get_appsettings
+from sqlalchemy import event
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(HERE)
+sys.path.insert(0, ROOT)
+
+from learning_journal import main as make_app  # noqa: E402
+from learning_journal.models import (  # noqa: E402
+    get_engine,
+    settings_from_environ,
+)
+from learning_journal.models.meta import Base  # noqa: E402
+from learning_journal.scripts.generate import generate  # noqa: E402
+
+USERNAME = 'bench'
+PASSWORD = 'bench'
+CSRF = re.compile(r'name="csrf_token" value="([^"]+)"')
+
+
+def seed(settings, corpus, seed=0):
+    """Recreate the schema and generate corpus synthetic entries."""
+    engine = get_engine(settings)
+    Base.metadata.drop_all(engine)
+    Base.metadata.create_all(engine)
+    engine.dispose()
+    started = time.time()
+    generate(settings, corpus, seed=seed)
+    return time.time() - started
+
+
+class QueryCounter(object):
+    """Count SQL statements run on an engine."""
+
+    def __init__(self, engine):
+        self.count = 0
+        self._lock = threading.Lock()
+        event.listen(engine, 'before_cursor_execute', self._executed)
+
+    def _executed(self, *args):
+        with self._lock:
+            self.count += 1
+
+
+class InProcessClient(object):
+    """Drive the WSGI app directly through WebTest."""
+
+    name = 'inprocess'
+
+    def __init__(self, app):
+        from webtest import TestApp
+        self.app = TestApp(app)
+
+    def request(self, method, path, params=None):
+        if method == 'POST':
+            response = self.app.post(path, params=params, expect_errors=True)
+        else:
+            response = self.app.get(path, expect_errors=True)
+        return response.status_int, response.text
+
+    def clone(self):
+        return self
+
+
+class HTTPClient(object):
+    """Drive a waitress server over a keep-alive HTTP connection."""
+
+    name = 'waitress'
+
+    def __init__(self, host, port, cookies=None):
+        self.host = host
+        self.port = port
+        self.cookies = dict(cookies or {})
+        self.connection = HTTPConnection(host, port)
+
+    def request(self, method, path, params=None):
+        headers = {}
+        body = None
+        if self.cookies:
+            headers['Cookie'] = '; '.join(
+                '%s=%s' % item for item in self.cookies.items())
+        if params is not None:
+            body = urlencode(params)
+            headers['Content-Type'] = 'application/x-www-form-urlencoded'
+        try:
+            self.connection.request(method, path, body, headers)
+            response = self.connection.getresponse()
+        except Exception:
+            self.connection.close()
+            self.connection = HTTPConnection(self.host, self.port)
+            raise
+        text = response.read().decode('utf-8', 'replace')
+        for name, value in response.getheaders():
+            if name.lower() == 'set-cookie':
+                cookie = value.split(';', 1)[0]
+                key, _, val = cookie.partition('=')
+                if val.strip('"'):
+                    self.cookies[key] = val
+                else:
+                    self.cookies.pop(key, None)
+        return response.status, text
+
+    def clone(self):
+        return HTTPClient(self.host, self.port, self.cookies)
+
+
+def percentile(values, pct):
+    """Return the nearest-rank percentile of sorted values."""
+    if not values:
+        return 0.0
+    index = max(0, int(round(pct / 100.0 * len(values))) - 1)
+    return values[min(index, len(values) - 1)]
+
+
+def csrf_token(client, path):
+    status, text = client.request('GET', path)
+    match = CSRF.search(text)
+    return match.group(1) if match else ''
+
+
+def scenarios(corpus, rand):
+    """Return (name, authenticated, make_request) for every route.
+
+    make_request(client, i) returns (method, path, params).
+    """
+    def entry_id():
+        return rand.randint(1, max(corpus, 1))
+
+    def form(client, path):
+        return {'csrf_token': csrf_token(client, path)}
+
+    def create(client, i):
+        params = form(client, '/journal/new-entry')
+        params.update(title='Bench post %d %f' % (i, time.time()),
+                      body='written by the benchmark',
+                      creation_date=date.today().isoformat())
+        return 'POST', '/journal/new-entry', params
+
+    def edit(client, i):
+        path = '/journal/%d/edit-entry' % entry_id()
+        params = form(client, path)
+        params.update(title='Edited by bench %d %f' % (i, time.time()),
+                      body='edited by the benchmark')
+        return 'POST', path, params
+
+    return [
+        ('GET /', False, lambda c, i: ('GET', '/', None)),
+        ('GET /?before', False,
+         lambda c, i: ('GET', '/?before=%d' % entry_id(), None)),
+        ('GET /journal/{id}', False,
+         lambda c, i: ('GET', '/journal/%d' % entry_id(), None)),
+        ('GET /login', False, lambda c, i: ('GET', '/login', None)),
+        ('POST /login', False, lambda c, i: (
+            'POST', '/login', {'username': USERNAME, 'password': PASSWORD})),
+        ('GET /journal/new-entry', True,
+         lambda c, i: ('GET', '/journal/new-entry', None)),
+        ('POST /journal/new-entry', True, create),
+        ('GET /journal/{id}/edit-entry', True,
+         lambda c, i: ('GET', '/journal/%d/edit-entry' % entry_id(), None)),
+        ('POST /journal/{id}/edit-entry', True, edit),
+    ]
+
+
+def run_scenario(client, make_request, requests, concurrency, counter):
+    """Run one route; return its measurements."""
+    latencies = []
+    errors = [0]
+    lock = threading.Lock()
+    remaining = [requests]
+
+    def worker(client):
+        while True:
+            with lock:
+                if remaining[0] <= 0:
+                    return
+                remaining[0] -= 1
+                i = remaining[0]
+            method, path, params = make_request(client, i)
+            started = time.time()
+            try:
+                status, _ = client.request(method, path, params)
+            except Exception:
+                status = 599
+            elapsed = time.time() - started
+            with lock:
+                latencies.append(elapsed)
+                if status >= 400:
+                    errors[0] += 1
+
+    queries_before = counter.count
+    started = time.time()
+    if concurrency == 1:
+        worker(client)
+    else:
+        threads = [threading.Thread(target=worker, args=(client.clone(),))
+                   for _ in range(concurrency)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    wall = time.time() - started
+    latencies.sort()
+    return {
+        'requests': len(latencies),
+        'errors': errors[0],
+        'throughput': len(latencies) / wall if wall else 0.0,
+        'p50_ms': percentile(latencies, 50) * 1000,
+        'p95_ms': percentile(latencies, 95) * 1000,
+        'p99_ms': percentile(latencies, 99) * 1000,
+        # form fetches for CSRF tokens are included in the count
+        'queries_per_request': (
+            float(counter.count - queries_before) / len(latencies)
+            if latencies else 0.0),
+    }
+
+
+def log_in(client):
+    status, _ = client.request('POST', '/login', {'username': USERNAME,
+                                                  'password': PASSWORD})
+    return status
+
+
+def run_suite(client, corpus, args, counter):
+    rand = random.Random(args.seed)
+    results = {}
+    for name, authenticated, make_request in scenarios(corpus, rand):
+        if args.routes and name not in args.routes:
+            continue
+        if authenticated:
+            log_in(client)
+        else:
+            client.request('GET', '/logout')
+        concurrency = 1 if client.name == 'inprocess' else args.concurrency
+        results[name] = run_scenario(client, make_request, args.requests,
+                                     concurrency, counter)
+        report(client.name, name, results[name])
+    return results
+
+
+def report(mode, name, result):
+    sys.stderr.write(
+        '%-9s %-32s %7.1f req/s  p50 %7.2fms  p95 %7.2fms  p99 %7.2fms  '
+        '%5.1f q/req  %d errors\n' % (
+            mode, name, result['throughput'], result['p50_ms'],
+            result['p95_ms'], result['p99_ms'],
+            result['queries_per_request'], result['errors']))
+
+
+def compare(results, baseline, threshold):
+    """Return descriptions of routes that regressed against baseline."""
+    regressions = []
+    for mode, routes in results.items():
+        for name, result in routes.items():
+            before = baseline.get('results', {}).get(mode, {}).get(name)
+            if not before:
+                continue
+            if result['p95_ms'] > before['p95_ms'] * (1 + threshold):
+                regressions.append('%s %s: p95 %.2fms -> %.2fms' % (
+                    mode, name, before['p95_ms'], result['p95_ms']))
+            if result['throughput'] < before['throughput'] * (1 - threshold):
+                regressions.append('%s %s: throughput %.1f -> %.1f req/s' % (
+                    mode, name, before['throughput'], result['throughput']))
+            if (result['queries_per_request'] >
+                    before['queries_per_request'] + 0.5):
+                regressions.append('%s %s: queries %.1f -> %.1f per request'
+                                   % (mode, name,
+                                      before['queries_per_request'],
+                                      result['queries_per_request']))
+    return regressions
+
+
+def build_app(args):
+    os.environ.setdefault('AUTH_USERNAME', USERNAME)
+    if os.environ['AUTH_USERNAME'] == USERNAME:
+        from passlib.apps import custom_app_context as pwd_context
+        os.environ['AUTH_PASSWORD'] = pwd_context.hash(PASSWORD)
+    settings = settings_from_environ(get_appsettings(args.config))
+    # 'POST /login' times password checks, not the login throttle
+    settings['login.guard'] = 'false'
+    settings.update(dict(option.split('=', 1) for option in args.set))
+    return settings, make_app({}, **settings)
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--config', default=os.path.join(ROOT,
+                                                         'production.ini'))
+    parser.add_argument('--set', action='append', default=[],
+                        metavar='key=value', help='override an app setting')
+    parser.add_argument('--corpus', type=int, default=1000,
+                        help='synthetic entries to seed (1000, 100000, ...)')
+    parser.add_argument('--no-seed', action='store_true',
+                        help='benchmark the existing data instead')
+    parser.add_argument('--requests', type=int, default=200,
+                        help='requests per route')
+    parser.add_argument('--concurrency', type=int, default=8,
+                        help='client threads against waitress')
+    parser.add_argument('--threads', type=int, default=4,
+                        help='waitress worker threads')
+    parser.add_argument('--mode', choices=('inprocess', 'waitress', 'both'),
+                        default='both')
+    parser.add_argument('--route', dest='routes', action='append',
+                        help='only run this route (repeatable)')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help='write results JSON here')
+    parser.add_argument('--baseline', help='results JSON to compare with')
+    parser.add_argument('--threshold', type=float, default=0.2,
+                        help='allowed relative regression (default 20%%)')
+    return parser.parse_args(argv)
+
+
+def main(argv=sys.argv[1:]):
+    args = parse_args(argv)
+    settings, app = build_app(args)
+    seconds = None
+    if not args.no_seed:
+        seconds = seed(settings, args.corpus, args.seed)
+        sys.stderr.write('seeded %d entries in %.1fs\n'
+                         % (args.corpus, seconds))
+    engine = app.registry['dbsession_factory'].kw['bind']
+    counter = QueryCounter(engine)
+    results = {}
+    if args.mode in ('inprocess', 'both'):
+        results['inprocess'] = run_suite(InProcessClient(app), args.corpus,
+                                         args, counter)
+    if args.mode in ('waitress', 'both'):
+        from waitress.server import create_server
+        # queue depth warnings are expected while saturating the server
+        logging.getLogger('waitress.queue').setLevel(logging.ERROR)
+        server = create_server(app, host='127.0.0.1', port=0,
+                               threads=args.threads)
+        thread = threading.Thread(target=server.run)
+        thread.daemon = True
+        thread.start()
+        client = HTTPClient('127.0.0.1', server.effective_port)
+        try:
+            results['waitress'] = run_suite(client, args.corpus, args,
+                                            counter)
+        finally:
+            server.close()
+    output = {
+        'meta': {
+            'corpus': args.corpus,
+            'seed_seconds': seconds,
+            'requests_per_route': args.requests,
+            'concurrency': args.concurrency,
+            'waitress_threads': args.threads,
+            'dialect': engine.dialect.name,
+            'python': platform.python_version(),
+            'timestamp': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+        },
+        'results': results,
+    }
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(output, f, indent=2, sort_keys=True)
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.threshold)
+        for line in regressions:
+            sys.stderr.write('REGRESSION %s\n' % line)
+        if regressions:
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
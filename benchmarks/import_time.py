@@ -0,0 +1,119 @@
+"""Import-time breakdown of building the app.
+
+Builds the app once in a fresh interpreter running ``python -X
+importtime``. It then reports the total startup time, how much of it
+went to imports, the resident memory afterwards, and the slowest
+top-level packages and individual modules:
+
+    DATABASE_URL=postgresql:///lj_bench python benchmarks/import_time.py
+
+Use --output to keep the numbers as JSON for comparing runs.
+"""
+import argparse
+import json
+import os
+import re
+import subprocess
+import sys
+from collections import defaultdict
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(HERE)
+
+LINE = re.compile(r'^import time:\s+(\d+) \|\s+(\d+) \|( *)(\S+)$')
+
+CHILD = """\
+import json, resource, sys, time
+started = time.time()
+sys.path.insert(0, %(root)r)
+from pyramid.paster import get_appsettings
+from learning_journal import main
+from learning_journal.models import settings_from_environ
+imported = time.time()
+settings = settings_from_environ(get_appsettings(%(config)r))
+settings.update(%(overrides)r)
+main({}, **settings)
+built = time.time()
+usage = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+sys.stdout.write(json.dumps({
+    'import_ms': (imported - started) * 1000,
+    'main_ms': (built - imported) * 1000,
+    'max_rss_kb': usage // 1024 if sys.platform == 'darwin' else usage,
+    'modules': len(sys.modules),
+}))
+"""
+
+
+def parse_importtime(lines):
+    """Return [(module, self_us, cumulative_us, depth)] from -X importtime."""
+    modules = []
+    for line in lines:
+        match = LINE.match(line.rstrip('\n'))
+        if match:
+            self_us, cumulative, indent, name = match.groups()
+            modules.append((name, int(self_us), int(cumulative),
+                            len(indent) // 2))
+    return modules
+
+
+def by_package(modules):
+    """Sum the self time of modules per top-level package, in us."""
+    totals = defaultdict(int)
+    for name, self_us, _, _ in modules:
+        totals[name.split('.')[0]] += self_us
+    return sorted(totals.items(), key=lambda item: -item[1])
+
+
+def measure(config, overrides):
+    code = CHILD % {'root': ROOT, 'config': config, 'overrides': overrides}
+    process = subprocess.Popen([sys.executable, '-X', 'importtime', '-c',
+                                code], stdout=subprocess.PIPE,
+                               stderr=subprocess.PIPE,
+                               universal_newlines=True)
+    out, err = process.communicate()
+    if process.returncode:
+        sys.stderr.write(err)
+        raise SystemExit(process.returncode)
+    result = json.loads(out)
+    result['imports'] = parse_importtime(err.splitlines())
+    return result
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--config', default=os.path.join(ROOT,
+                                                         'production.ini'))
+    parser.add_argument('--set', action='append', default=[],
+                        metavar='key=value', help='override an app setting')
+    parser.add_argument('--top', type=int, default=15,
+                        help='packages and modules to list')
+    parser.add_argument('--output', help='write results JSON here')
+    return parser.parse_args(argv)
+
+
+def main(argv=sys.argv[1:]):
+    args = parse_args(argv)
+    overrides = dict(option.split('=', 1) for option in args.set)
+    result = measure(args.config, overrides)
+    modules = result.pop('imports')
+    packages = by_package(modules)
+    slowest = sorted(modules, key=lambda module: -module[2])[:args.top]
+    write = sys.stdout.write
+    write('imports %.1fms, main() %.1fms, %d modules, max RSS %.1f MB\n\n'
+          % (result['import_ms'], result['main_ms'], result['modules'],
+             result['max_rss_kb'] / 1024.0))
+    write('%-30s %10s\n' % ('package', 'self ms'))
+    for name, self_us in packages[:args.top]:
+        write('%-30s %10.1f\n' % (name, self_us / 1000.0))
+    write('\n%-50s %10s\n' % ('module', 'cumul. ms'))
+    for name, _, cumulative, depth in slowest:
+        write('%-50s %10.1f\n' % ('  ' * depth + name, cumulative / 1000.0))
+    if args.output:
+        result['packages'] = dict(packages)
+        with open(args.output, 'w') as f:
+            json.dump(result, f, indent=2, sort_keys=True)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
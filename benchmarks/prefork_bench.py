@@ -0,0 +1,273 @@
+"""Throughput of the prefork runner as worker processes are added.
+
+For each worker count the app is served by ``learning_journal.prefork``
+in a fresh process and driven for --duration seconds by client processes
+(so the clients' own interpreter lock does not cap the rate) over
+keep-alive connections, fetching the home page and entry pages. It
+reports requests per second, p50/p95/p99 latency and the speedup and
+efficiency over one worker. One worker is what ``pserve`` gives; the
+speedup should follow the number of cores until the database or the
+clients run out.
+
+    DATABASE_URL=postgresql:///lj_bench \\
+        python benchmarks/prefork_bench.py --workers 1 --workers 2 \\
+        --workers 4 --output prefork.json
+
+The database is seeded with --corpus synthetic entries unless --no-seed
+is given. Load shedding is off so that the rates are not capped by it.
+"""
+import argparse
+import json
+import logging
+import multiprocessing
+import os
+import platform
+import random
+import signal
+import socket
+import subprocess
+import sys
+import threading
+import time
+
+try:
+    from http.client import HTTPConnection
+except ImportError:  # pragma: no cover - python 2
+    from httplib import HTTPConnection
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(HERE)
+
+DEFAULTS = {'shed.enabled': 'false', 'pyramid.reload_templates': 'false'}
+
+
+def serve(config, port, workers, threads, options):
+    """Child process: load the app once, then serve it from workers."""
+    sys.path.insert(0, ROOT)
+    from pyramid.paster import get_appsettings
+
+    from learning_journal import main as make_app
+    from learning_journal.models import settings_from_environ
+    from learning_journal.prefork import serve as prefork_serve
+
+    settings = settings_from_environ(get_appsettings(config))
+    settings.update(dict(option.split('=', 1) for option in options))
+    app = make_app({}, **settings)
+    # a saturated server warns of its queue on every request
+    logging.getLogger('waitress.queue').setLevel(logging.ERROR)
+    prefork_serve(app, {'host': '127.0.0.1', 'port': port,
+                        'threads': threads},
+                  workers=workers)
+
+
+def free_port():
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+def wait_until_serving(port, deadline):
+    while True:
+        try:
+            connection = HTTPConnection('127.0.0.1', port, timeout=5)
+            connection.request('GET', '/')
+            connection.getresponse().read()
+            return
+        except (socket.error, IOError):
+            if time.time() > deadline:
+                raise
+            time.sleep(0.05)
+
+
+def percentile(values, pct):
+    """Return the nearest-rank percentile of sorted values."""
+    if not values:
+        return 0.0
+    index = max(0, int(round(pct / 100.0 * len(values))) - 1)
+    return values[min(index, len(values) - 1)]
+
+
+def client(job):
+    """Client process: fetch paths from threads until the end time."""
+    port, paths, threads, warm_until, until, seed = job
+    latencies = []
+    errors = [0]
+    lock = threading.Lock()
+
+    def drive(number):
+        rand = random.Random(seed * 1000 + number)
+        connection = HTTPConnection('127.0.0.1', port, timeout=30)
+        mine = []
+        failed = 0
+        while True:
+            started = time.time()
+            if started >= until:
+                break
+            try:
+                connection.request('GET', rand.choice(paths))
+                response = connection.getresponse()
+                response.read()
+                ok = response.status == 200
+            except (socket.error, IOError):
+                connection.close()
+                connection = HTTPConnection('127.0.0.1', port, timeout=30)
+                ok = False
+            if started < warm_until:
+                continue
+            if ok:
+                mine.append(time.time() - started)
+            else:
+                failed += 1
+        connection.close()
+        with lock:
+            latencies.extend(mine)
+            errors[0] += failed
+
+    pool = [threading.Thread(target=drive, args=(number,))
+            for number in range(threads)]
+    for thread in pool:
+        thread.start()
+    for thread in pool:
+        thread.join()
+    return latencies, errors[0]
+
+
+def measure(args, workers, paths):
+    """Serve with workers processes and load it; return the results."""
+    port = free_port()
+    command = [sys.executable, os.path.abspath(__file__), '--serve',
+               str(port), '--config', args.config, '--workers', str(workers),
+               '--threads', str(args.threads)]
+    options = ['%s=%s' % item for item in sorted(DEFAULTS.items())]
+    for option in options + args.set:
+        command.extend(['--set', option])
+    child = subprocess.Popen(command)
+    try:
+        wait_until_serving(port, time.time() + args.timeout)
+        warm_until = time.time() + args.warmup
+        until = warm_until + args.duration
+        jobs = [(port, paths, args.connections, warm_until, until, number)
+                for number in range(args.clients)]
+        pool = multiprocessing.Pool(args.clients)
+        try:
+            results = pool.map(client, jobs)
+        finally:
+            pool.close()
+            pool.join()
+    finally:
+        child.send_signal(signal.SIGTERM)
+        child.wait()
+    latencies = sorted(latency for result in results
+                       for latency in result[0])
+    return {
+        'requests': len(latencies),
+        'errors': sum(result[1] for result in results),
+        'rps': len(latencies) / float(args.duration),
+        'p50_ms': percentile(latencies, 50) * 1000,
+        'p95_ms': percentile(latencies, 95) * 1000,
+        'p99_ms': percentile(latencies, 99) * 1000,
+    }
+
+
+def entry_paths(settings, limit):
+    """Return the home page and up to limit entry pages."""
+    from learning_journal.models import Entry, get_engine
+    from sqlalchemy.orm import sessionmaker
+
+    engine = get_engine(settings)
+    session = sessionmaker(bind=engine)()
+    try:
+        ids = [row[0] for row in session.query(Entry.id).limit(limit)]
+    finally:
+        session.close()
+        engine.dispose()
+    return ['/'] + ['/journal/%d' % id for id in ids]
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--config', default=os.path.join(ROOT,
+                                                         'production.ini'))
+    parser.add_argument('--set', action='append', default=[],
+                        metavar='key=value', help='override an app setting')
+    parser.add_argument('--corpus', type=int, default=1000,
+                        help='synthetic entries to seed')
+    parser.add_argument('--no-seed', action='store_true',
+                        help='use the existing data instead')
+    parser.add_argument('--workers', dest='worker_counts', type=int,
+                        action='append',
+                        help='worker processes to try (repeatable; default '
+                             '1, 2, 4, ... up to the number of cores)')
+    parser.add_argument('--threads', type=int, default=8,
+                        help='waitress threads per worker')
+    parser.add_argument('--clients', type=int,
+                        default=max(2, multiprocessing.cpu_count()),
+                        help='client processes')
+    parser.add_argument('--connections', type=int, default=8,
+                        help='connections per client process')
+    parser.add_argument('--duration', type=float, default=10,
+                        help='seconds of measured load per worker count')
+    parser.add_argument('--warmup', type=float, default=2,
+                        help='seconds of load before measuring')
+    parser.add_argument('--timeout', type=float, default=60,
+                        help='seconds to wait for the server to start')
+    parser.add_argument('--output', help='write results JSON here')
+    parser.add_argument('--serve', type=int, metavar='PORT',
+                        help=argparse.SUPPRESS)
+    return parser.parse_args(argv)
+
+
+def default_worker_counts():
+    cores = multiprocessing.cpu_count()
+    counts = [1]
+    while counts[-1] * 2 <= cores:
+        counts.append(counts[-1] * 2)
+    if counts[-1] != cores:
+        counts.append(cores)
+    return counts
+
+
+def main(argv=sys.argv[1:]):
+    args = parse_args(argv)
+    if args.serve:
+        return serve(args.config, args.serve, args.worker_counts[0],
+                     args.threads, args.set)
+    sys.path.insert(0, ROOT)
+    from pyramid.paster import get_appsettings
+    from learning_journal.models import settings_from_environ
+    settings = settings_from_environ(get_appsettings(args.config))
+    settings.update(dict(option.split('=', 1) for option in args.set))
+    if not args.no_seed:
+        from http_bench import seed
+        seed(settings, args.corpus)
+    paths = entry_paths(settings, 200)
+    results = {}
+    single = None
+    for workers in args.worker_counts or default_worker_counts():
+        results[workers] = result = measure(args, workers, paths)
+        if single is None:
+            single = result['rps'] or 1.0
+        result['speedup'] = result['rps'] / single
+        result['efficiency'] = result['speedup'] / workers
+        sys.stdout.write(
+            '%2d workers %9.1f req/s  x%5.2f (%3.0f%%)  p50 %7.1fms  '
+            'p95 %7.1fms  p99 %7.1fms  errors %d\n' % (
+                workers, result['rps'], result['speedup'],
+                result['efficiency'] * 100, result['p50_ms'],
+                result['p95_ms'], result['p99_ms'], result['errors']))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'meta': {'cores': multiprocessing.cpu_count(),
+                                'threads': args.threads,
+                                'clients': args.clients,
+                                'connections': args.connections,
+                                'duration': args.duration,
+                                'python': platform.python_version()},
+                       'results': results}, f, indent=2, sort_keys=True)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
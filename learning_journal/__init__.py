@@ -1,15 +1,27 @@
-import os
 from pyramid.config import Configurator
 
+from .models import settings_from_environ
+from .templating import warm_up_from_settings
+
 
 def main(global_config, **settings):
     """ This function returns a Pyramid WSGI application.
     """
-    settings["sqlalchemy.url"] = os.environ["DATABASE_URL"]
+    settings = settings_from_environ(settings)
     config = Configurator(settings=settings)
     config.include('pyramid_jinja2')
+    config.include('.templating')
+    config.include('.renderers')
     config.include('.models')
     config.include('.routes')
     config.include('.security')
-    config.scan()
-    return config.make_wsgi_app()
+    config.include('.cache')
+    config.include('.metrics')
+    config.include('.shedding')
+    config.include('.instrumentation')
+    config.include('.assets')
+    # only the view modules; a bare scan() would import tests and scripts
+    config.scan('.views')
+    app = config.make_wsgi_app()
+    warm_up_from_settings(app, settings)
+    return app
@@ -0,0 +1,59 @@
+"""Pyramid bootstrap environment for Alembic.
+
+Run from the project directory with the app's ini file, e.g.
+``alembic -c development.ini upgrade head``. ``DATABASE_URL`` overrides
+``sqlalchemy.url`` as it does for the app. ``learning_journal.migrations``
+runs the same migrations on a connection it passes in.
+"""
+from alembic import context
+from pyramid.paster import get_appsettings, setup_logging
+
+from learning_journal.migrations import include_object
+from learning_journal.models import get_engine, settings_from_environ
+from learning_journal.models.meta import Base
+
+config = context.config
+target_metadata = Base.metadata
+
+
+def get_settings():
+    setup_logging(config.config_file_name)
+    return settings_from_environ(get_appsettings(config.config_file_name))
+
+
+def configure(**kw):
+    context.configure(target_metadata=target_metadata,
+                      include_object=include_object,
+                      **kw)
+
+
+def run_migrations_offline():
+    """Write the migration SQL to stdout instead of running it."""
+    url = get_settings()['sqlalchemy.url']
+    configure(url=url, literal_binds=True,
+              render_as_batch=url.startswith('sqlite'))
+    with context.begin_transaction():
+        context.run_migrations()
+
+
+def run_migrations_online():
+    connection = config.attributes.get('connection')
+    if connection is not None:
+        configure(connection=connection,
+                  render_as_batch=connection.dialect.name == 'sqlite')
+        with context.begin_transaction():
+            context.run_migrations()
+        return
+    engine = get_engine(get_settings())
+    with engine.connect() as connection:
+        configure(connection=connection,
+                  render_as_batch=engine.dialect.name == 'sqlite')
+        with context.begin_transaction():
+            context.run_migrations()
+    engine.dispose()
+
+
+if context.is_offline_mode():
+    run_migrations_offline()
+else:
+    run_migrations_online()
@@ -0,0 +1,37 @@
+"""baseline schema
+
+The entries table as ``metadata.create_all`` built it in the first
+release, before entries had versions and the journal a state row.
+
+Revision ID: 1f6a0c93d8b2
+Revises:
+Create Date: 2026-10-18 09:05:11.204871
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = '1f6a0c93d8b2'
+down_revision = None
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        'models',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('title', sa.Unicode(), nullable=True),
+        sa.Column('body', sa.Unicode(), nullable=True),
+        sa.Column('creation_date', sa.Date(), nullable=True),
+        sa.Column('edit_date', sa.Date(), nullable=True),
+        sa.PrimaryKeyConstraint('id', name=op.f('pk_models')),
+    )
+    op.create_index('my_index', 'models', ['title'], unique=True,
+                    mysql_length=255)
+
+
+def downgrade():
+    op.drop_index('my_index', table_name='models')
+    op.drop_table('models')
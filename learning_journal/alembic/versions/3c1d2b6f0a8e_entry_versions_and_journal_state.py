@@ -0,0 +1,48 @@
+"""entry versions and journal state
+
+Count each entry's edits in ``version`` (existing entries start at 1),
+add the single-row ``journal_state`` table that records when the journal
+last changed, and build the full-text search index over the entries
+already there. Databases that ``metadata.create_all`` built with these
+are stamped at this revision.
+
+Revision ID: 3c1d2b6f0a8e
+Revises: 1f6a0c93d8b2
+Create Date: 2026-10-18 09:12:40.512301
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+from learning_journal.models.search import SQLITE_DROP, build_search_index
+
+# revision identifiers, used by Alembic.
+revision = '3c1d2b6f0a8e'
+down_revision = '1f6a0c93d8b2'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('models', sa.Column('version', sa.Integer(),
+                                      nullable=False, server_default='1'))
+    op.create_table(
+        'journal_state',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('version', sa.Integer(), nullable=False),
+        sa.Column('modified', sa.DateTime(), nullable=False),
+        sa.PrimaryKeyConstraint('id', name=op.f('pk_journal_state')),
+    )
+    build_search_index(op.get_bind())
+
+
+def downgrade():
+    dialect = op.get_bind().dialect.name
+    if dialect == 'postgresql':
+        op.execute('DROP INDEX IF EXISTS ix_models_search')
+    op.drop_table('journal_state')
+    # SQLite rebuilds the table, and its search triggers go with it
+    with op.batch_alter_table('models') as batch:
+        batch.drop_column('version')
+    if dialect == 'sqlite':
+        op.execute(SQLITE_DROP)
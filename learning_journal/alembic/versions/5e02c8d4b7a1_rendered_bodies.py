@@ -0,0 +1,40 @@
+"""rendered bodies
+
+Store the sanitized HTML of each entry's Markdown body, an excerpt and
+word count for listings, and the version of the renderer that produced
+them. Existing rows start at render_version 0; run ``render_entries``
+after upgrading to render them.
+
+Revision ID: 5e02c8d4b7a1
+Revises: 9a4e7f215c3b
+Create Date: 2026-10-18 10:21:37.604118
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+from learning_journal.models.search import build_search_index
+
+# revision identifiers, used by Alembic.
+revision = '5e02c8d4b7a1'
+down_revision = '9a4e7f215c3b'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('models', sa.Column('body_html', sa.Unicode()))
+    op.add_column('models', sa.Column('excerpt', sa.Unicode()))
+    op.add_column('models', sa.Column('word_count', sa.Integer()))
+    op.add_column('models', sa.Column('render_version', sa.Integer(),
+                                      nullable=False, server_default='0'))
+
+
+def downgrade():
+    # SQLite rebuilds the table, and its search triggers go with it
+    with op.batch_alter_table('models') as batch:
+        batch.drop_column('render_version')
+        batch.drop_column('word_count')
+        batch.drop_column('excerpt')
+        batch.drop_column('body_html')
+    build_search_index(op.get_bind())
@@ -0,0 +1,38 @@
+"""archive months
+
+Keep the number of entries created in each month in a summary table, so
+archive pages and the calendar do not group the entries table on every
+view, and count the entries already there.
+
+Revision ID: 7b3f9e60d2c4
+Revises: 5e02c8d4b7a1
+Create Date: 2026-10-18 11:02:15.930276
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+from learning_journal.models.archivemodel import rebuild_archive
+
+# revision identifiers, used by Alembic.
+revision = '7b3f9e60d2c4'
+down_revision = '5e02c8d4b7a1'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        'archive_months',
+        sa.Column('year', sa.Integer(), autoincrement=False, nullable=False),
+        sa.Column('month', sa.Integer(), autoincrement=False,
+                  nullable=False),
+        sa.Column('entries', sa.Integer(), nullable=False),
+        sa.PrimaryKeyConstraint('year', 'month',
+                                name=op.f('pk_archive_months')),
+    )
+    rebuild_archive(op.get_bind())
+
+
+def downgrade():
+    op.drop_table('archive_months')
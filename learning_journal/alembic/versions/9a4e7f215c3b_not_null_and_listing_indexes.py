@@ -0,0 +1,65 @@
+"""not null entries and listing indexes
+
+Entries always have a title, body and creation date in the views, so
+fill in any missing ones and make the columns NOT NULL. Index
+(creation_date, id) for newest-first listings and date-range archives
+(both databases scan it backwards for DESC), and edit_date for lookups
+of recently edited entries.
+
+Revision ID: 9a4e7f215c3b
+Revises: 3c1d2b6f0a8e
+Create Date: 2026-10-18 09:40:02.118532
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+from learning_journal.models.search import build_search_index
+
+# revision identifiers, used by Alembic.
+revision = '9a4e7f215c3b'
+down_revision = '3c1d2b6f0a8e'
+branch_labels = None
+depends_on = None
+
+models = sa.table(
+    'models',
+    sa.column('id', sa.Integer),
+    sa.column('title', sa.Unicode),
+    sa.column('body', sa.Unicode),
+    sa.column('creation_date', sa.Date),
+    sa.column('edit_date', sa.Date),
+)
+
+
+def set_nullable(nullable):
+    # SQLite rebuilds the table, and its search triggers go with it
+    with op.batch_alter_table('models') as batch:
+        batch.alter_column('title', existing_type=sa.Unicode(),
+                           nullable=nullable)
+        batch.alter_column('body', existing_type=sa.Unicode(),
+                           nullable=nullable)
+        batch.alter_column('creation_date', existing_type=sa.Date(),
+                           nullable=nullable)
+    build_search_index(op.get_bind())
+
+
+def upgrade():
+    op.execute(models.update().where(models.c.title.is_(None)).values(
+        title=sa.literal(u'Untitled entry ') +
+        sa.cast(models.c.id, sa.Unicode)))
+    op.execute(models.update().where(models.c.body.is_(None)).values(
+        body=u''))
+    op.execute(models.update().where(models.c.creation_date.is_(None))
+               .values(creation_date=sa.func.coalesce(
+                   models.c.edit_date, sa.func.current_date())))
+    set_nullable(False)
+    op.create_index('ix_models_creation_date', 'models',
+                    ['creation_date', 'id'])
+    op.create_index('ix_models_edit_date', 'models', ['edit_date'])
+
+
+def downgrade():
+    op.drop_index('ix_models_edit_date', table_name='models')
+    op.drop_index('ix_models_creation_date', table_name='models')
+    set_nullable(True)
@@ -0,0 +1,203 @@
+"""Fingerprinted, precompressed static assets.
+
+``build_assets`` (the build step, run at deploy time) writes a manifest
+of content hashes for everything under ``learning_journal/static`` and
+gzip (and brotli, when the ``brotli`` package is installed) copies of
+the text assets next to the originals.
+
+At runtime ``ContentHashCacheBuster`` adds each file's hash to the URLs
+made by ``request.static_url``. A tween then serves ``/static/`` itself.
+It picks a ``.br`` or ``.gz`` variant the client accepts, and marks
+fingerprinted URLs as immutable for a year, since a changed file always
+gets a new URL. Anything it cannot serve falls through to the regular
+static view.
+"""
+import gzip
+import hashlib
+import json
+import mimetypes
+import os
+import shutil
+
+from pyramid.path import AssetResolver
+from pyramid.response import FileResponse
+from pyramid.static import QueryStringCacheBuster
+from pyramid.tweens import INGRESS
+
+try:
+    import brotli
+except ImportError:  # pragma: no cover - optional dependency
+    brotli = None
+
+STATIC_SPEC = 'learning_journal:static/'
+MANIFEST_NAME = 'assets.json'
+TOKEN_PARAM = 'x'
+COMPRESSIBLE = ('.css', '.js', '.svg', '.html', '.txt', '.json', '.map')
+ENCODINGS = (('br', '.br'), ('gzip', '.gz'))
+ONE_YEAR = 365 * 24 * 60 * 60
+IMMUTABLE = 'public, max-age=%d, immutable' % ONE_YEAR
+
+
+def static_root():
+    """Return the filesystem path of the package's static directory."""
+    return AssetResolver().resolve(STATIC_SPEC).abspath()
+
+
+def file_hash(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(65536), b''):
+            digest.update(chunk)
+    return digest.hexdigest()[:12]
+
+
+def iter_assets(root):
+    """Yield the path, relative to root, of every original asset."""
+    for directory, _, files in os.walk(root):
+        for name in sorted(files):
+            if name == MANIFEST_NAME or name.endswith(('.gz', '.br')):
+                continue
+            path = os.path.join(directory, name)
+            yield os.path.relpath(path, root).replace(os.sep, '/')
+
+
+def is_stale(path, compressed_path):
+    return (not os.path.exists(compressed_path) or
+            os.path.getmtime(compressed_path) < os.path.getmtime(path))
+
+
+def compress(path):
+    """Write .gz (and .br) copies of path; return the encodings written."""
+    written = []
+    gz_path = path + '.gz'
+    if is_stale(path, gz_path):
+        with open(path, 'rb') as src:
+            # mtime=0 keeps the output identical between builds
+            with gzip.GzipFile(gz_path, 'wb', 9, mtime=0) as dst:
+                shutil.copyfileobj(src, dst)
+    written.append('gzip')
+    if brotli is not None:
+        br_path = path + '.br'
+        if is_stale(path, br_path):
+            with open(path, 'rb') as src:
+                data = brotli.compress(src.read())
+            with open(br_path, 'wb') as dst:
+                dst.write(data)
+        written.append('br')
+    return written
+
+
+def build_assets(root=None):
+    """Hash and precompress every asset under root; write the manifest.
+
+    Returns the manifest, a mapping of relative path to content hash.
+    """
+    root = root or static_root()
+    manifest = {}
+    for name in iter_assets(root):
+        path = os.path.join(root, name)
+        manifest[name] = file_hash(path)
+        if name.endswith(COMPRESSIBLE):
+            compress(path)
+    with open(os.path.join(root, MANIFEST_NAME), 'w') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    return manifest
+
+
+class StaticAssets(object):
+    """The static directory, its content hashes and how to serve it."""
+
+    def __init__(self, root, prefix='/static/', max_age=3600):
+        self.root = os.path.abspath(root)
+        self.prefix = prefix
+        self.max_age = max_age
+        self.hashes = {}
+        manifest = os.path.join(self.root, MANIFEST_NAME)
+        if os.path.exists(manifest):
+            with open(manifest) as f:
+                self.hashes.update(json.load(f))
+
+    def token(self, name):
+        """Return the content hash of the asset called name."""
+        token = self.hashes.get(name)
+        if token is None:
+            # not built yet (development): hash on first use
+            path = self.resolve(name)
+            token = self.hashes[name] = file_hash(path) if path else ''
+        return token
+
+    def resolve(self, name):
+        """Return the file for asset name, or None if there is none."""
+        path = os.path.abspath(os.path.join(self.root, name))
+        if not path.startswith(self.root + os.sep) or not os.path.isfile(path):
+            return None
+        return path
+
+    def serve(self, request):
+        """Return a response for a /static/ request, or None."""
+        name = request.path_info[len(self.prefix):]
+        path = self.resolve(name)
+        if path is None or name == MANIFEST_NAME:
+            return None
+        content_type = mimetypes.guess_type(path)[0]
+        encoding = None
+        # no Accept-Encoding header means "anything" to webob; send the
+        # original to such clients rather than guess
+        if name.endswith(COMPRESSIBLE) and 'Accept-Encoding' in request.headers:
+            for coding, extension in ENCODINGS:
+                if (coding in request.accept_encoding and
+                        os.path.isfile(path + extension)):
+                    path, encoding = path + extension, coding
+                    break
+        response = FileResponse(path, request=request,
+                                content_type=content_type)
+        if encoding:
+            response.content_encoding = encoding
+        if name.endswith(COMPRESSIBLE):
+            response.vary = ('Accept-Encoding',)
+        token = request.GET.get(TOKEN_PARAM)
+        if token and token == self.token(name):
+            response.headers['Cache-Control'] = IMMUTABLE
+        else:
+            response.headers['Cache-Control'] = 'public, max-age=%d' % (
+                self.max_age)
+        return response
+
+
+class ContentHashCacheBuster(QueryStringCacheBuster):
+    """Add each asset's content hash to its URL."""
+
+    def __init__(self, assets):
+        super(ContentHashCacheBuster, self).__init__(param=TOKEN_PARAM)
+        self.assets = assets
+
+    def tokenize(self, request, subpath, kw):
+        return self.assets.token(subpath)
+
+
+def static_assets_tween_factory(handler, registry):
+    assets = registry['static_assets']
+
+    def static_assets_tween(request):
+        if request.path_info.startswith(assets.prefix):
+            response = assets.serve(request)
+            if response is not None:
+                return response
+        return handler(request)
+
+    return static_assets_tween
+
+
+def includeme(config):
+    """Serve fingerprinted, precompressed static assets.
+
+    Activate it using ``config.include('learning_journal.assets')``.
+    """
+    settings = config.get_settings()
+    assets = StaticAssets(static_root(),
+                          max_age=int(settings.get('assets.max_age', 3600)))
+    config.registry['static_assets'] = assets
+    config.add_cache_buster(STATIC_SPEC, ContentHashCacheBuster(assets))
+    config.add_tween('learning_journal.assets.static_assets_tween_factory',
+                     under=INGRESS)
+
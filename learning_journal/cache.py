@@ -0,0 +1,475 @@
+"""Rendered page cache for anonymous readers, and the entry cache.
+
+Pages are cached whole (status, headers and body) under a key made of the
+route name, the route's match (entry id, archive year and month), the
+home page cursor and the scheme and host the page links back to. Each page is stored with the journal version it was
+rendered from and only served to requests reading that version or an
+older one (from a lagging replica), so a write anywhere, in any process,
+retires every page rendered before it. Two backends share the
+same interface: ``LRUCache`` keeps pages in process memory, ``FileCache``
+keeps them in a directory that several worker processes can share.
+
+``EntryCache`` keeps the compact records the detail and edit pages render
+from, for signed-in users as well.
+"""
+import hashlib
+import os
+import pickle
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+
+from pyramid.response import Response
+
+from .conditional import not_modified
+from .events import EntryChanged, after_commit
+from .models.entrymodel import get_entry_record
+from .models.journalmodel import get_journal_state
+
+
+class LRUCache(object):
+    """Thread-safe in-process cache bounded by entry count and age."""
+
+    name = 'memory'
+
+    def __init__(self, max_entries=500, ttl=300):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, version=0):
+        """Return the value stored under key, or None.
+
+        Values stored for a journal version older than version miss.
+        """
+        now = time.time()
+        with self._lock:
+            item = self._data.get(key)
+            if item is None or item[0] < now or item[2] < version:
+                if item is not None:
+                    del self._data[key]
+                self.misses += 1
+                return None
+            # re-insert to mark the key as most recently used
+            del self._data[key]
+            self._data[key] = item
+            self.hits += 1
+            return item[1]
+
+    def set(self, key, value, version=0):
+        """Store value, rendered for journal version, under key.
+
+        A value already stored for a newer version is kept. The least
+        recently used keys are evicted.
+        """
+        with self._lock:
+            item = self._data.pop(key, None)
+            if item is not None and item[2] > version:
+                self._data[key] = item
+                return
+            self._data[key] = (time.time() + self.ttl, value, version)
+            while len(self._data) > self.max_entries:
+                self._data.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def delete_namespace(self, namespace):
+        """Drop every key whose first element is namespace."""
+        with self._lock:
+            for key in [k for k in self._data if k[0] == namespace]:
+                del self._data[key]
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'backend': self.name,
+            'entries': len(self),
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_ratio': float(self.hits) / lookups if lookups else 0.0,
+        }
+
+
+class FileCache(LRUCache):
+    """Cache kept on disk so that every worker process shares it.
+
+    Each namespace is a subdirectory and each key a pickled file inside
+    it. Writes go through a temporary file and a rename so readers never
+    see a partial page. Hit and miss counters are per process. A page
+    from a lagging replica may replace a newer one; readers of the newer
+    version then miss and render it again.
+    """
+
+    name = 'file'
+    prune_every = 100
+
+    def __init__(self, directory, max_entries=500, ttl=300):
+        super(FileCache, self).__init__(max_entries, ttl)
+        self.directory = directory
+        self._writes = 0
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def _path(self, key):
+        digest = hashlib.sha1(repr(key[1:]).encode('utf-8')).hexdigest()
+        return os.path.join(self.directory, str(key[0]), digest)
+
+    def get(self, key, version=0):
+        try:
+            with open(self._path(key), 'rb') as f:
+                expires, value, stored = pickle.load(f)
+        except (IOError, OSError, EOFError, ValueError,
+                pickle.UnpicklingError):
+            expires, value, stored = 0, None, 0
+        if expires < time.time() or stored < version:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return value
+
+    def set(self, key, value, version=0):
+        path = self._path(key)
+        directory = os.path.dirname(path)
+        if not os.path.isdir(directory):
+            try:
+                os.makedirs(directory)
+            except OSError:
+                pass  # another process created it first
+        fd, tmp = tempfile.mkstemp(dir=directory)
+        with os.fdopen(fd, 'wb') as f:
+            pickle.dump((time.time() + self.ttl, value, version), f, 2)
+        os.rename(tmp, path)
+        self._writes += 1
+        if self._writes % self.prune_every == 0:
+            self._prune(directory)
+
+    def _prune(self, directory):
+        """Remove the oldest files once a namespace grows past its bound."""
+        paths = [os.path.join(directory, name)
+                 for name in os.listdir(directory)]
+        if len(paths) <= self.max_entries:
+            return
+        paths.sort(key=lambda p: os.path.getmtime(p) if os.path.exists(p) else 0)
+        for path in paths[:len(paths) - self.max_entries]:
+            self._remove(path)
+
+    @staticmethod
+    def _remove(path):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+    def delete(self, key):
+        self._remove(self._path(key))
+
+    def delete_namespace(self, namespace):
+        shutil.rmtree(os.path.join(self.directory, str(namespace)),
+                      ignore_errors=True)
+
+    def clear(self):
+        for name in os.listdir(self.directory):
+            self.delete_namespace(name)
+
+    def __len__(self):
+        return sum(len(files) for _, _, files in os.walk(self.directory))
+
+
+class FeedCache(object):
+    """Rendered feeds, kept for the latest journal version only.
+
+    Feeds are stored under (journal version, key). Storing a feed for a
+    newer version drops everything rendered for older ones; feeds for an
+    older version (read from a lagging replica) are not stored.
+    """
+
+    def __init__(self):
+        self.version = None
+        self._feeds = {}
+        self._lock = threading.Lock()
+
+    def get(self, version, key):
+        """Return the feed stored under key for version, or None."""
+        with self._lock:
+            if version != self.version:
+                return None
+            return self._feeds.get(key)
+
+    def set(self, version, key, body):
+        with self._lock:
+            if self.version is not None and version < self.version:
+                return
+            if version != self.version:
+                self.version = version
+                self._feeds = {}
+            self._feeds[key] = body
+
+    def stats(self):
+        return {'version': self.version, 'feeds': len(self._feeds)}
+
+
+def record_size(record):
+    """Return roughly how many bytes record takes up in memory."""
+    return sys.getsizeof(record) + sum(sys.getsizeof(value)
+                                       for value in record)
+
+
+class EntryCache(object):
+    """Thread-safe LRU cache of EntryRecords, bounded by their size.
+
+    Writes in this process drop the entries they change once they
+    commit. Writes in other processes are noticed through the journal
+    version: ``check`` reads it at most every check_interval seconds and
+    empties the cache when it has moved. Records are stored with the
+    version they were read under, so a record read before a change is
+    never stored after the cache has been emptied for it.
+    """
+
+    def __init__(self, max_bytes=8 * 1024 * 1024, check_interval=1.0):
+        self.max_bytes = max_bytes
+        self.check_interval = check_interval
+        self.version = None
+        self.checked_at = 0
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+        self._records = OrderedDict()
+        self._lock = threading.Lock()
+
+    def check(self, current_version):
+        """Empty the cache if the journal changed; return its version.
+
+        current_version is a callable returning the journal version,
+        called only when the last check is check_interval old.
+        """
+        if (self.version is not None and
+                time.time() - self.checked_at < self.check_interval):
+            return self.version
+        version = current_version()
+        with self._lock:
+            self.checked_at = time.time()
+            if version != self.version:
+                if self.version is not None:
+                    self.invalidations += 1
+                self._records.clear()
+                self.size = 0
+                self.version = version
+        return version
+
+    def get(self, entry_id):
+        """Return the record of entry_id, or None."""
+        with self._lock:
+            item = self._records.pop(entry_id, None)
+            if item is None:
+                self.misses += 1
+                return None
+            # re-insert to mark the record as most recently used
+            self._records[entry_id] = item
+            self.hits += 1
+            return item[0]
+
+    def set(self, record, version):
+        """Store record, read under journal version, evicting the LRU."""
+        size = record_size(record)
+        with self._lock:
+            if version != self.version or size > self.max_bytes:
+                return
+            self._discard(record.id)
+            self._records[record.id] = (record, size)
+            self.size += size
+            while self.size > self.max_bytes:
+                _, (_, evicted) = self._records.popitem(last=False)
+                self.size -= evicted
+                self.evictions += 1
+
+    def _discard(self, entry_id):
+        item = self._records.pop(entry_id, None)
+        if item is not None:
+            self.size -= item[1]
+
+    def delete(self, entry_id):
+        with self._lock:
+            self._discard(entry_id)
+
+    def clear(self):
+        with self._lock:
+            self._records.clear()
+            self.size = 0
+            self.version = None
+
+    def __len__(self):
+        return len(self._records)
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'entries': len(self),
+            'bytes': self.size,
+            'max_bytes': self.max_bytes,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_ratio': float(self.hits) / lookups if lookups else 0.0,
+            'evictions': self.evictions,
+            'invalidations': self.invalidations,
+            'journal_version': self.version,
+        }
+
+
+def entry_record(request, entry_id, load=True):
+    """Return the EntryRecord of entry_id through the entry cache.
+
+    With load false only a cached record is returned. Returns None for
+    missing entries.
+    """
+    dbsession = request.dbsession
+    cache = request.registry.get('entry_cache')
+    if cache is None:
+        return get_entry_record(dbsession, entry_id) if load else None
+    version = cache.check(lambda: get_journal_state(dbsession)[0])
+    record = cache.get(entry_id)
+    if record is None and load:
+        record = get_entry_record(dbsession, entry_id)
+        if record is not None:
+            cache.set(record, version)
+    return record
+
+
+# set in the WSGI environ of requests that must not read or fill the
+# page cache, such as the start-up warm-up
+BYPASS_ENVIRON_KEY = 'learning_journal.page_cache.bypass'
+
+
+def page_key(request):
+    """Return the cache key of the page answering request.
+
+    Pages link to themselves and their static files by absolute URL, so
+    the scheme and host they were requested under are part of the key.
+    """
+    return (request.matched_route.name,
+            '/'.join(str(value) for name, value
+                     in sorted(request.matchdict.items())),
+            request.params.get('before', ''),
+            request.host_url)
+
+
+def cached_page(view):
+    """View decorator serving anonymous GETs from the page cache.
+
+    Pyramid applies view decorators outside the renderer, so the wrapped
+    view returns a finished response which is stored as-is, with the
+    journal version read just before rendering it.
+    """
+    def wrapper(context, request):
+        cache = request.registry.get('page_cache')
+        if (cache is None or request.method != 'GET' or
+                request.environ.get(BYPASS_ENVIRON_KEY) or
+                request.authenticated_userid):
+            return view(context, request)
+        key = page_key(request)
+        version = get_journal_state(request.dbsession)[0]
+        cached = cache.get(key, version)
+        if cached is not None:
+            status, headerlist, body = cached
+            response = Response(body=body, status=status,
+                                headerlist=list(headerlist))
+            response.headers['X-Cache'] = 'HIT'
+            if response.etag and response.etag in request.if_none_match:
+                return not_modified(response)
+            return response
+        response = view(context, request)
+        if response.status_int == 200 and 'Set-Cookie' not in response.headers:
+            cache.set(key, (response.status,
+                            list(response.headerlist),
+                            response.body), version)
+            response.headers['X-Cache'] = 'MISS'
+        return response
+    return wrapper
+
+
+# pages listing entries, or counting them in the archive calendar
+LISTING_ROUTES = ('home', 'archive_year', 'archive_month')
+
+
+def invalidate_entry(cache, entry_id, host_url):
+    """Drop the pages showing entry_id: its detail page and the listings.
+
+    The detail page is dropped as served under host_url; copies served
+    under other hosts miss on the journal version instead.
+    """
+    cache.delete(('detail', str(entry_id), '', host_url))
+    for name in LISTING_ROUTES:
+        cache.delete_namespace(name)
+
+
+def invalidate_on_change(event):
+    """Drop cached pages for a changed entry once its transaction commits."""
+    cache = event.request.registry.get('page_cache')
+    if cache is not None:
+        after_commit(event.request, invalidate_entry, cache, event.entry.id,
+                     event.request.host_url)
+
+
+def forget_entry_on_change(event):
+    """Drop a changed entry's record once its transaction commits."""
+    cache = event.request.registry.get('entry_cache')
+    if cache is not None:
+        after_commit(event.request, cache.delete, event.entry.id)
+
+
+def entry_cache_from_settings(settings):
+    """Build the entry cache described by the ``entry_cache.*`` settings."""
+    max_bytes = int(settings.get('entry_cache.max_bytes', 8 * 1024 * 1024))
+    if not max_bytes:
+        return None
+    return EntryCache(max_bytes, float(
+        settings.get('entry_cache.check_interval', 1)))
+
+
+def cache_from_settings(settings):
+    """Build the page cache described by the ``page_cache.*`` settings."""
+    backend = settings.get('page_cache.backend', 'memory')
+    max_entries = int(settings.get('page_cache.max_entries', 500))
+    ttl = int(settings.get('page_cache.ttl', 300))
+    if backend == 'memory':
+        return LRUCache(max_entries, ttl)
+    if backend == 'file':
+        directory = settings.get('page_cache.directory') or os.path.join(
+            tempfile.gettempdir(), 'learning_journal_pages')
+        return FileCache(directory, max_entries, ttl)
+    if backend == 'none':
+        return None
+    raise ValueError('unknown page_cache.backend: %r' % backend)
+
+
+def includeme(config):
+    """Set up the page, feed and entry caches.
+
+    Activate it using ``config.include('learning_journal.cache')``.
+    """
+    settings = config.get_settings()
+    cache = cache_from_settings(settings)
+    config.registry['page_cache'] = cache
+    config.registry['feed_cache'] = FeedCache()
+    if cache is not None:
+        config.add_subscriber(invalidate_on_change, EntryChanged)
+    entry_cache = entry_cache_from_settings(settings)
+    config.registry['entry_cache'] = entry_cache
+    if entry_cache is not None:
+        config.add_subscriber(forget_entry_on_change, EntryChanged)
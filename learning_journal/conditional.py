@@ -0,0 +1,68 @@
+"""Conditional GET support: ETag / Last-Modified validators and 304s.
+
+Validators are only attached to anonymous responses. Signed-in pages
+embed per-session details (edit links, CSRF tokens) that a shared
+validator cannot describe.
+"""
+from datetime import datetime
+
+from pyramid.httpexceptions import HTTPNotModified
+from webob.datetime_utils import UTC
+
+
+def as_http_date(value):
+    """Return a date or naive UTC datetime as an aware UTC datetime."""
+    if value is None:
+        return None
+    if not isinstance(value, datetime):
+        value = datetime(value.year, value.month, value.day)
+    return value.replace(microsecond=0, tzinfo=UTC)
+
+
+def is_conditional(request):
+    """Return True if the client sent a validator to check."""
+    return bool(request.headers.get('If-None-Match') or
+                request.headers.get('If-Modified-Since'))
+
+
+def is_fresh(request, etag, last_modified):
+    """Return True when the client's cached copy is still current.
+
+    ``If-None-Match`` takes precedence over ``If-Modified-Since``. A plain
+    ``date`` as last_modified only says which day the resource last
+    changed, so it only answers If-Modified-Since for later days.
+    """
+    if request.if_none_match:
+        return etag in request.if_none_match
+    since = request.if_modified_since
+    if since is None or last_modified is None:
+        return False
+    if not isinstance(last_modified, datetime):
+        return last_modified < since.date()
+    return as_http_date(last_modified) <= since
+
+
+def not_modified(response):
+    """Return a 304 carrying the validators of response."""
+    return HTTPNotModified(headers=[
+        (name, value) for name, value in response.headerlist
+        if name in ('ETag', 'Last-Modified', 'Vary', 'Cache-Control')
+    ])
+
+
+def conditional_response(request, etag, last_modified):
+    """Set validators on request.response and check the client's copy.
+
+    Returns an ``HTTPNotModified`` to send instead of rendering the page,
+    or None when the page should be rendered as usual.
+    """
+    if request.authenticated_userid:
+        return None
+    response = request.response
+    response.etag = etag
+    response.last_modified = as_http_date(last_modified)
+    response.vary = ('Cookie',)
+    response.cache_control = 'no-cache'
+    if is_conditional(request) and is_fresh(request, etag, last_modified):
+        return not_modified(response)
+    return None
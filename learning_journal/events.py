@@ -0,0 +1,35 @@
+"""Events sent by the journal's write paths."""
+
+
+class EntryChanged(object):
+    """Sent after a journal entry has been created or edited.
+
+    Subscribers run inside the request's transaction, so anything they
+    write with ``request.dbsession`` commits or aborts with the entry
+    itself. Work that must only happen once the change is visible to
+    other requests (like dropping cached pages) belongs in an after-commit
+    hook; see ``after_commit``.
+    """
+
+    def __init__(self, request, entry, created=False):
+        self.request = request
+        self.entry = entry
+        self.created = created
+
+
+def after_commit(request, callback, *args):
+    """Call ``callback(*args)`` once the request's transaction commits.
+
+    Outside of a pyramid_tm managed request (scripts, unit tests) the
+    callback runs immediately.
+    """
+    tm = getattr(request, 'tm', None)
+    if tm is None:
+        callback(*args)
+        return
+
+    def hook(success):
+        if success:
+            callback(*args)
+
+    tm.get().addAfterCommitHook(hook)
@@ -0,0 +1,190 @@
+"""Per-request timing: SQL, template rendering and total handler time.
+
+A tween opens a ``RequestTimings`` record for each request in a thread
+local (waitress runs one request per thread at a time). SQLAlchemy
+engine events add every statement's duration to it, a ``BeforeRender``
+subscriber and a view deriver time the Jinja2 render. When the request
+is done the tween sends the totals as a ``Server-Timing`` header and
+logs them as one JSON line on the ``learning_journal.timing`` logger.
+Requests slower than ``timing.slow_threshold_ms`` are logged as
+warnings along with their SQL statements, and every request is recorded
+in the registry's ``metrics``. Engines built on ``TimedQueuePool`` add
+the time spent checking out connections.
+"""
+import json
+import logging
+import threading
+import time
+
+from pyramid.events import BeforeRender
+from pyramid.settings import asbool
+from sqlalchemy import event
+from sqlalchemy.pool import QueuePool
+
+log = logging.getLogger('learning_journal.timing')
+
+# statements kept per request for the slow request log
+MAX_STATEMENTS = 50
+
+_local = threading.local()
+
+
+class RequestTimings(object):
+    """What one request spent its time on, in seconds."""
+
+    __slots__ = ('started', 'sql_count', 'sql_time', 'statements',
+                 'render_started', 'render_time', 'checkouts', 'pool_wait')
+
+    def __init__(self):
+        self.started = time.time()
+        self.sql_count = 0
+        self.sql_time = 0.0
+        self.statements = []
+        self.render_started = None
+        self.render_time = 0.0
+        self.checkouts = 0
+        self.pool_wait = 0.0
+
+    def add_statement(self, statement, elapsed):
+        self.sql_count += 1
+        self.sql_time += elapsed
+        if len(self.statements) < MAX_STATEMENTS:
+            self.statements.append((statement, elapsed))
+
+
+def current_timings():
+    """Return the timings of the request on this thread, or None."""
+    return getattr(_local, 'timings', None)
+
+
+class TimedQueuePool(QueuePool):
+    """QueuePool timing checkouts for the request on the thread.
+
+    The time includes waiting for a connection to be returned and
+    opening a new one.
+    """
+
+    def _do_get(self):
+        started = time.time()
+        try:
+            return super(TimedQueuePool, self)._do_get()
+        finally:
+            timings = current_timings()
+            if timings is not None:
+                timings.checkouts += 1
+                timings.pool_wait += time.time() - started
+
+
+def before_cursor_execute(conn, cursor, statement, parameters, context,
+                          executemany):
+    conn.info.setdefault('query_started', []).append(time.time())
+
+
+def after_cursor_execute(conn, cursor, statement, parameters, context,
+                         executemany):
+    started = conn.info['query_started'].pop()
+    timings = current_timings()
+    if timings is not None:
+        timings.add_statement(statement, time.time() - started)
+
+
+def instrument_engine(engine):
+    """Attribute the engine's statements to the current request."""
+    if not event.contains(engine, 'before_cursor_execute',
+                          before_cursor_execute):
+        event.listen(engine, 'before_cursor_execute', before_cursor_execute)
+        event.listen(engine, 'after_cursor_execute', after_cursor_execute)
+
+
+def render_started(event):
+    timings = current_timings()
+    if timings is not None:
+        timings.render_started = time.time()
+
+
+def timed_view(view, info):
+    """View deriver closing the render timer opened by BeforeRender.
+
+    It sits just outside ``rendered_view``, so the response it gets back
+    has just been rendered.
+    """
+    def wrapper(context, request):
+        response = view(context, request)
+        timings = current_timings()
+        if timings is not None and timings.render_started is not None:
+            timings.render_time += time.time() - timings.render_started
+            timings.render_started = None
+        return response
+    return wrapper
+
+
+def server_timing(timings, total):
+    """Format timings as a Server-Timing header value."""
+    return ('db;dur=%.2f;desc="%d queries", render;dur=%.2f, app;dur=%.2f'
+            % (timings.sql_time * 1000, timings.sql_count,
+               timings.render_time * 1000, total * 1000))
+
+
+def log_request(request, response, timings, total, slow):
+    """Log one request's timings, with its statements if it was slow."""
+    if total < slow and not log.isEnabledFor(logging.INFO):
+        return
+    record = {
+        'method': request.method,
+        'path': request.path,
+        'route': getattr(request.matched_route, 'name', None),
+        'status': response.status_int if response is not None else 500,
+        'total_ms': round(total * 1000, 2),
+        'db_ms': round(timings.sql_time * 1000, 2),
+        'db_queries': timings.sql_count,
+        'render_ms': round(timings.render_time * 1000, 2),
+    }
+    if total >= slow:
+        record['statements'] = [
+            {'sql': statement, 'ms': round(elapsed * 1000, 2)}
+            for statement, elapsed in timings.statements]
+        log.warning('slow request %s', json.dumps(record))
+    else:
+        log.info('request %s', json.dumps(record))
+
+
+def timing_tween_factory(handler, registry):
+    settings = registry.settings or {}
+    slow = float(settings.get('timing.slow_threshold_ms', 500)) / 1000
+    send_header = asbool(settings.get('timing.server_timing', True))
+    metrics = registry.get('metrics')
+
+    def timing_tween(request):
+        timings = _local.timings = RequestTimings()
+        response = None
+        try:
+            response = handler(request)
+        finally:
+            _local.timings = None
+            total = time.time() - timings.started
+            log_request(request, response, timings, total, slow)
+            if metrics is not None:
+                metrics.record_request(request, response, timings, total)
+        if send_header:
+            response.headers['Server-Timing'] = server_timing(timings, total)
+        return response
+
+    return timing_tween
+
+
+def includeme(config):
+    """Set up request instrumentation.
+
+    Activate it using ``config.include('learning_journal.instrumentation')``
+    after ``learning_journal.models``.
+    """
+    engines = [config.registry.get('dbengine')]
+    replicas = config.registry.get('dbreplicas')
+    if replicas is not None:
+        engines.extend(replicas.engines)
+    for engine in engines:
+        if engine is not None:
+            instrument_engine(engine)
+    config.add_subscriber(render_started, BeforeRender)
+    config.add_view_deriver(timed_view)
+    config.add_tween('learning_journal.instrumentation.timing_tween_factory')
@@ -0,0 +1,247 @@
+"""Keep password checks from using up the request threads.
+
+Checking a password is made slow on purpose, so a burst of POSTs to
+``/login`` could keep every waitress thread hashing while page views
+queue behind them. ``LoginGuard`` stops that in two ways:
+
+- Attempts are throttled per client address and per username by token
+  buckets. Each bucket holds a burst of attempts and refills at a steady
+  rate. The buckets live in memory, one set per process, or in a SQLite
+  file shared by the processes on a host.
+- Passwords are checked on a small pool of threads with a short queue.
+  An attempt that finds the queue full, or waits longer than the
+  timeout, is turned away instead of holding its request thread.
+
+Both raise ``LoginThrottled``, which the login view answers with 429.
+Keep ``login.workers`` plus ``login.queue_limit`` below waitress's thread
+count so some threads are always left for readers.
+"""
+import os
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
+
+from pyramid.settings import asbool
+
+# longest username kept as a bucket key
+MAX_KEY_LENGTH = 100
+
+
+class LoginThrottled(Exception):
+    """A login attempt turned away; retry_after is in seconds."""
+
+    def __init__(self, reason, retry_after):
+        super(LoginThrottled, self).__init__(reason, retry_after)
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+class TokenBuckets(object):
+    """Token buckets kept in this process, one per key.
+
+    Each holds up to burst tokens and gains per_minute of them a minute.
+    Full buckets say nothing a new bucket would not, so they are dropped
+    when there are more than max_keys.
+    """
+
+    # whether every process using these buckets sees the same ones
+    shared = False
+
+    def __init__(self, burst=10, per_minute=6.0, max_keys=10000):
+        self.burst = burst
+        self.rate = per_minute / 60.0
+        self.max_keys = max_keys
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+    def refill(self, tokens, updated, now):
+        return min(self.burst, tokens + (now - updated) * self.rate)
+
+    def take(self, key, now=None):
+        """Take a token for key; return 0, or the seconds until one is
+        available if the bucket is empty.
+        """
+        now = time.time() if now is None else now
+        with self._lock:
+            tokens, updated = self._buckets.get(key, (self.burst, now))
+            tokens = self.refill(tokens, updated, now)
+            if tokens < 1:
+                self._buckets[key] = (tokens, now)
+                return (1 - tokens) / self.rate
+            self._buckets[key] = (tokens - 1, now)
+            if len(self._buckets) > self.max_keys:
+                self.prune(now)
+        return 0
+
+    def prune(self, now):
+        self._buckets = dict(
+            (key, (tokens, updated))
+            for key, (tokens, updated) in self._buckets.items()
+            if self.refill(tokens, updated, now) < self.burst)
+        if len(self._buckets) > self.max_keys:
+            # under a flood of new keys, forget the oldest half
+            newest = sorted(self._buckets.items(),
+                            key=lambda item: item[1][1])
+            self._buckets = dict(newest[len(newest) // 2:])
+
+
+class SQLiteTokenBuckets(TokenBuckets):
+    """Token buckets in a SQLite file shared by every process using it.
+
+    name keeps the buckets of different TokenBuckets apart in the file.
+    """
+
+    shared = True
+    prune_every = 1000
+
+    def __init__(self, path, name, burst=10, per_minute=6.0):
+        super(SQLiteTokenBuckets, self).__init__(burst, per_minute)
+        directory = os.path.dirname(os.path.abspath(path))
+        if not os.path.isdir(directory):
+            try:
+                os.makedirs(directory)
+            except OSError:
+                pass  # another process created it first
+        self.path = path
+        self.name = name
+        self._local = threading.local()
+        self._takes = 0
+
+    def connection(self):
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            # autocommit, so that BEGIN IMMEDIATE below takes the lock
+            connection = sqlite3.connect(self.path, timeout=5,
+                                         isolation_level=None)
+            connection.execute(
+                'CREATE TABLE IF NOT EXISTS token_buckets ('
+                'key TEXT PRIMARY KEY, tokens REAL NOT NULL, '
+                'updated REAL NOT NULL)')
+            self._local.connection = connection
+        return connection
+
+    def take(self, key, now=None):
+        now = time.time() if now is None else now
+        key = '%s:%s' % (self.name, key)
+        connection = self.connection()
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            row = connection.execute(
+                'SELECT tokens, updated FROM token_buckets WHERE key = ?',
+                (key,)).fetchone()
+            tokens = self.refill(*row, now=now) if row else self.burst
+            wait = 0 if tokens >= 1 else (1 - tokens) / self.rate
+            if not wait:
+                tokens -= 1
+            connection.execute(
+                'INSERT OR REPLACE INTO token_buckets (key, tokens, updated) '
+                'VALUES (?, ?, ?)', (key, tokens, now))
+            self._takes += 1
+            if self._takes % self.prune_every == 0:
+                # rows idle long enough to have refilled are full again
+                connection.execute(
+                    'DELETE FROM token_buckets WHERE key LIKE ? '
+                    'AND updated < ?',
+                    (self.name + ':%', now - self.burst / self.rate))
+            connection.execute('COMMIT')
+        except Exception:
+            connection.execute('ROLLBACK')
+            raise
+        return wait
+
+
+class LoginGuard(object):
+    """Throttle login attempts and check passwords on a bounded pool.
+
+    check is the function that verifies (username, password).
+    """
+
+    def __init__(self, check, client_buckets, user_buckets, workers=1,
+                 queue_limit=2, timeout=3.0):
+        self.check = check
+        self.client_buckets = client_buckets
+        self.user_buckets = user_buckets
+        self.workers = workers
+        self.queue_limit = queue_limit
+        self.timeout = timeout
+        self.reset()
+
+    @property
+    def shared(self):
+        """Whether every process using the guard shares its buckets."""
+        return self.client_buckets.shared and self.user_buckets.shared
+
+    def reset(self):
+        """Start without threads, as a forked child must."""
+        self._executor = None
+        self._slots = threading.BoundedSemaphore(
+            self.workers + self.queue_limit)
+        self._lock = threading.Lock()
+
+    def executor(self):
+        if self._executor is None:
+            with self._lock:
+                if self._executor is None:
+                    self._executor = ThreadPoolExecutor(self.workers)
+        return self._executor
+
+    def verify(self, client, username, password):
+        """Return whether the credentials are right.
+
+        Raises LoginThrottled when the client or the username has run out
+        of attempts, or when the password checks are backed up.
+        """
+        wait = self.client_buckets.take(client or 'unknown')
+        if wait:
+            raise LoginThrottled('too many attempts from %s' % client, wait)
+        user = (username or '').strip().lower()[:MAX_KEY_LENGTH]
+        wait = self.user_buckets.take(user)
+        if wait:
+            raise LoginThrottled('too many attempts for %s' % user, wait)
+        if not self._slots.acquire(False):
+            raise LoginThrottled('password checks are backed up',
+                                 self.timeout)
+        try:
+            future = self.executor().submit(self.check, username, password)
+        except Exception:
+            self._slots.release()
+            raise
+        slots = self._slots
+        future.add_done_callback(lambda future: slots.release())
+        try:
+            return future.result(self.timeout)
+        except TimeoutError:
+            # the check finishes on its own and frees its slot
+            raise LoginThrottled('password checks are backed up',
+                                 self.timeout)
+
+
+def buckets_from_settings(settings, name, burst, per_minute):
+    burst = int(settings.get('login.%s_burst' % name, burst))
+    per_minute = float(settings.get('login.%s_per_minute' % name,
+                                    per_minute))
+    backend = settings.get('login.throttle_backend', 'memory')
+    if backend == 'sqlite':
+        return SQLiteTokenBuckets(settings['login.throttle_path'], name,
+                                  burst, per_minute)
+    if backend != 'memory':
+        raise ValueError('unknown login.throttle_backend %r' % backend)
+    return TokenBuckets(burst, per_minute)
+
+
+def login_guard_from_settings(settings, check):
+    """Create the LoginGuard the ``login.*`` settings describe, or None."""
+    if not asbool(settings.get('login.guard', True)):
+        return None
+    guard = LoginGuard(
+        check,
+        buckets_from_settings(settings, 'client', 10, 6),
+        buckets_from_settings(settings, 'user', 20, 10),
+        workers=int(settings.get('login.workers', 1)),
+        queue_limit=int(settings.get('login.queue_limit', 2)),
+        timeout=float(settings.get('login.timeout', 3)))
+    if hasattr(os, 'register_at_fork'):
+        # the pool's threads do not survive a fork
+        os.register_at_fork(after_in_child=guard.reset)
+    return guard
@@ -0,0 +1,374 @@
+"""Prometheus metrics, served as text at ``/metrics``.
+
+Counters and histograms are updated without taking a lock: each thread
+adds to its own shard, a pair of dicts only that thread writes, and a
+scrape sums the shards. The timing tween in ``instrumentation`` records
+every request (route, status, latency, SQL, pool wait and render time),
+the login view counts attempts, and collectors read the connection pools
+and caches when a scrape asks for them.
+
+With ``metrics.directory`` set (or ``METRICS_DIR``), every process writes
+its totals to a file of its own in that directory, at most every
+``metrics.flush_interval`` seconds and when it exits, and a scrape of any
+process adds up all the files. Counters of processes that have exited
+are kept, as Prometheus expects; their gauges are dropped once their
+file is older than ``metrics.stale_after`` seconds. Empty the directory
+when deploying.
+"""
+import atexit
+import bisect
+import json
+import os
+import tempfile
+import threading
+import time
+
+from pyramid.settings import asbool
+
+from .models import pool_status
+
+# upper bounds, in seconds, of the histogram buckets
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# request methods counted under their own name; any other is "other", so
+# clients cannot add label values
+HTTP_METHODS = frozenset(('GET', 'HEAD', 'POST', 'PUT', 'DELETE', 'PATCH',
+                          'OPTIONS', 'CONNECT', 'TRACE'))
+
+# name: (type, help); only these are exported
+METRICS = {
+    'lj_http_requests_total': (
+        'counter', 'Requests handled, by route, method and status.'),
+    'lj_http_request_duration_seconds': (
+        'histogram', 'Time taken to handle requests, by route.'),
+    'lj_db_queries_total': (
+        'counter', 'SQL statements run by requests, by route.'),
+    'lj_db_query_seconds_total': (
+        'counter', 'Time requests spent running SQL, by route.'),
+    'lj_db_pool_wait_seconds': (
+        'histogram', 'Time requests spent checking connections out of '
+                     'the pool.'),
+    'lj_db_pool_connections': (
+        'gauge', 'Connections of each pool, by engine and state.'),
+    'lj_template_render_seconds': (
+        'histogram', 'Time requests spent rendering templates, by route.'),
+    'lj_logins_total': (
+        'counter', 'Login attempts, by result.'),
+    'lj_cache_lookups_total': (
+        'counter', 'Cache lookups, by cache and result.'),
+    'lj_cache_hit_ratio': (
+        'gauge', 'Share of cache lookups that were hits, by cache.'),
+    'lj_requests_in_flight': (
+        'gauge', 'Requests in progress.'),
+    'lj_request_queue_wait_seconds': (
+        'histogram', 'Time requests queued before a thread took them.'),
+    'lj_shed_requests_total': (
+        'counter', 'Requests turned away with a 503, by class and reason.'),
+}
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+class Metrics(object):
+    """This process's counters, histograms and gauge collectors.
+
+    Labels are tuples of (name, value) pairs. Collectors are callables
+    returning [(name, labels, value), ...] for counters and gauges whose
+    values are kept elsewhere, such as the caches' hit counts.
+    """
+
+    def __init__(self, directory=None, flush_interval=10.0,
+                 stale_after=60.0):
+        self.directory = directory
+        self.flush_interval = flush_interval
+        self.stale_after = stale_after
+        self.collectors = []
+        self.flushed_at = 0
+        self.started = time.time()
+        self._local = threading.local()
+        self._shards = []
+        self._lock = threading.Lock()
+
+    def _shard(self):
+        try:
+            return self._local.shard
+        except AttributeError:
+            shard = self._local.shard = ({}, {})
+            with self._lock:
+                self._shards.append(shard)
+            return shard
+
+    def inc(self, name, labels=(), amount=1):
+        counters = self._shard()[0]
+        key = (name, labels)
+        counters[key] = counters.get(key, 0) + amount
+
+    def observe(self, name, value, labels=()):
+        histograms = self._shard()[1]
+        key = (name, labels)
+        counts = histograms.get(key)
+        if counts is None:
+            # a count per bucket, then +Inf, then the sum
+            counts = histograms[key] = [0] * (len(BUCKETS) + 1) + [0.0]
+        counts[bisect.bisect_left(BUCKETS, value)] += 1
+        counts[-1] += value
+
+    def record_request(self, request, response, timings, total):
+        """Record one request, from the timing tween's RequestTimings."""
+        route = getattr(request.matched_route, 'name', None) or 'none'
+        status = response.status_int if response is not None else 500
+        labels = (('route', route),)
+        method = request.method if request.method in HTTP_METHODS else 'other'
+        self.inc('lj_http_requests_total', (
+            ('method', method), ('route', route),
+            ('status', str(status))))
+        self.observe('lj_http_request_duration_seconds', total, labels)
+        if timings.sql_count:
+            self.inc('lj_db_queries_total', labels, timings.sql_count)
+            self.inc('lj_db_query_seconds_total', labels, timings.sql_time)
+        if timings.checkouts:
+            self.observe('lj_db_pool_wait_seconds', timings.pool_wait)
+        if timings.render_time:
+            self.observe('lj_template_render_seconds', timings.render_time,
+                         labels)
+        self.maybe_flush()
+
+    def reset(self):
+        """Forget everything counted, as a forked child must."""
+        with self._lock:
+            self._shards = []
+            self._local = threading.local()
+        self.started = time.time()
+        self.flushed_at = 0
+
+    def snapshot(self):
+        """Return this process's totals as {'counters', 'histograms',
+        'gauges'}, each a dict keyed by (name, labels).
+        """
+        counters = {}
+        histograms = {}
+        with self._lock:
+            shards = list(self._shards)
+        for shard_counters, shard_histograms in shards:
+            # dict.copy and list() are atomic, unlike iterating a dict
+            # its owner may be adding to
+            for key, value in shard_counters.copy().items():
+                counters[key] = counters.get(key, 0) + value
+            for key, counts in shard_histograms.copy().items():
+                add_counts(histograms, key, list(counts))
+        gauges = {}
+        for collector in self.collectors:
+            for name, labels, value in collector():
+                if METRICS[name][0] == 'gauge':
+                    gauges[(name, labels)] = value
+                else:
+                    counters[(name, labels)] = (
+                        counters.get((name, labels), 0) + value)
+        return {'counters': counters, 'histograms': histograms,
+                'gauges': gauges}
+
+    def filename(self):
+        # the start time tells a reused pid from the process before it
+        return os.path.join(self.directory, 'metrics-%d-%d.json' % (
+            os.getpid(), int(self.started * 1000)))
+
+    def flush(self):
+        """Write this process's totals to its file in the directory."""
+        if not self.directory:
+            return
+        self.flushed_at = time.time()
+        data = self.snapshot()
+        data = {
+            'written': self.flushed_at,
+            'counters': [[name, labels, value] for (name, labels), value
+                         in data['counters'].items()],
+            'histograms': [[name, labels, counts] for (name, labels), counts
+                           in data['histograms'].items()],
+            'gauges': [[name, labels, value] for (name, labels), value
+                       in data['gauges'].items()],
+        }
+        fd, tmp = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        with os.fdopen(fd, 'w') as f:
+            json.dump(data, f)
+        os.rename(tmp, self.filename())
+
+    def maybe_flush(self):
+        """Flush when the last flush is flush_interval seconds old."""
+        if (self.directory and
+                time.time() - self.flushed_at >= self.flush_interval):
+            self.flush()
+
+    def collect(self):
+        """Return the totals of every process, or of this one alone."""
+        if not self.directory:
+            return self.snapshot()
+        self.flush()
+        counters = {}
+        histograms = {}
+        gauges = {}
+        now = time.time()
+        for name in os.listdir(self.directory):
+            if not (name.startswith('metrics-') and name.endswith('.json')):
+                continue
+            try:
+                with open(os.path.join(self.directory, name)) as f:
+                    data = json.load(f)
+            except (IOError, OSError, ValueError):
+                continue  # removed or being replaced
+            for metric, labels, value in data['counters']:
+                key = (metric, labels_key(labels))
+                counters[key] = counters.get(key, 0) + value
+            for metric, labels, counts in data['histograms']:
+                add_counts(histograms, (metric, labels_key(labels)), counts)
+            if now - data['written'] <= self.stale_after:
+                for metric, labels, value in data['gauges']:
+                    key = (metric, labels_key(labels))
+                    gauges[key] = gauges.get(key, 0) + value
+        return {'counters': counters, 'histograms': histograms,
+                'gauges': gauges}
+
+
+def labels_key(labels):
+    """Turn labels read back from JSON into a tuple of pairs."""
+    return tuple((name, value) for name, value in labels)
+
+
+def add_counts(histograms, key, counts):
+    total = histograms.get(key)
+    if total is None:
+        histograms[key] = counts
+    else:
+        for i, value in enumerate(counts):
+            total[i] += value
+
+
+def cache_hit_ratios(counters):
+    """Return lj_cache_hit_ratio gauges worked out from the lookups."""
+    lookups = {}
+    for (name, labels), value in counters.items():
+        if name == 'lj_cache_lookups_total':
+            labels = dict(labels)
+            hits, total = lookups.get(labels['cache'], (0, 0))
+            if labels['result'] == 'hit':
+                hits += value
+            lookups[labels['cache']] = (hits, total + value)
+    return dict(
+        (('lj_cache_hit_ratio', (('cache', cache),)),
+         float(hits) / total if total else 0.0)
+        for cache, (hits, total) in lookups.items())
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    return '{%s}' % ','.join(
+        '%s="%s"' % (name, str(value).replace('\\', r'\\')
+                     .replace('"', r'\"').replace('\n', r'\n'))
+        for name, value in labels)
+
+
+def format_value(value):
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
+
+
+def exposition(totals):
+    """Format totals from ``Metrics.collect`` in the text format."""
+    samples = {}
+    for kind in ('counters', 'gauges'):
+        for (name, labels), value in totals[kind].items():
+            samples.setdefault(name, []).append(
+                (name, labels, value))
+    for (name, labels), value in cache_hit_ratios(
+            totals['counters']).items():
+        samples.setdefault(name, []).append((name, labels, value))
+    for (name, labels), counts in totals['histograms'].items():
+        cumulative = 0
+        lines = samples.setdefault(name, [])
+        for bound, count in zip(BUCKETS + ('+Inf',), counts):
+            cumulative += count
+            le = bound if bound == '+Inf' else repr(bound)
+            lines.append((name + '_bucket', labels + (('le', le),),
+                          cumulative))
+        lines.append((name + '_sum', labels, counts[-1]))
+        lines.append((name + '_count', labels, cumulative))
+    lines = []
+    for name in sorted(samples):
+        kind, help_text = METRICS[name]
+        lines.append('# HELP %s %s' % (name, help_text))
+        lines.append('# TYPE %s %s' % (name, kind))
+        for sample, labels, value in sorted(samples[name],
+                                            key=lambda s: (s[1], s[0])):
+            lines.append('%s%s %s' % (sample, format_labels(labels),
+                                      format_value(value)))
+    return '\n'.join(lines) + '\n'
+
+
+def count(request, name, labels=(), amount=1):
+    """Add amount to a counter, if metrics are enabled."""
+    metrics = request.registry.get('metrics')
+    if metrics is not None:
+        metrics.inc(name, labels, amount)
+
+
+def registry_collector(registry):
+    """Return a collector of the pools and caches in registry."""
+    def collect():
+        samples = []
+        engines = [('primary', registry.get('dbengine'))]
+        replicas = registry.get('dbreplicas')
+        if replicas is not None:
+            engines.extend(('replica%d' % i, engine)
+                           for i, engine in enumerate(replicas.engines))
+        for label, engine in engines:
+            if engine is None:
+                continue
+            status = pool_status(engine)
+            for state in ('checked_out', 'checked_in', 'overflow'):
+                if state in status:
+                    samples.append(('lj_db_pool_connections', (
+                        ('engine', label), ('state', state)),
+                        status[state]))
+        shedder = registry.get('load_shedder')
+        if shedder is not None:
+            samples.append(('lj_requests_in_flight', (), shedder.in_flight))
+        for name in ('page_cache', 'entry_cache'):
+            cache = registry.get(name)
+            if cache is not None:
+                for result, value in (('hit', cache.hits),
+                                      ('miss', cache.misses)):
+                    samples.append(('lj_cache_lookups_total', (
+                        ('cache', name), ('result', result)), value))
+        return samples
+    return collect
+
+
+def metrics_from_settings(settings):
+    """Create the Metrics the ``metrics.*`` settings describe, or None."""
+    if not asbool(settings.get('metrics.enabled', True)):
+        return None
+    directory = settings.get('metrics.directory') or None
+    if directory and not os.path.isdir(directory):
+        os.makedirs(directory)
+    return Metrics(
+        directory=directory,
+        flush_interval=float(settings.get('metrics.flush_interval', 10)),
+        stale_after=float(settings.get('metrics.stale_after', 60)))
+
+
+def includeme(config):
+    """Set up metrics collection for the ``/metrics`` view.
+
+    Activate it using ``config.include('learning_journal.metrics')``.
+    """
+    metrics = metrics_from_settings(config.get_settings())
+    config.registry['metrics'] = metrics
+    if metrics is None:
+        return
+    metrics.collectors.append(registry_collector(config.registry))
+    if metrics.directory:
+        atexit.register(metrics.flush)
+    if hasattr(os, 'register_at_fork'):
+        # a forked worker counts its own requests, not its parent's
+        os.register_at_fork(after_in_child=metrics.reset)
@@ -0,0 +1,58 @@
+"""Run the Alembic migrations in ``learning_journal/alembic``.
+
+``upgrade`` brings a database to the latest schema without losing data:
+a new database is built from scratch, and one created by
+``metadata.create_all`` before migrations existed is first stamped with
+the revision its tables match, ``BASELINE`` for the first release and
+``JOURNAL_STATE`` once entries had versions.
+"""
+from alembic import command
+from alembic.config import Config
+from alembic.runtime.migration import MigrationContext
+from sqlalchemy import inspect
+
+SCRIPT_LOCATION = 'learning_journal:alembic'
+# the schema of the first release: the entries table alone
+BASELINE = '1f6a0c93d8b2'
+# entries with versions and the journal_state table, as create_all built
+# them until migrations were introduced
+JOURNAL_STATE = '3c1d2b6f0a8e'
+
+
+def include_object(obj, name, type_, reflected, compare_to):
+    """Leave the search index's tables out of autogenerate comparisons."""
+    return not (type_ == 'table' and name.startswith('models_fts'))
+
+
+def alembic_config(connection=None):
+    """Return an Alembic Config that migrates connection."""
+    config = Config()
+    config.set_main_option('script_location', SCRIPT_LOCATION)
+    config.attributes['connection'] = connection
+    return config
+
+
+def current_revision(connection):
+    return MigrationContext.configure(connection).get_current_revision()
+
+
+def legacy_revision(connection):
+    """Return the revision an unversioned database's tables match, if any."""
+    inspector = inspect(connection)
+    tables = inspector.get_table_names()
+    if 'models' not in tables:
+        return None
+    columns = [column['name'] for column in inspector.get_columns('models')]
+    if 'version' in columns and 'journal_state' in tables:
+        return JOURNAL_STATE
+    return BASELINE
+
+
+def upgrade(connection, revision='head'):
+    """Migrate the database on connection to revision."""
+    config = alembic_config(connection)
+    if current_revision(connection) is None:
+        legacy = legacy_revision(connection)
+        if legacy is not None:
+            command.stamp(config, legacy)
+    command.upgrade(config, revision)
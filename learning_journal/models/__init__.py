@@ -1,19 +1,170 @@
-from sqlalchemy import engine_from_config
+import logging
+import os
+
+from pyramid.settings import asbool
+from sqlalchemy import engine_from_config, event
+from sqlalchemy.engine.url import make_url
 from sqlalchemy.orm import sessionmaker
 from sqlalchemy.orm import configure_mappers
 import zope.sqlalchemy
 
+from ..events import EntryChanged
+from ..instrumentation import TimedQueuePool
+
 # import or define all models here to ensure they are attached to the
 # Base.metadata prior to any initialization routines
-from .entrymodel import Entry  # noqa
+from .entrymodel import Entry, iter_entries  # noqa
+from .journalmodel import JournalState, journal_changed  # noqa
+from .archivemodel import ArchiveMonth, archive_changed  # noqa
+from . import rendering, search  # noqa
+from .replicas import (
+    choose_session_factory,
+    mark_written,
+    replica_set_from_settings,
+    stick_to_primary,
+)
 
 # run configure_mappers after defining all of the models to ensure
 # all relationships can be setup
 configure_mappers()
 
 
+log = logging.getLogger(__name__)
+
+# environment variables that override ini settings, for Heroku style
+# deployments that configure the app through its environment
+ENVIRON_SETTINGS = {
+    'DATABASE_URL': 'sqlalchemy.url',
+    'DATABASE_REPLICA_URLS': 'replicas.urls',
+    'DB_POOL_SIZE': 'sqlalchemy.pool_size',
+    'DB_MAX_OVERFLOW': 'sqlalchemy.max_overflow',
+    'DB_POOL_TIMEOUT': 'sqlalchemy.pool_timeout',
+    'DB_POOL_RECYCLE': 'sqlalchemy.pool_recycle',
+    'DB_POOL_PRE_PING': 'sqlalchemy.pool_pre_ping',
+    'DB_STATEMENT_TIMEOUT': 'sqlalchemy.statement_timeout',
+    'DB_SQLITE_BUSY_TIMEOUT': 'sqlalchemy.sqlite_busy_timeout',
+    'METRICS_DIR': 'metrics.directory',
+}
+
+# engine options of ours, read by get_engine rather than SQLAlchemy
+ENGINE_OPTIONS = ('statement_timeout', 'sqlite_wal', 'sqlite_busy_timeout',
+                  'keepalives_idle', 'keepalives_interval', 'keepalives_count')
+
+# pool arguments the SQLite pools do not accept
+QUEUE_POOL_OPTIONS = ('pool_size', 'max_overflow', 'pool_timeout')
+
+
+def settings_from_environ(settings, environ=os.environ):
+    """Return a copy of settings with environment overrides applied."""
+    settings = dict(settings)
+    for name, key in ENVIRON_SETTINGS.items():
+        if environ.get(name):
+            settings[key] = environ[name]
+    return settings
+
+
 def get_engine(settings, prefix='sqlalchemy.'):
-    return engine_from_config(settings, prefix)
+    """Create the engine described by the ``<prefix>*`` settings.
+
+    On top of SQLAlchemy's own options (``pool_size``, ``max_overflow``,
+    ``pool_timeout``, ``pool_recycle``, ``pool_pre_ping``, ...) this reads:
+
+    - ``statement_timeout``: milliseconds, PostgreSQL only.
+    - ``keepalives_idle``/``keepalives_interval``/``keepalives_count``:
+      TCP keepalives for psycopg2 connections.
+    - ``sqlite_wal``: put SQLite databases in WAL mode (default true).
+    - ``sqlite_busy_timeout``: milliseconds SQLite waits for a lock
+      (default 5000).
+    """
+    options = dict((key[len(prefix):], value)
+                   for key, value in settings.items()
+                   if key.startswith(prefix))
+    ours = dict((name, options.pop(name)) for name in ENGINE_OPTIONS
+                if name in options)
+    url = make_url(options['url'])
+    kwargs = {}
+    if url.get_backend_name() == 'sqlite':
+        for name in QUEUE_POOL_OPTIONS:
+            options.pop(name, None)
+    else:
+        # a QueuePool that reports how long requests wait for connections
+        kwargs['poolclass'] = TimedQueuePool
+    if url.get_backend_name() == 'postgresql':
+        connect_args = {}
+        if ours.get('statement_timeout'):
+            connect_args['options'] = '-c statement_timeout=%d' % int(
+                ours['statement_timeout'])
+        if url.get_driver_name() == 'psycopg2':
+            connect_args['keepalives'] = 1
+            for name in ('keepalives_idle', 'keepalives_interval',
+                         'keepalives_count'):
+                if ours.get(name):
+                    connect_args[name] = int(ours[name])
+        kwargs['connect_args'] = connect_args
+    engine = engine_from_config(options, prefix='', **kwargs)
+    if engine.dialect.name == 'sqlite':
+        listen_sqlite_pragmas(
+            engine,
+            wal=asbool(ours.get('sqlite_wal', True)),
+            busy_timeout=int(ours.get('sqlite_busy_timeout', 5000)))
+    warn_when_exhausted(engine)
+    return engine
+
+
+def listen_sqlite_pragmas(engine, wal=True, busy_timeout=5000):
+    """Configure every new SQLite connection of engine."""
+    in_memory = engine.url.database in (None, '', ':memory:')
+
+    def on_connect(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        cursor.execute('PRAGMA busy_timeout = %d' % busy_timeout)
+        if wal and not in_memory:
+            cursor.execute('PRAGMA journal_mode = WAL')
+        cursor.close()
+
+    event.listen(engine, 'connect', on_connect)
+
+
+def pool_status(engine):
+    """Return the occupancy of engine's connection pool."""
+    pool = engine.pool
+    status = {'class': type(pool).__name__}
+    if hasattr(pool, 'checkedout'):
+        status.update(size=pool.size(),
+                      max_overflow=getattr(pool, '_max_overflow', 0),
+                      checked_in=pool.checkedin(),
+                      checked_out=pool.checkedout(),
+                      overflow=pool.overflow())
+    return status
+
+
+def dispose_engines(registry):
+    """Close the pooled connections of the app's primary and replicas.
+
+    A process forked after the app was built calls this so that it opens
+    connections of its own instead of sharing its parent's.
+    """
+    engines = [registry.get('dbengine')]
+    replicas = registry.get('dbreplicas')
+    if replicas is not None:
+        engines.extend(replicas.engines)
+    for engine in engines:
+        if engine is not None:
+            engine.dispose()
+
+
+def warn_when_exhausted(engine):
+    """Log whenever a checkout takes the last connection the pool allows."""
+    pool = engine.pool
+    max_overflow = getattr(pool, '_max_overflow', -1)
+    if not hasattr(pool, 'checkedout') or max_overflow < 0:
+        return
+
+    def on_checkout(dbapi_connection, connection_record, connection_proxy):
+        if pool.checkedout() >= pool.size() + max_overflow:
+            log.warning('connection pool exhausted: %s', pool.status())
+
+    event.listen(pool, 'checkout', on_checkout)
 
 
 def get_session_factory(engine):
@@ -49,6 +200,16 @@ def get_tm_session(session_factory, transaction_manager):
     return dbsession
 
 
+def request_dbsession(request):
+    """Return the session for request, on a read replica when possible."""
+    session_factory = choose_session_factory(request)
+    # r.tm is the transaction manager used by pyramid_tm
+    dbsession = get_tm_session(session_factory, request.tm)
+    if session_factory is request.registry['dbsession_factory']:
+        stick_to_primary(request, dbsession)
+    return dbsession
+
+
 def includeme(config):
     """
     Initialize the model for a Pyramid app.
@@ -61,13 +222,16 @@ def includeme(config):
     # use pyramid_tm to hook the transaction lifecycle to the request
     config.include('pyramid_tm')
 
-    session_factory = get_session_factory(get_engine(settings))
+    engine = get_engine(settings)
+    session_factory = get_session_factory(engine)
+    event.listen(session_factory, 'after_flush', mark_written)
+    config.registry['dbengine'] = engine
     config.registry['dbsession_factory'] = session_factory
+    config.registry['dbreplicas'] = replica_set_from_settings(
+        settings, get_engine, get_session_factory)
 
     # make request.dbsession available for use in Pyramid
-    config.add_request_method(
-        # r.tm is the transaction manager used by pyramid_tm
-        lambda r: get_tm_session(session_factory, r.tm),
-        'dbsession',
-        reify=True
-    )
+    config.add_request_method(request_dbsession, 'dbsession', reify=True)
+
+    config.add_subscriber(journal_changed, EntryChanged)
+    config.add_subscriber(archive_changed, EntryChanged)
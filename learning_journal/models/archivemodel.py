@@ -0,0 +1,76 @@
+from itertools import groupby
+
+from sqlalchemy import (
+    Column,
+    Integer,
+    cast,
+    extract,
+    func,
+    select,
+    text,
+)
+
+from .entrymodel import Entry
+from .meta import Base
+
+# SQLite (3.24+) and PostgreSQL share this upsert syntax
+COUNT_ENTRY = """\
+INSERT INTO archive_months (year, month, entries)
+VALUES (:year, :month, :delta)
+ON CONFLICT (year, month) DO UPDATE SET
+    entries = archive_months.entries + excluded.entries"""
+
+
+class ArchiveMonth(Base):
+    """The number of entries created in one month.
+
+    Archive pages and the calendar read these counts instead of grouping
+    the entries table on every view. New entries add to their month in
+    the transaction that creates them; ``rebuild_archive`` recounts
+    everything after bulk loads.
+    """
+    __tablename__ = 'archive_months'
+    year = Column(Integer, primary_key=True, autoincrement=False)
+    month = Column(Integer, primary_key=True, autoincrement=False)
+    entries = Column(Integer, nullable=False, default=0)
+
+
+def count_entry(dbsession, day, delta=1):
+    """Add delta to the count of day's month."""
+    dbsession.execute(text(COUNT_ENTRY), {
+        'year': day.year, 'month': day.month, 'delta': delta})
+
+
+def rebuild_archive(bind):
+    """Recount every month from the entries table; return the months."""
+    table = ArchiveMonth.__table__
+    entries = Entry.__table__
+    year = cast(extract('year', entries.c.creation_date), Integer)
+    month = cast(extract('month', entries.c.creation_date), Integer)
+    bind.execute(table.delete())
+    bind.execute(table.insert().from_select(
+        ['year', 'month', 'entries'],
+        select([year, month, func.count()]).group_by(year, month)))
+    return bind.execute(select([func.count()]).select_from(table)).scalar()
+
+
+def get_archive(dbsession, year=None):
+    """Return [(year, [(month, entries), ...]), ...], newest first."""
+    query = dbsession.query(
+        ArchiveMonth.year, ArchiveMonth.month, ArchiveMonth.entries
+    ).filter(ArchiveMonth.entries > 0).order_by(
+        ArchiveMonth.year.desc(), ArchiveMonth.month.desc())
+    if year is not None:
+        query = query.filter(ArchiveMonth.year == year)
+    return [(key, [(row.month, row.entries) for row in rows])
+            for key, rows in groupby(query, lambda row: row.year)]
+
+
+def archive_changed(event):
+    """Count a new entry in its month's archive total.
+
+    Edits keep an entry's creation date, so only new entries change the
+    counts.
+    """
+    if event.created:
+        count_entry(event.request.dbsession, event.entry.creation_date)
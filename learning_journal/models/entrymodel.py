@@ -1,9 +1,12 @@
+from collections import namedtuple
+
 from sqlalchemy import (
     Column,
     Index,
     Integer,
     Unicode,
-    Date
+    Date,
+    select,
 )
 
 from .meta import Base
@@ -12,10 +15,61 @@ from .meta import Base
 class Entry(Base):
     __tablename__ = 'models'
     id = Column(Integer, primary_key=True)
-    title = Column(Unicode)
-    body = Column(Unicode)
-    creation_date = Column(Date)
+    title = Column(Unicode, nullable=False)
+    body = Column(Unicode, nullable=False)
+    creation_date = Column(Date, nullable=False)
     edit_date = Column(Date)
+    # bumped by the ORM on every UPDATE; used for ETags
+    version = Column(Integer, nullable=False, default=1)
+    # rendered from body on write; see models/rendering.py
+    body_html = Column(Unicode)
+    excerpt = Column(Unicode)
+    word_count = Column(Integer)
+    render_version = Column(Integer, nullable=False, default=0,
+                            server_default='0')
+
+    __mapper_args__ = {'version_id_col': version}
 
 
 Index('my_index', Entry.title, unique=True, mysql_length=255)
+# newest-first listings and date-range archives
+Index('ix_models_creation_date', Entry.creation_date, Entry.id)
+# entries edited since a given day
+Index('ix_models_edit_date', Entry.edit_date)
+
+FIELDS = ('id', 'title', 'body', 'creation_date', 'edit_date')
+
+# what the detail and edit pages show of an entry, without the overhead
+# of an ORM object
+EntryRecord = namedtuple('EntryRecord', (
+    'id', 'title', 'body', 'body_html', 'creation_date', 'edit_date',
+    'version'))
+
+
+def get_entry_record(dbsession, entry_id):
+    """Return the EntryRecord of entry_id, or None if there is none."""
+    row = dbsession.query(
+        *[getattr(Entry, name) for name in EntryRecord._fields]
+    ).filter(Entry.id == entry_id).first()
+    return EntryRecord(*row) if row else None
+
+
+def iter_entries(connection, batch_size=1000, fields=FIELDS):
+    """Yield entry rows in id order through a server-side cursor.
+
+    Only batch_size rows are held in memory at a time, whatever the size
+    of the journal.
+    """
+    table = Entry.__table__
+    query = select([table.c[name] for name in fields]).order_by(table.c.id)
+    result = connection.execution_options(
+        stream_results=True).execute(query)
+    try:
+        while True:
+            rows = result.fetchmany(batch_size)
+            if not rows:
+                break
+            for row in rows:
+                yield row
+    finally:
+        result.close()
@@ -0,0 +1,50 @@
+from datetime import datetime
+
+from sqlalchemy import (
+    Column,
+    DateTime,
+    Integer,
+)
+
+from .meta import Base
+
+JOURNAL_STATE_ID = 1
+
+
+class JournalState(Base):
+    """The single row recording when the journal last changed.
+
+    ``version`` goes up by one every time entries are created or edited
+    and ``modified`` records when (in UTC). Pages built from many entries
+    use the pair as a cheap cache validator.
+    """
+    __tablename__ = 'journal_state'
+    id = Column(Integer, primary_key=True)
+    version = Column(Integer, nullable=False, default=0)
+    modified = Column(DateTime, nullable=False, default=datetime.utcnow)
+
+
+def get_journal_state(dbsession):
+    """Return the journal's (version, modified), or (0, None) if new."""
+    row = dbsession.query(
+        JournalState.version, JournalState.modified
+    ).filter(JournalState.id == JOURNAL_STATE_ID).first()
+    return (row.version, row.modified) if row else (0, None)
+
+
+def bump_journal_version(dbsession):
+    """Record a change to the journal in the current transaction."""
+    now = datetime.utcnow()
+    updated = dbsession.query(JournalState).filter(
+        JournalState.id == JOURNAL_STATE_ID
+    ).update({JournalState.version: JournalState.version + 1,
+              JournalState.modified: now}, synchronize_session=False)
+    if not updated:
+        dbsession.add(JournalState(id=JOURNAL_STATE_ID, version=1,
+                                   modified=now))
+        dbsession.flush()
+
+
+def journal_changed(event):
+    """Bump the journal version whenever an entry changes."""
+    bump_journal_version(event.request.dbsession)
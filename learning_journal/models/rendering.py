@@ -0,0 +1,107 @@
+"""Markdown bodies rendered once, on write.
+
+Every entry stores the sanitized HTML of its Markdown body next to the
+source, with a plain text excerpt and word count for listings, so pages
+never parse Markdown on the read path. Mapper events render an entry
+whenever the ORM inserts it or changes its body; bulk loads call
+``rendered_fields`` for each row themselves.
+
+``render_version`` records which renderer produced a row. Bump
+``RENDER_VERSION`` whenever the output of ``render_body`` changes, then
+run ``render_entries`` to re-render the rows written by older versions.
+"""
+import threading
+
+from markupsafe import Markup
+from sqlalchemy import event, inspect
+
+from .entrymodel import Entry
+
+# bump when render_body's output changes; rows stamped with an older
+# version are re-rendered by render_entries
+RENDER_VERSION = 1
+
+EXCERPT_WORDS = 40
+
+MARKDOWN_EXTENSIONS = ['fenced_code', 'sane_lists', 'tables']
+
+ALLOWED_TAGS = frozenset([
+    'a', 'abbr', 'b', 'blockquote', 'br', 'code', 'del', 'em', 'h1', 'h2',
+    'h3', 'h4', 'h5', 'h6', 'hr', 'i', 'li', 'ol', 'p', 'pre', 'strong',
+    'table', 'tbody', 'td', 'th', 'thead', 'tr', 'ul',
+])
+ALLOWED_ATTRIBUTES = {
+    'a': ['href', 'title'],
+    'abbr': ['title'],
+    'th': ['align'],
+    'td': ['align'],
+}
+ALLOWED_PROTOCOLS = frozenset(['http', 'https', 'mailto'])
+
+RENDERED_FIELDS = ('body_html', 'excerpt', 'word_count', 'render_version')
+
+
+# each thread's Markdown converter and HTML cleaner, made by renderers()
+local = threading.local()
+
+
+def renderers():
+    """Return this thread's Markdown converter and HTML cleaner.
+
+    Building them costs more than rendering most bodies, and neither can
+    be shared between threads.
+    """
+    if not hasattr(local, 'markdown'):
+        # imported here so that serving pages does not pay for them
+        from bleach.sanitizer import Cleaner
+        from markdown import Markdown
+        local.markdown = Markdown(extensions=MARKDOWN_EXTENSIONS,
+                                  output_format='html')
+        local.cleaner = Cleaner(tags=ALLOWED_TAGS,
+                                attributes=ALLOWED_ATTRIBUTES,
+                                protocols=ALLOWED_PROTOCOLS, strip=True)
+    return local.markdown, local.cleaner
+
+
+def render_markdown(text):
+    """Return the sanitized HTML of the Markdown in text."""
+    converter, cleaner = renderers()
+    return cleaner.clean(converter.reset().convert(text or u''))
+
+
+def make_excerpt(words, size=EXCERPT_WORDS):
+    """Return the first size words, with an ellipsis if any were cut."""
+    excerpt = u' '.join(words[:size])
+    if len(words) > size:
+        excerpt += u'…'
+    return excerpt
+
+
+def rendered_fields(body):
+    """Return the values of the RENDERED_FIELDS columns for body."""
+    html = render_markdown(body)
+    words = Markup(html).striptags().split()
+    return {
+        'body_html': html,
+        'excerpt': make_excerpt(words),
+        'word_count': len(words),
+        'render_version': RENDER_VERSION,
+    }
+
+
+def render_entry(entry):
+    """Render entry's body into its stored HTML, excerpt and word count."""
+    for name, value in rendered_fields(entry.body).items():
+        setattr(entry, name, value)
+
+
+@event.listens_for(Entry, 'before_insert')
+def render_new_entry(mapper, connection, entry):
+    render_entry(entry)
+
+
+@event.listens_for(Entry, 'before_update')
+def render_changed_entry(mapper, connection, entry):
+    if (inspect(entry).attrs.body.history.has_changes() or
+            entry.render_version != RENDER_VERSION):
+        render_entry(entry)
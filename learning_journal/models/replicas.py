@@ -0,0 +1,151 @@
+"""Read replica routing for ``request.dbsession``.
+
+GET and HEAD requests read from a replica chosen round-robin; every
+other request uses the primary. A request that writes through the
+primary sets a short-lived cookie so the same client keeps reading from
+the primary until the replicas have caught up (read-your-writes).
+
+Replicas are checked with ``SELECT 1`` at most every ``check_interval``
+seconds and whenever a connection error is raised on them. A failing
+replica is ejected for ``retry_after`` seconds and then tried again.
+"""
+import itertools
+import logging
+import threading
+import time
+
+from pyramid.settings import aslist
+from sqlalchemy import event
+
+log = logging.getLogger(__name__)
+
+SAFE_METHODS = ('GET', 'HEAD')
+PRIMARY_COOKIE = 'lj_primary'
+
+
+class Replica(object):
+    """One read replica and its health."""
+
+    def __init__(self, engine, session_factory):
+        self.engine = engine
+        self.session_factory = session_factory
+        self.ejected_until = 0
+        self.checked_at = 0
+
+    @property
+    def name(self):
+        return repr(self.engine.url)
+
+
+class ReplicaSet(object):
+    """Round-robin over the replicas that are currently healthy."""
+
+    def __init__(self, replicas, retry_after=30, check_interval=10):
+        self.replicas = list(replicas)
+        self.retry_after = retry_after
+        self.check_interval = check_interval
+        self._counter = itertools.count()
+        self._lock = threading.Lock()
+        for replica in self.replicas:
+            event.listen(replica.engine, 'handle_error',
+                         self._error_handler(replica))
+
+    def _error_handler(self, replica):
+        def on_error(context):
+            if context.is_disconnect or context.connection is None:
+                self.eject(replica)
+        return on_error
+
+    def eject(self, replica):
+        """Stop routing reads to replica for retry_after seconds."""
+        replica.ejected_until = time.time() + self.retry_after
+        log.warning('ejected read replica %s for %ss',
+                    replica.name, self.retry_after)
+
+    def is_healthy(self, replica):
+        now = time.time()
+        if replica.ejected_until > now:
+            return False
+        if now - replica.checked_at < self.check_interval:
+            return True
+        replica.checked_at = now
+        try:
+            with replica.engine.connect() as connection:
+                connection.execute('SELECT 1')
+        except Exception:
+            self.eject(replica)
+            return False
+        return True
+
+    def choose(self):
+        """Return the next healthy replica, or None if there are none."""
+        with self._lock:
+            start = next(self._counter)
+        count = len(self.replicas)
+        for offset in range(count):
+            replica = self.replicas[(start + offset) % count]
+            if self.is_healthy(replica):
+                return replica
+        return None
+
+    @property
+    def engines(self):
+        return [replica.engine for replica in self.replicas]
+
+    def stats(self):
+        now = time.time()
+        return [{'url': replica.name,
+                 'healthy': replica.ejected_until <= now,
+                 'ejected_for': max(0, round(replica.ejected_until - now))}
+                for replica in self.replicas]
+
+
+def replica_set_from_settings(settings, get_engine, get_session_factory):
+    """Build the ReplicaSet described by the ``replicas.*`` settings.
+
+    Replicas share the primary's ``sqlalchemy.*`` engine options. Returns
+    None when ``replicas.urls`` is empty.
+    """
+    urls = aslist(settings.get('replicas.urls', ''))
+    if not urls:
+        return None
+    replicas = []
+    for url in urls:
+        replica_settings = dict(settings)
+        replica_settings['sqlalchemy.url'] = url
+        engine = get_engine(replica_settings)
+        replicas.append(Replica(engine, get_session_factory(engine)))
+    return ReplicaSet(
+        replicas,
+        retry_after=float(settings.get('replicas.retry_after', 30)),
+        check_interval=float(settings.get('replicas.check_interval', 10)))
+
+
+def mark_written(session, flush_context):
+    """Remember that a session has sent changes to the primary."""
+    session.info['wrote'] = True
+
+
+def choose_session_factory(request):
+    """Return the session factory request should read and write with."""
+    registry = request.registry
+    replicas = registry.get('dbreplicas')
+    if (replicas is not None and request.method in SAFE_METHODS and
+            PRIMARY_COOKIE not in request.cookies):
+        replica = replicas.choose()
+        if replica is not None:
+            return replica.session_factory
+    return registry['dbsession_factory']
+
+
+def stick_to_primary(request, session):
+    """Send the client to the primary for a while if session wrote."""
+    seconds = int(request.registry.settings.get('replicas.sticky_seconds',
+                                                10))
+
+    def set_cookie(request, response):
+        if session.info.get('wrote'):
+            response.set_cookie(PRIMARY_COOKIE, '1', max_age=seconds,
+                                httponly=True)
+
+    request.add_response_callback(set_cookie)
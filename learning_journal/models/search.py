@@ -0,0 +1,179 @@
+"""Full-text search over journal entries.
+
+The index lives in the database and is kept in sync by the database
+itself, so no write path has to remember to update it:
+
+- On SQLite an FTS5 external content table, ``models_fts``, mirrors the
+  title and body of ``models`` through insert/update/delete triggers.
+- On PostgreSQL a GIN expression index over the entry's ``tsvector`` is
+  maintained by the planner like any other index.
+
+The DDL is attached to the ``models`` table, so ``metadata.create_all``
+builds the index along with the table. ``build_search_index`` creates it
+on an existing database and reindexes the rows already there.
+"""
+from markupsafe import Markup, escape
+from sqlalchemy import DDL, Date, Integer, Unicode, Float, event, text
+
+from .entrymodel import Entry
+
+# snippets come back from the database with these around each match;
+# they are swapped for <mark> tags once the rest has been escaped
+START_MATCH = u'\x02'
+STOP_MATCH = u'\x03'
+
+
+class UnsupportedDatabase(ValueError):
+    """Raised when a feature needs SQL the database's dialect lacks."""
+
+    def __init__(self, feature, dialect):
+        super(UnsupportedDatabase, self).__init__(
+            '%s is not available on %s' % (feature, dialect))
+        self.feature = feature
+        self.dialect = dialect
+
+
+SQLITE_DDL = [
+    "CREATE VIRTUAL TABLE IF NOT EXISTS models_fts USING fts5("
+    "title, body, content='models', content_rowid='id')",
+    "CREATE TRIGGER IF NOT EXISTS models_fts_insert AFTER INSERT ON models "
+    "BEGIN "
+    "INSERT INTO models_fts(rowid, title, body) "
+    "VALUES (new.id, new.title, new.body); "
+    "END",
+    "CREATE TRIGGER IF NOT EXISTS models_fts_delete AFTER DELETE ON models "
+    "BEGIN "
+    "INSERT INTO models_fts(models_fts, rowid, title, body) "
+    "VALUES ('delete', old.id, old.title, old.body); "
+    "END",
+    "CREATE TRIGGER IF NOT EXISTS models_fts_update "
+    "AFTER UPDATE OF title, body ON models "
+    "BEGIN "
+    "INSERT INTO models_fts(models_fts, rowid, title, body) "
+    "VALUES ('delete', old.id, old.title, old.body); "
+    "INSERT INTO models_fts(rowid, title, body) "
+    "VALUES (new.id, new.title, new.body); "
+    "END",
+]
+SQLITE_REBUILD = "INSERT INTO models_fts(models_fts) VALUES ('rebuild')"
+SQLITE_DROP = "DROP TABLE IF EXISTS models_fts"
+
+PG_DOCUMENT = ("to_tsvector('english', "
+               "coalesce(title, '') || ' ' || coalesce(body, ''))")
+PG_DDL = [
+    "CREATE INDEX IF NOT EXISTS ix_models_search ON models "
+    "USING gin ((%s))" % PG_DOCUMENT,
+]
+PG_REBUILD = "REINDEX INDEX ix_models_search"
+
+DIALECT_DDL = {
+    'sqlite': (SQLITE_DDL, SQLITE_REBUILD),
+    'postgresql': (PG_DDL, PG_REBUILD),
+}
+
+for statement in SQLITE_DDL:
+    event.listen(Entry.__table__, 'after_create',
+                 DDL(statement).execute_if(dialect='sqlite'))
+event.listen(Entry.__table__, 'before_drop',
+             DDL(SQLITE_DROP).execute_if(dialect='sqlite'))
+for statement in PG_DDL:
+    event.listen(Entry.__table__, 'after_create',
+                 DDL(statement).execute_if(dialect='postgresql'))
+
+
+def build_search_index(connectable):
+    """Create the search index if needed and index every existing row."""
+    statements, rebuild = DIALECT_DDL.get(connectable.dialect.name,
+                                          ((), None))
+    for statement in statements:
+        connectable.execute(text(statement))
+    if rebuild:
+        connectable.execute(text(rebuild))
+
+
+SQLITE_SEARCH = text(
+    "SELECT models.id, models.title, models.creation_date, "
+    "snippet(models_fts, 1, :start, :stop, :ellipsis, 24) AS snippet, "
+    "bm25(models_fts, 10.0, 1.0) AS rank "
+    "FROM models_fts JOIN models ON models.id = models_fts.rowid "
+    "WHERE models_fts MATCH :query "
+    "ORDER BY rank, models.id DESC "
+    "LIMIT :limit OFFSET :offset"
+)
+
+# rank and page in the subquery so ts_headline only runs on one page
+PG_SEARCH = text(
+    "SELECT models.id, models.title, models.creation_date, "
+    "ts_headline('english', coalesce(models.body, ''), hits.query, "
+    ":options) AS snippet, "
+    "hits.rank "
+    "FROM ("
+    "SELECT models.id, query, ts_rank_cd(%s, query) AS rank "
+    "FROM models, plainto_tsquery('english', :query) query "
+    "WHERE %s @@ query "
+    "ORDER BY rank DESC, models.id DESC "
+    "LIMIT :limit OFFSET :offset"
+    ") hits JOIN models ON models.id = hits.id "
+    "ORDER BY hits.rank DESC, models.id DESC" % (PG_DOCUMENT, PG_DOCUMENT)
+)
+
+SQLITE_COUNT = text(
+    "SELECT count(*) FROM models_fts WHERE models_fts MATCH :query")
+PG_COUNT = text(
+    "SELECT count(*) FROM models, plainto_tsquery('english', :query) query "
+    "WHERE %s @@ query" % PG_DOCUMENT)
+
+RESULT_COLUMNS = dict(id=Integer, title=Unicode, creation_date=Date,
+                      snippet=Unicode, rank=Float)
+
+
+def fts5_query(terms):
+    """Quote each word of terms so FTS5 matches them all literally."""
+    return u' '.join(u'"%s"' % word.replace(u'"', u'""')
+                     for word in terms.split())
+
+
+def search_entries(dbsession, terms, limit=20, offset=0):
+    """Return a page of entries matching terms, best match first.
+
+    Each row has ``id``, ``title``, ``creation_date``, ``snippet`` and
+    ``rank``. Snippets are raw text with matches wrapped in
+    ``START_MATCH``/``STOP_MATCH``; see ``highlight``.
+    """
+    if not terms.strip():
+        return []
+    dialect = dbsession.bind.dialect.name
+    if dialect == 'sqlite':
+        statement = SQLITE_SEARCH.columns(**RESULT_COLUMNS)
+        params = dict(query=fts5_query(terms), start=START_MATCH,
+                      stop=STOP_MATCH, ellipsis=u'…')
+    elif dialect == 'postgresql':
+        statement = PG_SEARCH.columns(**RESULT_COLUMNS)
+        params = dict(query=terms, options=(
+            u'StartSel="%s", StopSel="%s", MaxFragments=2, '
+            u'MaxWords=30, MinWords=10' % (START_MATCH, STOP_MATCH)))
+    else:
+        raise UnsupportedDatabase('full-text search', dialect)
+    params.update(limit=limit, offset=offset)
+    return dbsession.execute(statement, params).fetchall()
+
+
+def count_matches(dbsession, terms):
+    """Return the number of entries matching terms."""
+    if not terms.strip():
+        return 0
+    dialect = dbsession.bind.dialect.name
+    if dialect == 'sqlite':
+        statement, query = SQLITE_COUNT, fts5_query(terms)
+    elif dialect == 'postgresql':
+        statement, query = PG_COUNT, terms
+    else:
+        raise UnsupportedDatabase('full-text search', dialect)
+    return dbsession.execute(statement, {'query': query}).scalar()
+
+
+def highlight(snippet):
+    """Return snippet as safe HTML with its matches in <mark> tags."""
+    return Markup(escape(snippet or u'')
+                  .replace(START_MATCH, Markup(u'<mark>'))
+                  .replace(STOP_MATCH, Markup(u'</mark>')))
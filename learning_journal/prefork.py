@@ -0,0 +1,279 @@
+"""Serve one app from several pre-forked waitress processes.
+
+The arbiter binds the listening socket and is handed an app that is
+already loaded, so the workers it forks share the app's memory copy on
+write, then keeps ``workers`` processes running. Each worker closes the
+database connections it inherited, serves the shared socket with
+waitress, and leaves once it has served ``max_requests`` requests (plus
+up to ``max_requests_jitter``, so they do not all leave together) or is
+sent SIGTERM. A leaving worker stops accepting and finishes the requests
+it holds, for up to ``graceful_timeout`` seconds.
+
+Signals to the arbiter:
+
+- SIGTERM or SIGINT: stop the workers gracefully, then exit.
+- SIGHUP: graceful restart. The arbiter re-executes itself, keeping the
+  listening socket, loads the app again (new code and settings), starts
+  new workers and only then stops the old ones, so no connection is
+  refused.
+"""
+import gc
+import itertools
+import logging
+import os
+import random
+import signal
+import socket
+import sys
+import time
+
+from waitress import wasyncore
+from waitress.server import create_server
+
+from .models import dispose_engines
+from .shedding import dispatcher_from_settings
+
+log = logging.getLogger(__name__)
+
+# environment passed across a graceful restart: the listening socket's
+# file descriptor, and the pids of the workers to retire
+LISTEN_FD = 'LJ_PREFORK_FD'
+OLD_WORKERS = 'LJ_PREFORK_OLD_WORKERS'
+
+# seconds between the arbiter's checks on its workers
+TICK = 0.5
+# a worker leaving sooner than this after starting is respawned only
+# after a pause, so a broken app does not fork in a tight loop
+MIN_LIFETIME = 1.0
+
+
+def listen(host='0.0.0.0', port=8080, backlog=1024):
+    """Return the listening socket, inherited across a restart if any."""
+    fd = os.environ.pop(LISTEN_FD, None)
+    if fd is not None:
+        sock = socket.socket(fileno=int(fd))
+    else:
+        family, kind, proto, _, address = socket.getaddrinfo(
+            host, int(port), 0, socket.SOCK_STREAM)[0]
+        sock = socket.socket(family, kind, proto)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.bind(address)
+    sock.listen(int(backlog))
+    return sock
+
+
+def check_shared_state(app, workers):
+    """Refuse settings that would give each worker state they must share.
+
+    The page and entry caches check the journal version, so per-process
+    copies are only ever briefly stale; login buckets kept per process
+    would multiply the login limits by the number of workers.
+    """
+    registry = getattr(app, 'registry', None)
+    guard = registry.get('login_guard') if registry is not None else None
+    if workers > 1 and guard is not None and not guard.shared:
+        raise ValueError(
+            'login.throttle_backend = memory gives each of the %d workers '
+            'its own login buckets; use sqlite with login.throttle_path'
+            % workers)
+
+
+def busy(server):
+    """Return whether waitress still holds requests or unsent output."""
+    dispatcher = server.task_dispatcher
+    if dispatcher.queue or dispatcher.active_count:
+        return True
+    return any(getattr(channel, 'requests', None) or
+               getattr(channel, 'total_outbufs_len', 0)
+               for channel in list(server._map.values()))
+
+
+class Worker(object):
+    """A forked process serving app on the shared socket.
+
+    It is also the WSGI app waitress serves, to count the requests.
+    """
+
+    def __init__(self, app, sock, options, max_requests=0,
+                 graceful_timeout=30):
+        self.app = app
+        self.sock = sock
+        self.options = options
+        self.max_requests = max_requests
+        self.graceful_timeout = graceful_timeout
+        self.served = itertools.count(1)
+        self.stopping = False
+
+    def __call__(self, environ, start_response):
+        # next() on a count is atomic, so the threads need no lock
+        if self.max_requests and next(self.served) >= self.max_requests:
+            self.stopping = True
+        return self.app(environ, start_response)
+
+    def stop(self, signum=None, frame=None):
+        self.stopping = True
+
+    def run(self):
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+        signal.signal(signal.SIGHUP, signal.SIG_IGN)
+        registry = getattr(self.app, 'registry', None)
+        if registry is not None:
+            # connections opened before the fork belong to the arbiter
+            dispose_engines(registry)
+        dispatcher = dispatcher_from_settings(
+            registry.settings if registry is not None else {})
+        dispatcher.set_thread_count(int(self.options.get('threads', 4)))
+        server = create_server(self, sockets=[self.sock],
+                               _dispatcher=dispatcher, **self.options)
+        use_poll = server.adj.asyncore_use_poll
+        while not self.stopping:
+            wasyncore.loop(timeout=1.0, use_poll=use_poll, map=server._map,
+                           count=1)
+        # the other workers accept from now on
+        server.accepting = False
+        deadline = time.time() + self.graceful_timeout
+        while busy(server) and time.time() < deadline:
+            wasyncore.loop(timeout=0.1, use_poll=use_poll, map=server._map,
+                           count=1)
+        dispatcher.shutdown(timeout=1)
+        metrics = registry.get('metrics') if registry is not None else None
+        if metrics is not None:
+            metrics.flush()
+
+
+class Arbiter(object):
+    """Keep ``workers`` processes serving app on sock.
+
+    options are waitress's; max_requests of 0 never recycles workers.
+    """
+
+    def __init__(self, app, sock, options=None, workers=2, max_requests=0,
+                 max_requests_jitter=0, graceful_timeout=30):
+        self.app = app
+        self.sock = sock
+        self.options = dict(options or {})
+        self.workers = workers
+        self.max_requests = max_requests
+        self.max_requests_jitter = max_requests_jitter
+        self.graceful_timeout = graceful_timeout
+        self.children = {}
+        self.stopping = False
+        self.restarting = False
+
+    def spawn(self):
+        max_requests = self.max_requests
+        if max_requests and self.max_requests_jitter:
+            max_requests += random.randint(0, self.max_requests_jitter)
+        pid = os.fork()
+        if pid:
+            self.children[pid] = time.time()
+            return pid
+        code = 0
+        try:
+            random.seed()
+            Worker(self.app, self.sock, self.options, max_requests,
+                   self.graceful_timeout).run()
+        except BaseException:
+            log.exception('worker %d failed', os.getpid())
+            code = 1
+        finally:
+            # skip the arbiter's own clean up, inherited with its stack
+            os._exit(code)
+
+    def reap(self):
+        """Forget the workers that have exited; return how many soon did."""
+        early = 0
+        while True:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                return early
+            if not pid:
+                return early
+            started = self.children.pop(pid, None)
+            if started is None:
+                continue  # a worker retired after a restart
+            if status:
+                log.warning('worker %d exited with status %d', pid, status)
+            if time.time() - started < MIN_LIFETIME:
+                early += 1
+
+    def signal_children(self, signum, pids=None):
+        for pid in list(self.children if pids is None else pids):
+            try:
+                os.kill(pid, signum)
+            except OSError:
+                pass
+
+    def on_stop(self, signum, frame):
+        self.stopping = True
+
+    def on_restart(self, signum, frame):
+        self.restarting = True
+
+    def restart(self):
+        """Re-execute the arbiter, passing on the socket and the workers."""
+        log.info('restarting')
+        self.sock.set_inheritable(True)
+        os.environ[LISTEN_FD] = str(self.sock.fileno())
+        os.environ[OLD_WORKERS] = ','.join(str(pid) for pid in self.children)
+        os.execv(sys.executable, [sys.executable] + sys.argv)
+
+    def retire_old_workers(self):
+        """Stop the workers of the arbiter that restarted into this one."""
+        pids = [int(pid) for pid in
+                os.environ.pop(OLD_WORKERS, '').split(',') if pid]
+        self.signal_children(signal.SIGTERM, pids)
+
+    def stop(self):
+        """Stop every worker, gracefully for graceful_timeout seconds."""
+        self.signal_children(signal.SIGTERM)
+        deadline = time.time() + self.graceful_timeout + 1
+        while self.children and time.time() < deadline:
+            self.reap()
+            time.sleep(0.1)
+        self.signal_children(signal.SIGKILL)
+        while self.children:
+            pid, _ = os.waitpid(-1, 0)
+            self.children.pop(pid, None)
+
+    def run(self):
+        signal.signal(signal.SIGTERM, self.on_stop)
+        signal.signal(signal.SIGINT, self.on_stop)
+        signal.signal(signal.SIGHUP, self.on_restart)
+        registry = getattr(self.app, 'registry', None)
+        if registry is not None:
+            # forked workers must not share the arbiter's connections
+            dispose_engines(registry)
+        if hasattr(gc, 'freeze'):
+            # keep the collector from touching, and so copying, the
+            # objects every worker shares
+            gc.freeze()
+        for _ in range(self.workers):
+            self.spawn()
+        self.retire_old_workers()
+        log.info('serving with %d workers', self.workers)
+        while not self.stopping:
+            if self.restarting:
+                self.restart()
+            if self.reap():
+                time.sleep(MIN_LIFETIME)
+            while len(self.children) < self.workers and not self.stopping:
+                self.spawn()
+            time.sleep(TICK)
+        self.stop()
+        self.sock.close()
+
+
+def serve(app, options, workers=1, max_requests=0, max_requests_jitter=0,
+          graceful_timeout=30):
+    """Serve app with waitress options from workers processes."""
+    check_shared_state(app, workers)
+    options = dict(options)
+    sock = listen(options.pop('host', '0.0.0.0'),
+                  options.pop('port', 8080),
+                  options.get('backlog', 1024))
+    Arbiter(app, sock, options, workers=workers, max_requests=max_requests,
+            max_requests_jitter=max_requests_jitter,
+            graceful_timeout=graceful_timeout).run()
@@ -1,8 +1,19 @@
 def includeme(config):
-    config.add_static_view(name='static', path='learning_journal:static')
+    config.add_static_view(name='static', path='learning_journal:static',
+                           cache_max_age=3600)
     config.add_route('home', '/')
     config.add_route('detail', '/journal/{id:\d+}')
     config.add_route('create', '/journal/new-entry')
     config.add_route('update', '/journal/{id:\d+}/edit-entry')
     config.add_route('login', '/login')
     config.add_route('logout', '/logout')
+    config.add_route('search', '/search')
+    config.add_route('archive_year', r'/archive/{year:\d{4}}')
+    config.add_route('archive_month',
+                     r'/archive/{year:\d{4}}/{month:\d{1,2}}')
+    config.add_route('feed', '/feed.{kind:atom|rss}')
+    config.add_route('stats', '/_stats')
+    config.add_route('metrics', '/metrics')
+    config.add_route('api_entries', '/api/v1/entries')
+    config.add_route('api_entries_stream', '/api/v1/entries.ndjson')
+    config.add_route('api_entry', r'/api/v1/entries/{id:\d+}')
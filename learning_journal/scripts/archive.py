@@ -0,0 +1,34 @@
+"""Recount the archive's entries per month from the entries table.
+
+New entries are counted as they are created; run this after loading
+entries some other way, or if the counts are ever in doubt.
+"""
+import argparse
+import os
+import sys
+
+import transaction
+from pyramid.scripts.common import parse_vars
+
+from ..models import get_engine, get_session_factory, get_tm_session
+from ..models.archivemodel import rebuild_archive
+from ..models.journalmodel import bump_journal_version
+from .transfer import get_settings
+
+
+def main(argv=sys.argv):
+    parser = argparse.ArgumentParser(
+        prog=os.path.basename(argv[0]),
+        description='Recount the entries in each month of the archive.')
+    parser.add_argument('config_uri', help='e.g. development.ini')
+    parser.add_argument('options', nargs='*', metavar='var=value',
+                        help='settings overrides')
+    args = parser.parse_args(argv[1:])
+    settings = get_settings(args.config_uri, parse_vars(args.options))
+    session_factory = get_session_factory(get_engine(settings))
+    with transaction.manager:
+        dbsession = get_tm_session(session_factory, transaction.manager)
+        months = rebuild_archive(dbsession)
+        # archive pages are validated against the journal version
+        bump_journal_version(dbsession)
+    print('counted entries in %d months' % months)
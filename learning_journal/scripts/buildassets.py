@@ -0,0 +1,21 @@
+"""Fingerprint and precompress the static assets before deploying."""
+import os
+import sys
+
+from ..assets import brotli, build_assets
+
+
+def usage(argv):
+    cmd = os.path.basename(argv[0])
+    print('usage: %s [static_dir]\n'
+          '(example: "%s learning_journal/static")' % (cmd, cmd))
+    sys.exit(1)
+
+
+def main(argv=sys.argv):
+    if len(argv) > 2:
+        usage(argv)
+    root = argv[1] if len(argv) > 1 else None
+    manifest = build_assets(root)
+    print('built %d assets (%s)' % (
+        len(manifest), 'gzip, brotli' if brotli is not None else 'gzip'))
@@ -0,0 +1,249 @@
+"""Generate a reproducible synthetic journal for capacity testing.
+
+    generate development.ini 1000000 --seed 7 --body-words 250 \\
+        --distribution lognormal --processes 8
+
+Each entry is drawn from its own random generator, seeded with the seed
+and the entry's number, so the same arguments always give the same
+journal whatever the number of processes, and an entry comes out the
+same whichever ``--start`` or ``--chunk-size`` produced it. Entries are
+made in chunks of ``chunk_size``; every worker process generates,
+renders and bulk loads its own chunks
+(``COPY`` on PostgreSQL, batched ``executemany`` elsewhere), upserting on
+the title, so running the same command twice loads the same entries
+once. The archive is recounted once at the end.
+"""
+import argparse
+import math
+import multiprocessing
+import os
+import random
+import sys
+import time
+from datetime import date, datetime, timedelta
+
+from pyramid.scripts.common import parse_vars
+from sqlalchemy import inspect
+
+from ..migrations import upgrade
+from ..models import get_engine
+from ..models.rendering import RENDER_VERSION, make_excerpt
+from .transfer import Progress, finish_load, get_settings, load_entries
+
+WORDS = u"""\
+algorithm array binary bisect branch browser cache class closure commit
+compile cookie cursor database decorator deque deploy dictionary django
+docstring edge exception fixture flask framework function generator git
+graph hash heap heroku index insert iterator javascript jinja join json
+lambda linked list merge method migration model module node object
+postgres priority pyramid python query queue recursion refactor regex
+request response route schema scope search server session socket sort
+sqlalchemy stack string template test today transaction traversal tree
+trie tuple update variable view weight learned finally confusing easy
+hard tomorrow project group pair lecture whiteboard interview""".split()
+
+CHUNK_SIZE = 10000
+DEFAULT_SINCE = date(2016, 12, 19)
+DEFAULT_DAYS = 3650
+PARAGRAPH_WORDS = 60
+# share of entries given an edit date
+EDITED_SHARE = 0.1
+
+
+def fixed_length(rand, mean):
+    return mean
+
+
+def uniform_length(rand, mean):
+    return rand.randint(1, 2 * mean - 1)
+
+
+def lognormal_length(rand, mean, sigma=0.75):
+    # mu chosen so that the distribution's mean is mean
+    mu = math.log(mean) - sigma * sigma / 2
+    return max(1, int(rand.lognormvariate(mu, sigma)))
+
+
+def pareto_length(rand, mean, alpha=2.5):
+    return max(1, int(mean * (alpha - 1) / alpha * rand.paretovariate(alpha)))
+
+
+# body length distributions, by the mean number of words
+DISTRIBUTIONS = {
+    'fixed': fixed_length,
+    'uniform': uniform_length,
+    'lognormal': lognormal_length,
+    'pareto': pareto_length,
+}
+
+
+def chunks(count, start=0, chunk_size=CHUNK_SIZE):
+    """Yield (chunk number, first entry, stop) covering count entries."""
+    first = start
+    stop = start + count
+    while first < stop:
+        chunk = first // chunk_size
+        end = min(stop, (chunk + 1) * chunk_size)
+        yield chunk, first, end
+        first = end
+
+
+def synthetic_range(seed, first, stop, body_words=200,
+                    distribution='lognormal', since=DEFAULT_SINCE,
+                    days=DEFAULT_DAYS):
+    """Return the entry dicts numbered first to stop - 1.
+
+    Each entry's words are drawn in one call and its body is a slice of
+    them broken into paragraphs. The words need no escaping, so the
+    rendered fields are built directly rather than by the renderer.
+    """
+    length = DISTRIBUTIONS[distribution]
+    rows = []
+    for number in range(first, stop):
+        rand = random.Random('%d:%d' % (seed, number))
+        size = length(rand, body_words)
+        words = rand.choices(WORDS, k=size + 3)
+        title = u'Entry %d: %s' % (number, u' '.join(words[:3]))
+        body = words[3:]
+        created = since + timedelta(days=rand.randrange(days))
+        edited = None
+        if rand.random() < EDITED_SHARE:
+            edited = created + timedelta(days=rand.randrange(1, 60))
+        paragraphs = [u' '.join(body[i:i + PARAGRAPH_WORDS])
+                      for i in range(0, size, PARAGRAPH_WORDS)]
+        rows.append({
+            'id': None,
+            'title': title,
+            'body': u'\n\n'.join(paragraphs),
+            'creation_date': created,
+            'edit_date': edited,
+            # what rendered_fields would make of plain paragraphs, without
+            # the cost of Markdown and bleach
+            'body_html': u'\n'.join(u'<p>%s</p>' % paragraph
+                                    for paragraph in paragraphs),
+            'excerpt': make_excerpt(body),
+            'word_count': size,
+            'render_version': RENDER_VERSION,
+        })
+    return rows
+
+
+def synthetic_entries(count, seed=0, start=0, chunk_size=CHUNK_SIZE,
+                      **shape):
+    """Lazily yield count reproducible entry dicts, a chunk at a time.
+
+    shape takes the body_words, distribution, since and days arguments
+    of ``synthetic_range``.
+    """
+    for chunk, first, stop in chunks(count, start, chunk_size):
+        for row in synthetic_range(seed, first, stop, **shape):
+            yield row
+
+
+# the engine and options of each worker process, set by init_worker
+worker = {}
+
+
+def init_worker(settings, options):
+    worker.update(engine=get_engine(settings), options=options)
+
+
+def load_chunk(work):
+    """Generate and load one chunk; return the entries loaded."""
+    _, first, stop = work
+    options = worker['options']
+    rows = synthetic_range(options['seed'], first, stop,
+                           **options['shape'])
+    return load_entries(worker['engine'], rows,
+                        batch_size=options['batch_size'],
+                        use_copy=options['use_copy'], finish=False)
+
+
+def generate(settings, count, seed=0, start=0, processes=None,
+             chunk_size=CHUNK_SIZE, batch_size=5000, use_copy=True,
+             progress=None, **shape):
+    """Load count synthetic entries into the database of settings.
+
+    A database without tables is migrated first. Returns the number of
+    entries loaded.
+    """
+    engine = get_engine(settings)
+    with engine.connect() as connection:
+        if 'models' not in inspect(connection).get_table_names():
+            upgrade(connection)
+    # forked workers must not share the parent's connections
+    engine.dispose()
+    options = {'seed': seed, 'shape': shape, 'batch_size': batch_size,
+               'use_copy': use_copy}
+    work = list(chunks(count, start, chunk_size))
+    processes = min(processes or multiprocessing.cpu_count(), len(work))
+    loaded = 0
+    if processes <= 1:
+        init_worker(settings, options)
+        try:
+            for rows in map(load_chunk, work):
+                loaded += rows
+                if progress:
+                    progress(rows)
+        finally:
+            worker.pop('engine').dispose()
+    else:
+        pool = multiprocessing.Pool(processes, initializer=init_worker,
+                                    initargs=(settings, options))
+        try:
+            for rows in pool.imap_unordered(load_chunk, work):
+                loaded += rows
+                if progress:
+                    progress(rows)
+        finally:
+            pool.close()
+            pool.join()
+    finish_load(engine)
+    engine.dispose()
+    return loaded
+
+
+def parse_date(value):
+    return datetime.strptime(value, '%Y-%m-%d').date()
+
+
+def main(argv=sys.argv):
+    parser = argparse.ArgumentParser(
+        prog=os.path.basename(argv[0]),
+        description='Load reproducible synthetic journal entries.')
+    parser.add_argument('config_uri', help='e.g. development.ini')
+    parser.add_argument('count', type=int, help='entries to generate')
+    parser.add_argument('options', nargs='*', metavar='var=value',
+                        help='settings overrides')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--start', type=int, default=0,
+                        help='number of the first entry, to add to an '
+                             'earlier run')
+    parser.add_argument('--body-words', type=int, default=200,
+                        help='mean words per body')
+    parser.add_argument('--distribution', choices=sorted(DISTRIBUTIONS),
+                        default='lognormal',
+                        help='distribution of body lengths')
+    parser.add_argument('--since', type=parse_date, default=DEFAULT_SINCE,
+                        help='earliest creation date, YYYY-MM-DD')
+    parser.add_argument('--days', type=int, default=DEFAULT_DAYS,
+                        help='creation dates fall within this many days')
+    parser.add_argument('--processes', type=int,
+                        help='worker processes (default: one per CPU)')
+    parser.add_argument('--chunk-size', type=int, default=CHUNK_SIZE,
+                        help='entries generated and loaded per task')
+    parser.add_argument('--batch-size', type=int, default=5000)
+    parser.add_argument('--no-copy', action='store_true',
+                        help='use executemany instead of COPY on PostgreSQL')
+    args = parser.parse_args(argv[1:])
+    settings = get_settings(args.config_uri, parse_vars(args.options))
+    progress = Progress(label='generated')
+    generate(settings, args.count, seed=args.seed, start=args.start,
+             processes=args.processes, chunk_size=args.chunk_size,
+             batch_size=args.batch_size, use_copy=not args.no_copy,
+             progress=progress, body_words=args.body_words,
+             distribution=args.distribution, since=args.since,
+             days=args.days)
+    sys.stderr.write('generated %d entries in %.1fs (%.0f/s)\n'
+                     % (progress.count, time.time() - progress.started,
+                        progress.rate()))
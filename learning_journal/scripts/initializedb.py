@@ -1,6 +1,5 @@
 import os
 import sys
-import transaction
 from datetime import datetime
 
 from pyramid.paster import (
@@ -9,28 +8,23 @@ from pyramid.paster import (
 )
 
 from pyramid.scripts.common import parse_vars
+from sqlalchemy import select
 
-from ..models.meta import Base
+from ..migrations import upgrade
 from ..models import (
     get_engine,
-    get_session_factory,
-    get_tm_session,
+    settings_from_environ,
 )
 from ..models import Entry
+from ..models.search import build_search_index
+from .generate import synthetic_entries
+from .transfer import load_entries
 
-import faker
+# synthetic entries a new journal starts with, ahead of ENTRIES
+SYNTHETIC_ENTRIES = 30
+SEED = 0
 
-
-fake = faker.Faker()
-
-ENTRIES = [{
-    "title": fake.catch_phrase(),
-    "body": fake.paragraph(),
-    "creation_date": fake.date_object()
-} for i in range(30)]
-
-
-ENTRIES += [
+ENTRIES = [
     {
         "title": "TESTING",
         "body": "T0day we m0ved past vanillaish servers and jumped int0 pyth0n web framew0rks, specifically Pyramid. We discussed the t00ls Pyramid gives y0u t0 implement MVC architecture, with view c0ntr0llers and r0utes. Setting up the pyramid framew0rk is quite straightf0rward with the scaff0lds they pr0vide, I imagine it'd be h0rrend0us if th0se weren't available. F0r n0w, all 0f 0ur c0ntent is static, but we'll be building 0ur data 0ff 0f templates s00n. After setting up the pyramid app, we pushed it t0 her0ku. As 0ur daily data structure, we were intr0duced t0 d0uble ended queses, deques, which all0w p0pping and appending 0n b0th ends. They werer simple t0 implement using the d0uble-linked list under the h00d.",
@@ -59,6 +53,15 @@ ENTRIES += [
 ]
 
 
+def seed_entries():
+    """Return the entry dicts a new journal is seeded with."""
+    entries = list(synthetic_entries(SYNTHETIC_ENTRIES, seed=SEED))
+    for entry in ENTRIES:
+        entries.append(dict(entry, id=None, edit_date=None,
+                            creation_date=entry['creation_date'].date()))
+    return entries
+
+
 def usage(argv):
     cmd = os.path.basename(argv[0])
     print('usage: %s <config_uri> [var=value]\n'
@@ -73,18 +76,17 @@ def main(argv=sys.argv):
     options = parse_vars(argv[2:])
     setup_logging(config_uri)
     settings = get_appsettings(config_uri, options=options)
-    settings["sqlalchemy.url"] = os.environ["DATABASE_URL"]
+    settings = settings_from_environ(settings)
 
     engine = get_engine(settings)
-    Base.metadata.drop_all(engine)
-    Base.metadata.create_all(engine)
+    # migrate rather than drop and recreate, so existing entries survive
+    with engine.connect() as connection:
+        upgrade(connection)
+        empty = connection.execute(
+            select([Entry.__table__.c.id]).limit(1)).first() is None
 
-    session_factory = get_session_factory(engine)
+    if empty:
+        load_entries(engine, seed_entries())
 
-    with transaction.manager:
-        dbsession = get_tm_session(session_factory, transaction.manager)
-        for entry in ENTRIES:
-            model = Entry(title=entry['title'],
-                          body=entry['body'],
-                          creation_date=entry['creation_date'])
-            dbsession.add(model)
+    with engine.begin() as connection:
+        build_search_index(connection)
@@ -0,0 +1,89 @@
+"""Render the Markdown bodies of entries written by an older renderer.
+
+Run after migrating a database that predates rendered bodies, and after
+every change to ``RENDER_VERSION``. Rows are read in id order, a batch
+at a time, and each batch commits on its own, so the command can be
+interrupted and run again to pick up where it stopped.
+"""
+import argparse
+import os
+import sys
+import time
+
+from pyramid.scripts.common import parse_vars
+from sqlalchemy import bindparam, select
+
+from ..models import Entry, get_engine, get_session_factory, rendering
+from ..models.journalmodel import bump_journal_version
+from .transfer import Progress, get_settings
+
+
+def render_stale_entries(engine, batch_size=500, everything=False,
+                         progress=None):
+    """Re-render entries stamped with an older renderer version.
+
+    With everything, every entry is re-rendered. Each re-rendered entry
+    gets a new version, so cached copies of its page are revalidated.
+    Returns the number of entries rendered.
+    """
+    table = Entry.__table__
+    query = select([table.c.id, table.c.body]).order_by(
+        table.c.id).limit(batch_size)
+    if not everything:
+        query = query.where(
+            table.c.render_version < rendering.RENDER_VERSION)
+    update = table.update().where(
+        table.c.id == bindparam('entry_id')
+    ).values(body_html=bindparam('body_html'),
+             excerpt=bindparam('excerpt'),
+             word_count=bindparam('word_count'),
+             render_version=bindparam('render_version'),
+             version=table.c.version + 1)
+    count = 0
+    last_id = 0
+    with engine.connect() as connection:
+        while True:
+            rows = connection.execute(
+                query.where(table.c.id > last_id)).fetchall()
+            if not rows:
+                break
+            batch = []
+            for row in rows:
+                values = rendering.rendered_fields(row.body)
+                values['entry_id'] = row.id
+                batch.append(values)
+            with connection.begin():
+                connection.execute(update, batch)
+            last_id = rows[-1].id
+            count += len(batch)
+            if progress:
+                progress(len(batch))
+    if count:
+        session = get_session_factory(engine)()
+        try:
+            bump_journal_version(session)
+            session.commit()
+        finally:
+            session.close()
+    return count
+
+
+def main(argv=sys.argv):
+    parser = argparse.ArgumentParser(
+        prog=os.path.basename(argv[0]),
+        description='Render the Markdown bodies of journal entries.')
+    parser.add_argument('config_uri', help='e.g. development.ini')
+    parser.add_argument('options', nargs='*', metavar='var=value',
+                        help='settings overrides')
+    parser.add_argument('--batch-size', type=int, default=500)
+    parser.add_argument('--all', action='store_true', dest='everything',
+                        help='re-render every entry, not just stale ones')
+    args = parser.parse_args(argv[1:])
+    settings = get_settings(args.config_uri, parse_vars(args.options))
+    engine = get_engine(settings)
+    progress = Progress(label='rendered')
+    render_stale_entries(engine, batch_size=args.batch_size,
+                         everything=args.everything, progress=progress)
+    sys.stderr.write('rendered %d entries in %.1fs (renderer version %d)\n'
+                     % (progress.count, time.time() - progress.started,
+                        rendering.RENDER_VERSION))
@@ -0,0 +1,36 @@
+"""Export the public site as static files for a file server or CDN."""
+import argparse
+import os
+import sys
+
+from pyramid.paster import setup_logging
+from pyramid.scripts.common import parse_vars
+
+from ..snapshot import DEFAULT_BASE_URL, build_snapshot
+
+
+def main(argv=sys.argv):
+    parser = argparse.ArgumentParser(
+        prog=os.path.basename(argv[0]),
+        description='Render the public pages into a directory, only '
+                    'rendering what changed since the last export.')
+    parser.add_argument('config_uri', help='e.g. production.ini')
+    parser.add_argument('directory', help='where to write the site')
+    parser.add_argument('options', nargs='*', metavar='var=value',
+                        help='settings overrides')
+    parser.add_argument('--base-url', default=DEFAULT_BASE_URL,
+                        help='the URL the site will be served from')
+    parser.add_argument('--full', action='store_true',
+                        help='render every page, as after a template change')
+    parser.add_argument('--processes', type=int,
+                        help='rendering processes (default: one per CPU)')
+    args = parser.parse_args(argv[1:])
+    setup_logging(args.config_uri)
+    summary = build_snapshot(args.config_uri, args.directory,
+                             base_url=args.base_url.rstrip('/'),
+                             options=parse_vars(args.options),
+                             processes=args.processes, full=args.full)
+    print('%s export: rendered %d pages, removed %d, copied %d static '
+          'files in %.1fs' % ('full' if summary['full'] else 'incremental',
+                              summary['rendered'], summary['removed'],
+                              summary['static_files'], summary['seconds']))
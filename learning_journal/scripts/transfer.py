@@ -0,0 +1,394 @@
+"""Stream journal entries in and out of the database.
+
+``export_entries`` writes every entry as JSON Lines or CSV, reading them
+through a server-side cursor so memory use does not grow with the
+journal. ``import_entries`` reads the same formats and loads them in
+batches with Core ``executemany`` (or ``COPY`` on PostgreSQL), upserting
+on the unique title index and rendering each body as it goes. Records
+that cannot be stored are skipped and reported by line number.
+"""
+import argparse
+import csv
+import io
+import json
+import os
+import sys
+import time
+from collections import OrderedDict
+from datetime import datetime
+
+from pyramid.paster import (
+    get_appsettings,
+    setup_logging,
+)
+from pyramid.scripts.common import parse_vars
+from sqlalchemy import Date, bindparam, text
+
+from ..models import (
+    get_engine,
+    get_session_factory,
+    iter_entries,
+    settings_from_environ,
+)
+from ..models.entrymodel import FIELDS
+from ..models.archivemodel import rebuild_archive
+from ..models.journalmodel import bump_journal_version
+from ..models.search import UnsupportedDatabase
+from ..models.rendering import (
+    RENDERED_FIELDS,
+    RENDER_VERSION,
+    rendered_fields,
+)
+
+FORMATS = ('jsonl', 'csv')
+
+# SQLite (3.24+) and PostgreSQL share this upsert syntax
+UPSERT = """\
+INSERT INTO models (%(columns)s, version)
+VALUES (%(values)s, 1)
+ON CONFLICT (title) DO UPDATE SET
+    body = excluded.body,
+    creation_date = excluded.creation_date,
+    edit_date = excluded.edit_date,
+    body_html = excluded.body_html,
+    excerpt = excluded.excerpt,
+    word_count = excluded.word_count,
+    render_version = excluded.render_version,
+    version = models.version + 1"""
+
+PG_STAGING = """\
+CREATE TEMPORARY TABLE IF NOT EXISTS models_import (
+    id integer,
+    title text,
+    body text,
+    creation_date date,
+    edit_date date,
+    body_html text,
+    excerpt text,
+    word_count integer,
+    render_version integer
+) ON COMMIT DELETE ROWS"""
+
+PG_COPY = ("COPY models_import (%s) FROM STDIN "
+           "WITH (FORMAT csv, NULL '\\N')")
+
+PG_MERGE = """\
+INSERT INTO models (%(columns)s, version)
+SELECT %(columns)s, 1 FROM models_import
+ON CONFLICT (title) DO UPDATE SET
+    body = excluded.body,
+    creation_date = excluded.creation_date,
+    edit_date = excluded.edit_date,
+    body_html = excluded.body_html,
+    excerpt = excluded.excerpt,
+    word_count = excluded.word_count,
+    render_version = excluded.render_version,
+    version = models.version + 1"""
+
+PG_RESET_SEQUENCE = ("SELECT setval(pg_get_serial_sequence('models', 'id'), "
+                     "(SELECT coalesce(max(id), 1) FROM models))")
+
+
+def guess_format(path, fmt=None):
+    """Return the format named by fmt or by the file's extension."""
+    if fmt:
+        return fmt
+    if path.endswith('.csv'):
+        return 'csv'
+    return 'jsonl'
+
+
+def open_stream(path, mode):
+    """Open path (or stdin/stdout for "-") as UTF-8 text."""
+    if path == '-':
+        stream = sys.stdin if 'r' in mode else sys.stdout
+        return io.open(stream.fileno(), mode, encoding='utf-8',
+                       newline='', closefd=False)
+    return io.open(path, mode, encoding='utf-8', newline='')
+
+
+def dump_value(value):
+    if value is None:
+        return None
+    if hasattr(value, 'isoformat'):
+        return value.isoformat()
+    return value
+
+
+def write_entries(rows, stream, fmt):
+    """Write rows to stream as JSON Lines or CSV; return the row count."""
+    count = 0
+    if fmt == 'csv':
+        writer = csv.writer(stream)
+        writer.writerow(FIELDS)
+        for row in rows:
+            writer.writerow([
+                '' if row[name] is None else dump_value(row[name])
+                for name in FIELDS])
+            count += 1
+    else:
+        for row in rows:
+            record = OrderedDict(
+                (name, dump_value(row[name])) for name in FIELDS)
+            stream.write(json.dumps(record, ensure_ascii=False) + u'\n')
+            count += 1
+    return count
+
+
+def parse_date(value):
+    if not value:
+        return None
+    return datetime.strptime(value[:10], '%Y-%m-%d').date()
+
+
+# fields an entry cannot be stored without
+REQUIRED_FIELDS = ('title', 'body', 'creation_date')
+
+
+def parse_entry(record):
+    """Return the entry dict read from record; raise ValueError if invalid."""
+    if not hasattr(record, 'get'):
+        raise ValueError('not an object')
+    entry_id = record.get('id')
+    try:
+        entry = {
+            'id': int(entry_id) if entry_id not in (None, '') else None,
+            'title': record.get('title') or None,
+            'body': record.get('body'),
+            'creation_date': parse_date(record.get('creation_date')),
+            'edit_date': parse_date(record.get('edit_date')),
+        }
+    except (TypeError, ValueError) as e:
+        raise ValueError(str(e))
+    missing = [name for name in REQUIRED_FIELDS if entry[name] is None]
+    if missing:
+        raise ValueError('missing %s' % ', '.join(missing))
+    for name in ('title', 'body'):
+        if not isinstance(entry[name], str):
+            raise ValueError('%s is not text' % name)
+    return entry
+
+
+def read_records(stream, fmt):
+    """Yield (line number, record) for each record in stream.
+
+    A JSON Lines record that does not parse is yielded as the error.
+    """
+    if fmt == 'csv':
+        reader = csv.DictReader(stream)
+        for record in reader:
+            yield reader.line_num, record
+        return
+    for number, line in enumerate(stream, 1):
+        if not line.strip():
+            continue
+        try:
+            yield number, json.loads(line)
+        except ValueError as e:
+            yield number, e
+
+
+def read_entries(stream, fmt, rejected=None):
+    """Lazily yield entry dicts read from stream.
+
+    Records that cannot be stored (one without a title, body or creation
+    date, or with an id or date that does not parse) are skipped, so an
+    import never stops half way; rejected, if given, is called with the
+    record's line number and the reason.
+    """
+    for number, record in read_records(stream, fmt):
+        try:
+            if isinstance(record, ValueError):
+                raise record
+            entry = parse_entry(record)
+        except ValueError as e:
+            if rejected:
+                rejected(number, str(e))
+            continue
+        yield entry
+
+
+def render_rows(rows):
+    """Yield each entry dict with its body's rendered fields added.
+
+    Rows that come with rendered fields of the current renderer are
+    passed on as they are.
+    """
+    for row in rows:
+        if row.get('render_version') != RENDER_VERSION:
+            row = dict(row)
+            row.update(rendered_fields(row['body']))
+        yield row
+
+
+def batched(rows, size):
+    """Yield lists of up to size rows."""
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def upsert_statement(columns):
+    statement = text(UPSERT % {
+        'columns': ', '.join(columns),
+        'values': ', '.join(':' + name for name in columns),
+    })
+    return statement.bindparams(bindparam('creation_date', type_=Date),
+                                bindparam('edit_date', type_=Date))
+
+
+def copy_batch(connection, batch, columns):
+    """Load batch into the staging table with COPY and merge it."""
+    buf = io.StringIO()
+    writer = csv.writer(buf)
+    for row in batch:
+        writer.writerow([u'\\N' if row[name] is None else dump_value(row[name])
+                         for name in columns])
+    buf.seek(0)
+    cursor = connection.connection.cursor()
+    cursor.copy_expert(PG_COPY % ', '.join(columns), buf)
+    connection.execute(text(PG_MERGE % {'columns': ', '.join(columns)}))
+
+
+class Progress(object):
+    """Report rows loaded and throughput to a stream."""
+
+    def __init__(self, stream=sys.stderr, label='imported'):
+        self.stream = stream
+        self.label = label
+        self.count = 0
+        self.started = time.time()
+
+    def rate(self):
+        elapsed = time.time() - self.started
+        return self.count / elapsed if elapsed else float(self.count)
+
+    def __call__(self, rows):
+        self.count += rows
+        self.stream.write('%s %d entries (%.0f/s)\n'
+                          % (self.label, self.count, self.rate()))
+        self.stream.flush()
+
+
+def load_entries(engine, rows, batch_size=1000, use_copy=True,
+                 keep_ids=False, progress=None, finish=True):
+    """Upsert entry dicts into the journal in batches.
+
+    Each batch commits on its own. Entries are matched on title; a title
+    seen again updates the body and dates and bumps the entry's version.
+    Bodies are rendered here, since these writes bypass the ORM.
+    Unless finish is false, ``finish_load`` runs once the rows are in.
+    Returns the number of entries written.
+    """
+    dialect = engine.dialect.name
+    if dialect not in ('sqlite', 'postgresql'):
+        raise UnsupportedDatabase('bulk import', dialect)
+    columns = [name for name in FIELDS if keep_ids or name != 'id']
+    columns.extend(RENDERED_FIELDS)
+    use_copy = use_copy and dialect == 'postgresql'
+    statement = upsert_statement(columns)
+    count = 0
+    with engine.connect() as connection:
+        if use_copy:
+            connection.execute(text(PG_STAGING))
+        for batch in batched(render_rows(row for row in rows
+                                         if row['title']),
+                             batch_size):
+            # a title may only be written once per statement
+            batch = list(OrderedDict(
+                (row['title'], row) for row in batch).values())
+            with connection.begin():
+                if use_copy:
+                    copy_batch(connection, batch, columns)
+                else:
+                    connection.execute(statement, batch)
+            count += len(batch)
+            if progress:
+                progress(len(batch))
+        if keep_ids and dialect == 'postgresql':
+            connection.execute(text(PG_RESET_SEQUENCE))
+    if finish:
+        finish_load(engine)
+    return count
+
+
+def finish_load(engine):
+    """Recount the archive and bump the journal version after a load."""
+    session = get_session_factory(engine)()
+    try:
+        # recount the archive once rather than per row
+        rebuild_archive(session)
+        bump_journal_version(session)
+        session.commit()
+    finally:
+        session.close()
+
+
+def get_settings(config_uri, options):
+    setup_logging(config_uri)
+    settings = get_appsettings(config_uri, options=options)
+    return settings_from_environ(settings)
+
+
+def parse_args(argv, description):
+    parser = argparse.ArgumentParser(prog=os.path.basename(argv[0]),
+                                     description=description)
+    parser.add_argument('config_uri', help='e.g. development.ini')
+    parser.add_argument('path', help='file to read or write, - for stdio')
+    parser.add_argument('options', nargs='*', metavar='var=value',
+                        help='settings overrides')
+    parser.add_argument('--format', choices=FORMATS,
+                        help='defaults to the file extension, then jsonl')
+    parser.add_argument('--batch-size', type=int, default=1000)
+    return parser
+
+
+def export_main(argv=sys.argv):
+    parser = parse_args(argv, 'Export journal entries.')
+    args = parser.parse_args(argv[1:])
+    settings = get_settings(args.config_uri, parse_vars(args.options))
+    engine = get_engine(settings)
+    fmt = guess_format(args.path, args.format)
+    started = time.time()
+    with engine.connect() as connection, \
+            open_stream(args.path, 'w') as stream:
+        count = write_entries(iter_entries(connection, args.batch_size),
+                              stream, fmt)
+    elapsed = time.time() - started
+    sys.stderr.write('exported %d entries in %.1fs\n' % (count, elapsed))
+
+
+def import_main(argv=sys.argv):
+    parser = parse_args(argv, 'Import journal entries, upserting on title.')
+    parser.add_argument('--keep-ids', action='store_true',
+                        help='keep the ids from the file')
+    parser.add_argument('--no-copy', action='store_true',
+                        help='use executemany instead of COPY on PostgreSQL')
+    args = parser.parse_args(argv[1:])
+    settings = get_settings(args.config_uri, parse_vars(args.options))
+    engine = get_engine(settings)
+    fmt = guess_format(args.path, args.format)
+    progress = Progress()
+    skipped = []
+
+    def rejected(number, reason):
+        skipped.append(number)
+        sys.stderr.write('skipped line %d: %s\n' % (number, reason))
+
+    with open_stream(args.path, 'r') as stream:
+        load_entries(engine, read_entries(stream, fmt, rejected),
+                     batch_size=args.batch_size,
+                     use_copy=not args.no_copy,
+                     keep_ids=args.keep_ids,
+                     progress=progress)
+    sys.stderr.write('imported %d entries in %.1fs (%.0f/s)\n'
+                     % (progress.count, time.time() - progress.started,
+                        progress.rate()))
+    if skipped:
+        sys.stderr.write('skipped %d invalid entries\n' % len(skipped))
+        return 1
@@ -1,10 +1,12 @@
+import math
 import os
 from pyramid.authentication import AuthTktAuthenticationPolicy
 from pyramid.authorization import ACLAuthorizationPolicy
+from pyramid.httpexceptions import HTTPTooManyRequests
 from pyramid.security import Allow, Everyone, Authenticated
 from pyramid.session import SignedCookieSessionFactory
 
-from passlib.apps import custom_app_context as pwd_context
+from .loginguard import LoginThrottled, login_guard_from_settings
 
 
 class MyRoot(object):
@@ -17,12 +19,34 @@ class MyRoot(object):
 
 
 def check_credentials(username, password):
+    # passlib is slow to import and only needed once someone logs in
+    from passlib.apps import custom_app_context as pwd_context
     if username and password:
         if username == os.environ['AUTH_USERNAME']:
             return pwd_context.verify(password, os.environ['AUTH_PASSWORD'])
     return False
 
 
+def verify_login(request, username, password):
+    """Check credentials through the registry's login guard, if any.
+
+    Raises HTTPTooManyRequests, with a Retry-After header, for attempts
+    the guard turns away. Clients are told apart by the address they
+    connected from, never by X-Forwarded-For, which they can set to
+    anything; behind a proxy, waitress's ``trusted_proxy`` settings put
+    the address the proxy saw in REMOTE_ADDR.
+    """
+    guard = request.registry.get('login_guard')
+    if guard is None:
+        return check_credentials(username, password)
+    try:
+        return guard.verify(request.remote_addr, username, password)
+    except LoginThrottled as e:
+        raise HTTPTooManyRequests(
+            detail='Too many login attempts, try again later.',
+            headers={'Retry-After': str(int(math.ceil(e.retry_after)))})
+
+
 def includeme(config):
     """Pyramid security configuration."""
     auth_secret = os.environ.get('AUTH_SECRET', 'donttellanyone')
@@ -38,3 +62,5 @@ def includeme(config):
     session_factory = SignedCookieSessionFactory(session_secret)
     config.set_session_factory(session_factory)
     config.set_default_csrf_options(require_csrf=True)
+    config.registry['login_guard'] = login_guard_from_settings(
+        config.get_settings(), check_credentials)
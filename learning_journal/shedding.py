@@ -0,0 +1,235 @@
+"""Turn requests away quickly when the process is overloaded.
+
+A tween near the top of the stack counts the requests in progress and
+reads how long each one queued before a thread picked it up, from the
+``X-Request-Start`` header. With ``runapp.py``, ``QueueTimingDispatcher``
+sets it when waitress queues the request, replacing any value the client
+sent, unless ``shed.trusted_router`` says a router in front sets it from
+when the router received the request. Requests fall into three classes:
+
+- ``admin``: writes by a logged in user.
+- ``cheap``: anonymous GETs of the pages the page cache and conditional
+  responses answer (``shed.cheap_routes``).
+- ``expensive``: everything else.
+
+Each class is turned away with a ``503`` and ``Retry-After`` once the
+requests in progress reach its limit or it has queued longer than its
+wait limit. The limits of expensive requests are the lowest, so the last
+threads are kept for cheap reads and admin writes. ``/_stats`` reports
+the shedder's state under ``load_shedding`` for tuning the limits.
+"""
+import threading
+import time
+
+from pyramid.interfaces import IRoutesMapper
+from pyramid.response import Response
+from pyramid.settings import asbool, aslist
+from pyramid.tweens import INGRESS
+from waitress.task import ThreadedTaskDispatcher
+
+CLASSES = ('admin', 'cheap', 'expensive')
+
+# waitress's name for the X-Request-Start header
+WAITRESS_HEADER = 'X_REQUEST_START'
+
+# queue waits longer than this come from clocks that disagree
+MAX_QUEUE_WAIT = 3600
+
+DEFAULT_CHEAP_ROUTES = ('home', 'detail', 'archive_year', 'archive_month',
+                        'feed')
+
+
+def queue_wait(value, now):
+    """Return the seconds since an X-Request-Start value, or None.
+
+    The value is a Unix time in seconds, milliseconds or microseconds,
+    optionally prefixed by ``t=``.
+    """
+    if not value:
+        return None
+    if value.startswith('t='):
+        value = value[2:]
+    try:
+        started = float(value)
+    except ValueError:
+        return None
+    if started > 1e14:
+        started /= 1e6
+    elif started > 1e11:
+        started /= 1e3
+    wait = now - started
+    if wait > MAX_QUEUE_WAIT:
+        return None
+    return max(wait, 0.0)
+
+
+class LoadShedder(object):
+    """Requests in progress and queue waits, with the limits of each class.
+
+    in_flight and queue_wait map each class to its limit: the number of
+    requests in progress, and the seconds queued, at which a request of
+    that class is turned away.
+    """
+
+    def __init__(self, in_flight, queue_wait, retry_after=5,
+                 cheap_routes=DEFAULT_CHEAP_ROUTES):
+        self.in_flight_limits = in_flight
+        self.queue_wait_limits = queue_wait
+        self.retry_after = retry_after
+        self.cheap_routes = frozenset(cheap_routes)
+        self.in_flight = 0
+        self.peak_in_flight = 0
+        self.admitted = dict((name, 0) for name in CLASSES)
+        self.shed = dict((name, {'in_flight': 0, 'queue_wait': 0})
+                         for name in CLASSES)
+        self.last_queue_wait = None
+        self.max_queue_wait = 0.0
+        self._lock = threading.Lock()
+
+    def classify(self, request, mapper):
+        """Return the class of request."""
+        if request.method not in ('GET', 'HEAD'):
+            return 'admin' if request.authenticated_userid else 'expensive'
+        route = mapper(request)['route'] if mapper is not None else None
+        if route is None or route.name not in self.cheap_routes:
+            return 'expensive'
+        # signed-in users skip the page cache and conditional responses,
+        # so even their revalidations render the whole page
+        if request.authenticated_userid:
+            return 'expensive'
+        return 'cheap'
+
+    def admit(self, kind, wait):
+        """Count a request of kind in, or return why it is turned away."""
+        with self._lock:
+            if wait is not None:
+                self.last_queue_wait = wait
+                self.max_queue_wait = max(self.max_queue_wait, wait)
+                if wait >= self.queue_wait_limits[kind]:
+                    self.shed[kind]['queue_wait'] += 1
+                    return 'queue_wait'
+            if self.in_flight >= self.in_flight_limits[kind]:
+                self.shed[kind]['in_flight'] += 1
+                return 'in_flight'
+            self.in_flight += 1
+            self.peak_in_flight = max(self.peak_in_flight, self.in_flight)
+            self.admitted[kind] += 1
+        return None
+
+    def release(self):
+        with self._lock:
+            self.in_flight -= 1
+
+    def stats(self):
+        with self._lock:
+            return {
+                'in_flight': self.in_flight,
+                'peak_in_flight': self.peak_in_flight,
+                'admitted': dict(self.admitted),
+                'shed': dict((kind, dict(reasons))
+                             for kind, reasons in self.shed.items()),
+                'last_queue_wait': self.last_queue_wait,
+                'max_queue_wait': self.max_queue_wait,
+                'limits': {
+                    'in_flight': dict(self.in_flight_limits),
+                    'queue_wait': dict(self.queue_wait_limits),
+                },
+            }
+
+
+def overloaded(retry_after):
+    response = Response(status=503, content_type='text/plain',
+                        body=b'The journal is busy, try again shortly.\n')
+    response.headers['Retry-After'] = str(retry_after)
+    response.cache_control.no_store = True
+    return response
+
+
+def load_shedding_tween_factory(handler, registry):
+    shedder = registry.get('load_shedder')
+    if shedder is None:
+        return handler
+    mapper = registry.queryUtility(IRoutesMapper)
+    metrics = registry.get('metrics')
+
+    def load_shedding_tween(request):
+        now = time.time()
+        wait = queue_wait(request.headers.get('X-Request-Start'), now)
+        kind = shedder.classify(request, mapper)
+        reason = shedder.admit(kind, wait)
+        if metrics is not None and wait is not None:
+            metrics.observe('lj_request_queue_wait_seconds', wait)
+        if reason is not None:
+            if metrics is not None:
+                metrics.inc('lj_shed_requests_total',
+                            (('class', kind), ('reason', reason)))
+            return overloaded(shedder.retry_after)
+        try:
+            return handler(request)
+        finally:
+            shedder.release()
+
+    return load_shedding_tween
+
+
+class QueueTimingDispatcher(ThreadedTaskDispatcher):
+    """waitress dispatcher stamping requests with the time they queued.
+
+    The stamp is sent to the app as ``X-Request-Start``. It replaces the
+    value a client sent, which could be stale (shedding the request) or
+    in the future (hiding its wait), unless trusted_router says a router
+    in front sets the header from when it received the request.
+    """
+
+    def __init__(self, trusted_router=False):
+        super(QueueTimingDispatcher, self).__init__()
+        self.trusted_router = trusted_router
+
+    def add_task(self, task):
+        stamp = 't=%.6f' % time.time()
+        for request in getattr(task, 'requests', ()):
+            if self.trusted_router:
+                request.headers.setdefault(WAITRESS_HEADER, stamp)
+            else:
+                request.headers[WAITRESS_HEADER] = stamp
+        super(QueueTimingDispatcher, self).add_task(task)
+
+
+def dispatcher_from_settings(settings):
+    """Create the QueueTimingDispatcher the ``shed.*`` settings describe."""
+    return QueueTimingDispatcher(
+        trusted_router=asbool(settings.get('shed.trusted_router', False)))
+
+
+def shedder_from_settings(settings):
+    """Create the LoadShedder the ``shed.*`` settings describe, or None."""
+    if not asbool(settings.get('shed.enabled', True)):
+        return None
+    in_flight = {
+        'admin': int(settings.get('shed.max_in_flight', 8)),
+        'cheap': int(settings.get('shed.cheap_in_flight', 7)),
+        'expensive': int(settings.get('shed.expensive_in_flight', 4)),
+    }
+    wait = {
+        'admin': float(settings.get('shed.admin_queue_wait', 10)),
+        'cheap': float(settings.get('shed.cheap_queue_wait', 2)),
+        'expensive': float(settings.get('shed.expensive_queue_wait', 0.5)),
+    }
+    routes = aslist(settings.get('shed.cheap_routes', ''))
+    return LoadShedder(in_flight, wait,
+                       retry_after=int(settings.get('shed.retry_after', 5)),
+                       cheap_routes=routes or DEFAULT_CHEAP_ROUTES)
+
+
+def includeme(config):
+    """Set up load shedding.
+
+    Activate it using ``config.include('learning_journal.shedding')``.
+    """
+    config.registry['load_shedder'] = shedder_from_settings(
+        config.get_settings())
+    # just inside the static assets, which are always cheap
+    config.add_tween(
+        'learning_journal.shedding.load_shedding_tween_factory',
+        under=('learning_journal.assets.static_assets_tween_factory',
+               INGRESS))
@@ -0,0 +1,289 @@
+"""Export the public site as a directory of static files.
+
+``build_snapshot`` renders the pages a signed-out visitor sees (the home
+page, every entry, the archive, the feeds and the 404 page) through the
+real app, as a file server or CDN would need them:
+
+    /                   index.html
+    /journal/5          journal/5.html
+    /archive/2016/12    archive/2016/12.html
+    /feed.atom          feed.atom
+
+plus a copy of the static assets. Serve ``<path>.html`` for extensionless
+paths and ``404.html`` for anything missing.
+
+A manifest, ``snapshot.json``, records the day of the build and the
+entries it rendered. The next build only renders the entries created or
+edited since that day, or missing from the manifest, along with the
+listings that show them; pages of deleted entries are removed. Pages are
+rendered by a pool of processes, each running its own copy of the app.
+"""
+import json
+import multiprocessing
+import os
+import shutil
+import tempfile
+import time
+from datetime import date, datetime
+
+from pyramid.paster import get_app, get_appsettings
+from pyramid.request import Request
+from sqlalchemy import or_
+
+from .assets import static_root
+from .models import (
+    Entry,
+    get_engine,
+    get_session_factory,
+    settings_from_environ,
+)
+from .models.archivemodel import get_archive
+
+MANIFEST = 'snapshot.json'
+# bump when the manifest or the file layout changes
+SNAPSHOT_FORMAT = 1
+DEFAULT_BASE_URL = 'http://localhost'
+# no route matches this, so it renders the not found page
+NOT_FOUND_PATH = '/404.html'
+LISTING_PATHS = ('/', '/feed.atom', '/feed.rss')
+# settings for the apps rendering the snapshot: every page is rendered
+# once, so a page cache or a warm-up would only cost time
+SNAPSHOT_SETTINGS = {
+    'page_cache.backend': 'none',
+    'templates.warmup': 'false',
+}
+
+
+def page_file(path):
+    """Return the file, relative to the snapshot, holding path's page."""
+    name = path.strip('/')
+    if not name:
+        return 'index.html'
+    if '.' in name.rsplit('/', 1)[-1]:
+        return name
+    return name + '.html'
+
+
+def write_file(root, name, body):
+    """Write body to root/name, replacing any earlier copy atomically."""
+    path = os.path.join(root, *name.split('/'))
+    directory = os.path.dirname(path)
+    if not os.path.isdir(directory):
+        try:
+            os.makedirs(directory)
+        except OSError:
+            pass  # another worker created it first
+    fd, tmp = tempfile.mkstemp(dir=directory)
+    with os.fdopen(fd, 'wb') as f:
+        f.write(body)
+    os.chmod(tmp, 0o644)
+    os.rename(tmp, path)
+
+
+def remove_file(root, name):
+    try:
+        os.remove(os.path.join(root, *name.split('/')))
+    except OSError:
+        pass
+
+
+def render_pages(app, paths, root, base_url):
+    """Render paths through app into root; return [(path, status), ...].
+
+    Pages that no longer exist are removed from the snapshot.
+    """
+    results = []
+    for path in paths:
+        response = Request.blank(path, base_url=base_url).get_response(app)
+        name = page_file(path)
+        if response.status_int == 200 or path == NOT_FOUND_PATH:
+            write_file(root, name, response.body)
+        else:
+            remove_file(root, name)
+        results.append((path, response.status_int))
+    return results
+
+
+def snapshot_app(config_uri, options=None):
+    """Load the app described by config_uri, set up for exporting."""
+    settings = dict(SNAPSHOT_SETTINGS)
+    settings.update(options or {})
+    return get_app(config_uri, options=settings)
+
+
+# the app of each worker process, loaded once by init_worker
+worker = {}
+
+
+def init_worker(config_uri, options, root, base_url):
+    worker.update(app=snapshot_app(config_uri, options), root=root,
+                  base_url=base_url)
+
+
+def render_in_worker(paths):
+    return render_pages(worker['app'], paths, worker['root'],
+                        worker['base_url'])
+
+
+def chunked(items, size):
+    return [items[i:i + size] for i in range(0, len(items), size)]
+
+
+def copy_static(root):
+    """Copy the static assets into root/static; return the files copied."""
+    source = static_root()
+    copied = 0
+    for directory, _, files in os.walk(source):
+        target = os.path.join(root, 'static',
+                              os.path.relpath(directory, source))
+        if not os.path.isdir(target):
+            os.makedirs(target)
+        for name in files:
+            src = os.path.join(directory, name)
+            dst = os.path.join(target, name)
+            stat = os.stat(src)
+            if os.path.exists(dst):
+                copy = os.stat(dst)
+                if (copy.st_size, int(copy.st_mtime)) == (
+                        stat.st_size, int(stat.st_mtime)):
+                    continue
+            shutil.copy2(src, dst)
+            copied += 1
+    return copied
+
+
+def load_manifest(root):
+    """Return the manifest of the snapshot in root, or None."""
+    try:
+        with open(os.path.join(root, MANIFEST)) as f:
+            manifest = json.load(f)
+    except (IOError, OSError, ValueError):
+        return None
+    if manifest.get('format') != SNAPSHOT_FORMAT:
+        return None
+    return manifest
+
+
+def save_manifest(root, manifest):
+    write_file(root, MANIFEST, json.dumps(
+        manifest, indent=1, sort_keys=True).encode('utf-8'))
+
+
+def archive_paths(archive, months=None):
+    """Return the archive pages, or only those of months and their years.
+
+    months is a set of (year, month) pairs.
+    """
+    paths = []
+    for year, counts in archive:
+        shown = [month for month, _ in counts
+                 if months is None or (year, month) in months]
+        if shown:
+            paths.append('/archive/%d' % year)
+            paths.extend('/archive/%d/%02d' % (year, month)
+                         for month in shown)
+    return paths
+
+
+def plan_build(dbsession, manifest):
+    """Work out what to render and remove since the manifest's build.
+
+    Returns (paths to render, paths to remove, manifest of the new
+    build). Without a manifest, everything is rendered.
+    """
+    rows = dbsession.query(Entry.id, Entry.creation_date).all()
+    ids = sorted(row.id for row in rows)
+    archive = get_archive(dbsession)
+    every_archive_path = archive_paths(archive)
+    built = {
+        'format': SNAPSHOT_FORMAT,
+        'built': date.today().isoformat(),
+        'entries': ids,
+        'archive': every_archive_path,
+    }
+    if manifest is None:
+        paths = list(LISTING_PATHS) + [NOT_FOUND_PATH]
+        paths.extend('/journal/%d' % entry_id for entry_id in ids)
+        paths.extend(every_archive_path)
+        return paths, [], built
+    before = set(manifest['entries'])
+    removed = ['/journal/%d' % entry_id
+               for entry_id in sorted(before.difference(ids))]
+    removed.extend(sorted(set(manifest['archive']).difference(
+        every_archive_path)))
+    # dates are days, so entries changed on the day of the last build
+    # are rendered again; that is cheaper than missing one
+    since = datetime.strptime(manifest['built'], '%Y-%m-%d').date()
+    changed = set(row.id for row in dbsession.query(Entry.id).filter(or_(
+        Entry.creation_date >= since, Entry.edit_date >= since)))
+    changed.update(entry_id for entry_id in ids if entry_id not in before)
+    if not changed and not removed:
+        return [], [], built
+    paths = list(LISTING_PATHS)
+    paths.extend('/journal/%d' % entry_id for entry_id in sorted(changed))
+    if removed or changed.difference(before):
+        # the counts in every archive page's calendar changed
+        paths.extend(every_archive_path)
+    else:
+        dates = dict((row.id, row.creation_date) for row in rows)
+        paths.extend(archive_paths(archive, set(
+            (dates[i].year, dates[i].month) for i in changed)))
+    return paths, removed, built
+
+
+def build_snapshot(config_uri, root, base_url=DEFAULT_BASE_URL,
+                   options=None, processes=None, full=False,
+                   chunk_size=50):
+    """Render the site described by config_uri into root.
+
+    The first build, and any build with full or a different base_url,
+    renders every page. Returns a summary of the build.
+    """
+    started = time.time()
+    settings = settings_from_environ(get_appsettings(
+        config_uri, options=options))
+    manifest = load_manifest(root)
+    if full or manifest is None or manifest.get('base_url') != base_url:
+        manifest = None
+    engine = get_engine(settings)
+    session = get_session_factory(engine)()
+    try:
+        paths, removed, built = plan_build(session, manifest)
+    finally:
+        session.close()
+        # forked workers must not share the parent's connections
+        engine.dispose()
+    for path in removed:
+        remove_file(root, page_file(path))
+    processes = processes or multiprocessing.cpu_count()
+    results = []
+    if len(paths) <= chunk_size or processes == 1:
+        app = snapshot_app(config_uri, options)
+        results = render_pages(app, paths, root, base_url)
+    else:
+        pool = multiprocessing.Pool(
+            processes, initializer=init_worker,
+            initargs=(config_uri, options, root, base_url))
+        try:
+            for chunk in pool.imap_unordered(render_in_worker,
+                                             chunked(paths, chunk_size)):
+                results.extend(chunk)
+        finally:
+            pool.close()
+            pool.join()
+    failed = [(path, status) for path, status in results
+              if status >= 500]
+    if failed:
+        # leave the manifest alone so the next build tries again
+        raise RuntimeError('could not render %s' % ', '.join(
+            '%s (%d)' % item for item in failed))
+    copied = copy_static(root)
+    built['base_url'] = base_url
+    save_manifest(root, built)
+    return {
+        'full': manifest is None,
+        'rendered': len(results),
+        'removed': len(removed),
+        'static_files': copied,
+        'seconds': time.time() - started,
+    }
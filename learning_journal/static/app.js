@@ -4,18 +4,25 @@ $(document).ready(function(){
         e.preventDefault();
         $.ajax({
             type: 'POST',
-            url: '/',
+            url: form.attr('action') || window.location.pathname,
             data: form.serialize(),
-            success: function(e){
-                console.log("created new entry");
-                href = $('div.entries.container a:first-of-type').attr('href').split('/').slice(1)
-                console.log(href)
-                href[href.length - 1]++
-                href = '/' + href.join('/')
-                $("div.entries.container").prepend('<article><h6 class="date">'+ $("#date").val() +'</h6><section><a href="'+ href +'"><h4>'+ $('.title_input').val() +'</h4></a></section></article>')
-                $(".title_input").val("")
-                $("#new_entry_form textarea").val("")
+            dataType: 'json',
+            success: function(data){
+                console.log("created new entry " + data.id);
+                $("div.entries.container").prepend(data.html);
+                $(".title_input").val("");
+                $("#new_entry_form textarea").val("");
+                $("#new_entry_form .errors").remove();
+            },
+            error: function(xhr){
+                var errors = (xhr.responseJSON || {}).errors || {};
+                var messages = $.map(errors, function(message){
+                    return message;
+                });
+                $("#new_entry_form .errors").remove();
+                form.prepend($('<p class="errors">').text(
+                    messages.join(' ') || 'The entry could not be saved.'));
             }
         });
     });
-});
\ No newline at end of file
+});
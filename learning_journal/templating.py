@@ -0,0 +1,119 @@
+"""Template precompilation and warm-up for faster cold starts.
+
+Jinja2 compiles a template the first time it is rendered, so the first
+request after a restart pays for every template it touches, and every
+process pays again. With ``jinja2.bytecode_caching`` on, pyramid_jinja2
+keeps the compiled code in ``jinja2.bytecode_caching_directory``, which
+every process on the host can share.
+
+``templates.precompile`` compiles every template under
+``learning_journal/templates`` into that cache at startup, under the
+names the renderers load them by. ``templates.warmup`` goes further and
+renders the pages listed in ``templates.warmup_paths`` once through the
+finished app, before the server accepts traffic.
+"""
+import logging
+import os
+import time
+
+from jinja2 import TemplateNotFound, meta
+from pyramid.path import AssetResolver
+from pyramid.request import Request
+from pyramid.settings import asbool, aslist
+
+from .cache import BYPASS_ENVIRON_KEY
+
+log = logging.getLogger(__name__)
+
+TEMPLATES_SPEC = 'learning_journal:templates/'
+TEMPLATE_EXTENSION = '.jinja2'
+
+# one page per template a signed-out visitor can reach
+DEFAULT_WARMUP_PATHS = ('/', '/journal/1', '/search?q=warmup', '/login',
+                        '/journal/new-entry', '/_warmup/not-found')
+
+
+def template_names(spec=TEMPLATES_SPEC):
+    """Return the asset spec of every template under spec."""
+    directory = AssetResolver().resolve(spec).abspath()
+    return sorted(spec + name for name in os.listdir(directory)
+                  if name.endswith(TEMPLATE_EXTENSION))
+
+
+def precompile(environment, names):
+    """Compile names, and the templates they pull in, into the cache.
+
+    Templates that extend, include or import another template load it
+    under a name relative to their own, so those are compiled by
+    following the references rather than by file. Returns the number of
+    templates compiled.
+    """
+    seen = set()
+    pending = list(names)
+    while pending:
+        name = pending.pop()
+        if name in seen:
+            continue
+        seen.add(name)
+        try:
+            source = environment.loader.get_source(environment, name)[0]
+        except TemplateNotFound:
+            log.warning('cannot precompile missing template %s', name)
+            continue
+        environment.get_template(name)
+        for reference in meta.find_referenced_templates(
+                environment.parse(source)):
+            if reference is not None:
+                pending.append(environment.join_path(reference, name))
+    return len(seen)
+
+
+def warm_up(app, paths=DEFAULT_WARMUP_PATHS):
+    """Render each of paths once through app; return the seconds taken.
+
+    The pages bypass the page cache: they are rendered for a blank
+    request's host, not for the visitors who would be served them.
+    """
+    started = time.time()
+    for path in paths:
+        try:
+            request = Request.blank(path, {BYPASS_ENVIRON_KEY: True})
+            response = request.get_response(app)
+        except Exception:
+            log.exception('warm-up request for %s failed', path)
+            continue
+        log.debug('warmed up %s (%s)', path, response.status)
+    return time.time() - started
+
+
+def warm_up_from_settings(app, settings):
+    """Warm up app if ``templates.warmup`` is on."""
+    if not asbool(settings.get('templates.warmup', False)):
+        return
+    paths = aslist(settings.get('templates.warmup_paths', '')) or \
+        DEFAULT_WARMUP_PATHS
+    log.info('warmed up %d pages in %.3fs', len(paths), warm_up(app, paths))
+
+
+def includeme(config):
+    """Set up the template bytecode cache and precompilation.
+
+    Activate it using ``config.include('learning_journal.templating')``
+    after ``pyramid_jinja2``.
+    """
+    settings = config.get_settings()
+    directory = settings.get('jinja2.bytecode_caching_directory')
+    if asbool(settings.get('jinja2.bytecode_caching', False)) and directory:
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    if asbool(settings.get('templates.precompile', False)):
+        def precompile_templates():
+            started = time.time()
+            count = precompile(config.get_jinja2_environment(),
+                               template_names())
+            log.info('precompiled %d templates in %.3fs',
+                     count, time.time() - started)
+
+        # after pyramid_jinja2 has created the environment
+        config.action(None, precompile_templates, order=999)
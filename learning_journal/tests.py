@@ -6,6 +6,7 @@ from pyramid.httpexceptions import HTTPFound, HTTPNotFound
 from zope.interface.interfaces import ComponentLookupError
 from passlib.apps import custom_app_context as pwd_context
 from pyramid.security import Allow, Everyone, Authenticated
+from .models.archivemodel import rebuild_archive
 from .models.meta import Base
 from pyramid import testing
 import faker
@@ -117,11 +118,49 @@ def test_entries_are_added(db_session):
 
 
 def test_home_view_filled(dummy_request, add_models):
-    """Test home_view returns all entries."""
-    from .views.default import home_view
+    """Test home_view returns the newest page of entries."""
+    from .views.default import home_view, DEFAULT_PAGE_SIZE
     res = home_view(dummy_request)
     entries = res['left_entries'] + res['right_entries'] + [res['latest']]
-    assert len(entries) == len(ENTRIES)
+    assert len(entries) == DEFAULT_PAGE_SIZE
+    assert res['latest'].id == len(ENTRIES)
+    assert res['newer'] is None
+    assert 'before=%d' % (len(ENTRIES) - DEFAULT_PAGE_SIZE + 1) in res['older']
+
+
+def test_home_view_before_pages_backwards(dummy_request, add_models):
+    """Test home_view lists entries older than the before cursor."""
+    from .views.default import home_view, DEFAULT_PAGE_SIZE
+    dummy_request.params['before'] = '31'
+    res = home_view(dummy_request)
+    ids = [res['latest'].id] + [e.id for e in res['left_entries']]
+    assert res['latest'].id == 30
+    assert min(ids + [e.id for e in res['right_entries']]) == 11
+    assert 'before=%d' % (31 + DEFAULT_PAGE_SIZE) in res['newer']
+    assert not hasattr(res['latest'], 'body')
+
+
+@pytest.mark.parametrize('before', [u'\u00b2', '99999999999999999999999',
+                                    '-1', 'abc'])
+def test_home_view_ignores_an_invalid_cursor(dummy_request, add_models,
+                                              before):
+    """Test a cursor that is not an entry id lists the newest page."""
+    from .views.default import home_view
+    dummy_request.params['before'] = before
+    res = home_view(dummy_request)
+    assert res['latest'].id == len(ENTRIES)
+    assert res['newer'] is None
+
+
+def test_home_view_lists_one_entry_when_page_size_is_too_small(
+        dummy_request, add_models, monkeypatch):
+    """Test a page_size below one still lists a page."""
+    from .views.default import home_view
+    monkeypatch.setattr(dummy_request.registry, 'settings',
+                        {'journal.page_size': '0'})
+    res = home_view(dummy_request)
+    assert res['latest'].id == len(ENTRIES)
+    assert 'before=%d' % len(ENTRIES) in res['older']
 
 
 def test_detail_view(dummy_request, add_models):
@@ -197,6 +236,428 @@ def test_create_view_post(dummy_request):
     assert 'datetime' in str(type(entry.creation_date))
 
 
+def test_create_view_rejects_invalid_form(dummy_request, add_models):
+    """Test a blank body or a title already taken answers 400."""
+    from pyramid.httpexceptions import HTTPBadRequest
+    from .views.default import create_view
+    dummy_request.method = 'POST'
+    dummy_request.POST['title'] = ENTRIES[0].title
+    dummy_request.POST['body'] = ' '
+    dummy_request.POST['creation_date'] = ''
+    with pytest.raises(HTTPBadRequest) as info:
+        create_view(dummy_request)
+    assert 'already has this title' in info.value.detail
+    assert 'body is required' in info.value.detail
+
+
+def test_lru_cache_evicts_least_recently_used():
+    """Test the page cache keeps at most max_entries keys."""
+    from .cache import LRUCache
+    cache = LRUCache(max_entries=2)
+    cache.set(('home', '', ''), 'a')
+    cache.set(('detail', '1', ''), 'b')
+    cache.get(('home', '', ''))
+    cache.set(('detail', '2', ''), 'c')
+    assert cache.get(('detail', '1', '')) is None
+    assert cache.get(('home', '', '')) == 'a'
+    assert cache.stats()['hits'] == 2
+
+
+def test_lru_cache_expires_and_deletes_namespaces():
+    """Test stale keys miss and namespaces are dropped together."""
+    from .cache import LRUCache
+    cache = LRUCache(ttl=-1)
+    cache.set(('home', '', ''), 'a')
+    assert cache.get(('home', '', '')) is None
+    cache.ttl = 60
+    cache.set(('home', '', ''), 'a')
+    cache.set(('home', '', '31'), 'b')
+    cache.set(('detail', '1', ''), 'c')
+    cache.delete_namespace('home')
+    assert len(cache) == 1
+
+
+def test_file_cache_round_trip(tmpdir):
+    """Test the shared file cache stores, reads and invalidates pages."""
+    from .cache import FileCache, invalidate_entry
+    cache = FileCache(str(tmpdir))
+    host = 'http://localhost'
+    cache.set(('detail', '3', '', host), ('200 OK', [], b'page'))
+    cache.set(('home', '', '', host), ('200 OK', [], b'home'))
+    assert FileCache(str(tmpdir)).get(('detail', '3', '', host)) == (
+        '200 OK', [], b'page')
+    invalidate_entry(cache, 3, host)
+    assert cache.get(('detail', '3', '', host)) is None
+    assert cache.get(('home', '', '', host)) is None
+
+
+def test_page_caches_keep_the_newest_journal_version(tmpdir):
+    """Test pages rendered before a write miss, and never replace newer."""
+    from .cache import FileCache, LRUCache
+    for cache in (LRUCache(), FileCache(str(tmpdir))):
+        cache.set(('home', '', ''), 'old', 4)
+        assert cache.get(('home', '', ''), 4) == 'old'
+        assert cache.get(('home', '', ''), 3) == 'old'
+        assert cache.get(('home', '', ''), 5) is None
+        cache.set(('home', '', ''), 'new', 5)
+        assert cache.get(('home', '', ''), 5) == 'new'
+    memory = LRUCache()
+    memory.set(('home', '', ''), 'new', 5)
+    memory.set(('home', '', ''), 'lagging', 4)
+    assert memory.get(('home', '', ''), 4) == 'new'
+
+
+def test_entry_cache_is_bounded_by_size_and_journal_version():
+    """Test records are evicted by size and dropped when the journal moves."""
+    from .cache import EntryCache, record_size
+    from .models.entrymodel import EntryRecord
+    records = [EntryRecord(i, u'Title %d' % i, u'x' * 100, u'<p>x</p>',
+                           datetime.date(2017, 1, 2), None, 1)
+               for i in range(4)]
+    cache = EntryCache(max_bytes=record_size(records[0]) * 3,
+                       check_interval=60)
+    assert cache.check(lambda: 7) == 7
+    for record in records[:3]:
+        cache.set(record, 7)
+    assert cache.get(0) == records[0]
+    cache.set(records[3], 7)
+    assert cache.get(1) is None
+    assert [cache.get(i) is not None for i in (0, 2, 3)] == [True] * 3
+    assert cache.check(lambda: 8) == 7
+    cache.checked_at = 0
+    assert cache.check(lambda: 8) == 8
+    assert len(cache) == 0
+    cache.set(records[0], 7)
+    assert cache.get(0) is None
+    stats = cache.stats()
+    assert (stats['hits'], stats['misses']) == (4, 2)
+    assert (stats['evictions'], stats['invalidations']) == (1, 1)
+
+
+def test_detail_and_edit_pages_read_cached_records(set_auth_credentials,
+                                                   testapp, fill_db):
+    """Test edits reach the entry cache and the stats report its use."""
+    cache = testapp.app.registry['entry_cache']
+    testapp.post('/login', params={'username': 'Bill', 'password': 'pass'})
+    testapp.get('/journal/5')
+    testapp.get('/journal/5/edit-entry')
+    assert cache.stats()['hits'] == 1
+    form = testapp.get('/journal/5/edit-entry').forms[0]
+    form['title'] = 'Edited through the cache'
+    form.submit(status=302)
+    assert cache.get(5) is None
+    assert 'Edited through the cache' in testapp.get('/journal/5').text
+    stats = testapp.get('/_stats').json['entry_cache']
+    assert stats['entries'] == 1
+    assert stats['bytes'] > 0
+
+
+def test_search_entries_ranks_and_highlights(db_session):
+    """Test full-text search finds entries through the index."""
+    from .models.search import count_matches, search_entries, highlight
+    db_session.add_all([
+        Entry(title='Heaps', body='a binary heap is a tree',
+              creation_date=datetime.date(2016, 12, 20)),
+        Entry(title='Binary search trees', body='binary binary binary',
+              creation_date=datetime.date(2016, 12, 21)),
+        Entry(title='Deques', body='double ended queues',
+              creation_date=datetime.date(2016, 12, 19)),
+    ])
+    db_session.flush()
+    rows = search_entries(db_session, 'binary')
+    assert [row.title for row in rows] == ['Binary search trees', 'Heaps']
+    assert u'<mark>binary</mark>' in highlight(rows[1].snippet)
+    assert search_entries(db_session, 'binary', limit=1, offset=1)[0].id == \
+        rows[1].id
+    assert count_matches(db_session, 'binary') == 2
+
+
+def test_search_index_follows_updates_on_sqlite():
+    """Test the FTS5 index is kept in sync by triggers on SQLite."""
+    from sqlalchemy import create_engine
+    from sqlalchemy.orm import sessionmaker
+    from .models.search import search_entries
+    engine = create_engine('sqlite://')
+    Base.metadata.create_all(engine)
+    session = sessionmaker(bind=engine)()
+    entry = Entry(title='Pyramid', body='views and "routes"',
+                  creation_date=datetime.date(2016, 12, 19))
+    session.add(entry)
+    session.flush()
+    assert [r.id for r in search_entries(session, 'routes"')] == [entry.id]
+    entry.body = 'templates'
+    session.flush()
+    assert search_entries(session, 'routes') == []
+    assert search_entries(session, 'templates')[0].snippet == u'\x02templates\x03'
+
+
+def test_highlight_escapes_entry_text():
+    """Test snippets are escaped before matches are marked."""
+    from .models.search import highlight, START_MATCH, STOP_MATCH
+    snippet = u'<b>%sheap%s</b>' % (START_MATCH, STOP_MATCH)
+    assert highlight(snippet) == u'&lt;b&gt;<mark>heap</mark>&lt;/b&gt;'
+
+
+def test_entry_changed_bumps_journal_version(dummy_request):
+    """Test every write moves the journal version on."""
+    from .models.journalmodel import get_journal_state, journal_changed
+    from .events import EntryChanged
+    assert get_journal_state(dummy_request.dbsession) == (0, None)
+    journal_changed(EntryChanged(dummy_request, None))
+    journal_changed(EntryChanged(dummy_request, None))
+    version, modified = get_journal_state(dummy_request.dbsession)
+    assert version == 2
+    assert isinstance(modified, datetime.datetime)
+
+
+def test_is_fresh_with_day_granular_dates():
+    """Test a day-granular Last-Modified only validates later days."""
+    from pyramid.request import Request
+    from .conditional import is_fresh
+    request = Request.blank('/', headers={
+        'If-Modified-Since': 'Tue, 20 Dec 2016 00:00:00 GMT'})
+    assert is_fresh(request, 'x', datetime.date(2016, 12, 19))
+    assert not is_fresh(request, 'x', datetime.date(2016, 12, 20))
+    request = Request.blank('/', headers={'If-None-Match': '"x"'})
+    assert is_fresh(request, 'x', None)
+    assert not is_fresh(request, 'y', None)
+
+
+def test_export_import_round_trip_upserts_on_title(tmpdir):
+    """Test entries survive export and re-import, matched on title."""
+    import io
+    from sqlalchemy import create_engine
+    from .scripts.transfer import (
+        iter_entries, write_entries, read_entries, load_entries)
+    engine = create_engine('sqlite:///%s' % tmpdir.join('lj.sqlite'))
+    Base.metadata.create_all(engine)
+    rows = [{'id': None, 'title': u'Entry %d' % i, 'body': u'b\u00f6dy',
+             'creation_date': datetime.date(2016, 12, 19), 'edit_date': None}
+            for i in range(5)]
+    assert load_entries(engine, iter(rows), batch_size=2) == 5
+    for fmt in ('jsonl', 'csv'):
+        stream = io.StringIO()
+        with engine.connect() as connection:
+            count = write_entries(iter_entries(connection, 2), stream, fmt)
+        assert count == 5
+        stream.seek(0)
+        loaded = list(read_entries(stream, fmt))
+        assert loaded[4]['title'] == u'Entry 4'
+        assert loaded[4]['creation_date'] == datetime.date(2016, 12, 19)
+    loaded[0]['body'] = u'changed'
+    load_entries(engine, iter(loaded), batch_size=2)
+    with engine.connect() as connection:
+        body, version = connection.execute(
+            "SELECT body, version FROM models WHERE title = 'Entry 0'"
+        ).fetchone()
+        assert connection.execute('SELECT count(*) FROM models').scalar() == 5
+    assert (body, version) == (u'changed', 2)
+
+
+def test_import_skips_and_reports_entries_it_cannot_store(tmpdir):
+    """Test invalid records are skipped by line number, the rest loaded."""
+    import io
+    from sqlalchemy import create_engine
+    from .scripts.transfer import load_entries, read_entries
+    engine = create_engine('sqlite:///%s' % tmpdir.join('lj.sqlite'))
+    Base.metadata.create_all(engine)
+    stream = io.StringIO(u'\n'.join([
+        u'{"title": "Kept", "body": "b", "creation_date": "2016-12-19"}',
+        u'{"title": "No body", "creation_date": "2016-12-19"}',
+        u'{"title": "No date", "body": "b"}',
+        u'{"title": "Bad date", "body": "b", "creation_date": "Tuesday"}',
+        u'{"title": "Number", "body": 5, "creation_date": "2016-12-19"}',
+        u'not json',
+        u'[]',
+        u'{"title": "Also kept", "body": "", "creation_date": "2016-12-20"}',
+    ]))
+    rejected = []
+    rows = read_entries(stream, 'jsonl',
+                        lambda number, reason: rejected.append(number))
+    assert load_entries(engine, rows, batch_size=1) == 2
+    assert rejected == [2, 3, 4, 5, 6, 7]
+    with engine.connect() as connection:
+        assert connection.execute('SELECT count(*) FROM models').scalar() == 2
+
+
+def test_import_with_copy_on_postgres(db_session):
+    """Test the COPY import path merges batches into the table."""
+    from .scripts.transfer import load_entries
+    engine = db_session.bind
+    rows = [{'id': None, 'title': u'Copied %d' % (i % 3), 'body': u'x',
+             'creation_date': datetime.date(2016, 12, 20),
+             'edit_date': None} for i in range(7)]
+    load_entries(engine, iter(rows), batch_size=4, use_copy=True)
+    assert db_session.query(Entry).count() == 3
+    assert db_session.query(Entry.version).filter(
+        Entry.title == u'Copied 0').scalar() == 2
+
+
+def test_rendered_fields_sanitize_markdown():
+    """Test bodies render to safe HTML with a plain text excerpt."""
+    from .models.rendering import RENDER_VERSION, rendered_fields
+    fields = rendered_fields(
+        u'# Heaps\n\nA *binary* heap. <script>alert(1)</script>\n\n'
+        u'[link](javascript:alert(1)) ' + u'word ' * 50)
+    assert u'<h1>Heaps</h1>' in fields['body_html']
+    assert u'<em>binary</em>' in fields['body_html']
+    assert u'<script>' not in fields['body_html']
+    assert u'javascript:' not in fields['body_html']
+    assert fields['excerpt'].startswith(u'Heaps A binary heap.')
+    assert fields['excerpt'].endswith(u'\u2026')
+    assert fields['word_count'] == 56
+    assert fields['render_version'] == RENDER_VERSION
+
+
+def test_entries_are_rendered_when_written(db_session):
+    """Test the ORM renders new bodies and re-renders edited ones."""
+    entry = Entry(title=u'Rendered', body=u'**bold**',
+                  creation_date=datetime.date(2017, 1, 2))
+    db_session.add(entry)
+    db_session.flush()
+    assert entry.body_html == u'<p><strong>bold</strong></p>'
+    assert (entry.excerpt, entry.word_count) == (u'bold', 1)
+    entry.title = u'Renamed'
+    db_session.flush()
+    assert entry.body_html == u'<p><strong>bold</strong></p>'
+    entry.body = u'_two words_'
+    db_session.flush()
+    assert entry.body_html == u'<p><em>two words</em></p>'
+    assert entry.word_count == 2
+
+
+def test_render_entries_renders_stale_rows_in_batches(tmpdir, monkeypatch):
+    """Test the backfill renders unrendered and outdated rows only."""
+    from sqlalchemy import create_engine
+    from .models import rendering
+    from .scripts.render import render_stale_entries
+    from .scripts.transfer import load_entries
+    engine = create_engine('sqlite:///%s' % tmpdir.join('lj.sqlite'))
+    Base.metadata.create_all(engine)
+    load_entries(engine, iter([{
+        'id': None, 'title': u'Imported', 'body': u'*imported*',
+        'creation_date': datetime.date(2017, 1, 2), 'edit_date': None}]))
+    with engine.begin() as connection:
+        for i in range(5):
+            connection.execute(
+                "INSERT INTO models (title, body, creation_date, version) "
+                "VALUES ('Old %d', 'old *%d*', '2017-01-03', 1)" % (i, i))
+    assert render_stale_entries(engine, batch_size=2) == 5
+    assert render_stale_entries(engine, batch_size=2) == 0
+    with engine.connect() as connection:
+        assert connection.execute(
+            "SELECT body_html, word_count, version FROM models "
+            "WHERE title = 'Old 4'").fetchone() == (
+                u'<p>old <em>4</em></p>', 2, 2)
+        assert connection.execute(
+            "SELECT body_html FROM models WHERE title = 'Imported'"
+        ).scalar() == u'<p><em>imported</em></p>'
+    monkeypatch.setattr(rendering, 'RENDER_VERSION', 2)
+    assert render_stale_entries(engine, batch_size=4) == 6
+    assert render_stale_entries(engine, batch_size=4) == 0
+
+
+def test_settings_from_environ_overrides_pool_settings():
+    """Test DATABASE_URL and DB_* variables override ini settings."""
+    from .models import settings_from_environ
+    settings = settings_from_environ(
+        {'sqlalchemy.url': 'sqlite://', 'sqlalchemy.pool_size': '5'},
+        {'DATABASE_URL': 'postgresql:///lj', 'DB_POOL_SIZE': '12'})
+    assert settings['sqlalchemy.url'] == 'postgresql:///lj'
+    assert settings['sqlalchemy.pool_size'] == '12'
+
+
+def test_get_engine_tunes_sqlite(tmpdir):
+    """Test SQLite engines ignore queue pool sizes and get WAL mode."""
+    from .models import get_engine
+    engine = get_engine({
+        'sqlalchemy.url': 'sqlite:///%s' % tmpdir.join('lj.sqlite'),
+        'sqlalchemy.pool_size': '5',
+        'sqlalchemy.sqlite_busy_timeout': '1234',
+    })
+    with engine.connect() as connection:
+        assert connection.execute('PRAGMA journal_mode').scalar() == 'wal'
+        assert connection.execute('PRAGMA busy_timeout').scalar() == 1234
+
+
+def test_get_engine_tunes_postgres_pool():
+    """Test pool sizes and statement timeouts reach PostgreSQL engines."""
+    from .models import get_engine, pool_status
+    engine = get_engine({
+        'sqlalchemy.url': 'postgresql:///lj_testing',
+        'sqlalchemy.pool_size': '3',
+        'sqlalchemy.max_overflow': '1',
+        'sqlalchemy.pool_pre_ping': 'true',
+        'sqlalchemy.statement_timeout': '2500',
+        'sqlalchemy.keepalives_idle': '30',
+    })
+    with engine.connect() as connection:
+        assert connection.execute(
+            'SHOW statement_timeout').scalar() == '2500ms'
+        status = pool_status(engine)
+    assert status['size'] == 3
+    assert status['max_overflow'] == 1
+    assert status['checked_out'] == 1
+    engine.dispose()
+
+
+@pytest.fixture
+def replica_set(tmpdir):
+    """Return a ReplicaSet of one working and one unreachable replica."""
+    from sqlalchemy import create_engine
+    from .models import get_session_factory
+    from .models.replicas import Replica, ReplicaSet
+    engines = [create_engine('sqlite:///%s' % tmpdir.join('replica.sqlite')),
+               create_engine('sqlite:////nonexistent/replica.sqlite')]
+    return ReplicaSet([Replica(engine, get_session_factory(engine))
+                       for engine in engines], retry_after=60)
+
+
+def test_replica_set_ejects_failing_replicas(replica_set):
+    """Test reads keep going to the healthy replica only."""
+    good, bad = replica_set.replicas
+    assert [replica_set.choose() for i in range(4)] == [good] * 4
+    assert [s['healthy'] for s in replica_set.stats()] == [True, False]
+    bad.ejected_until = 0
+    bad.engine = good.engine
+    bad.checked_at = 0
+    assert set(replica_set.choose() for i in range(4)) == set([good, bad])
+
+
+def test_reads_are_routed_to_replicas(dummy_request, replica_set):
+    """Test safe requests read from replicas unless they must not."""
+    from pyramid.registry import Registry
+    from .models.replicas import choose_session_factory, PRIMARY_COOKIE
+    primary = object()
+    registry = Registry()
+    registry.update(dbsession_factory=primary, dbreplicas=replica_set)
+    dummy_request.registry = registry
+    replica = replica_set.replicas[0].session_factory
+    assert choose_session_factory(dummy_request) is replica
+    dummy_request.method = 'POST'
+    assert choose_session_factory(dummy_request) is primary
+    dummy_request.method = 'GET'
+    dummy_request.cookies[PRIMARY_COOKIE] = '1'
+    assert choose_session_factory(dummy_request) is primary
+    del dummy_request.cookies[PRIMARY_COOKIE]
+    for each in replica_set.replicas:
+        replica_set.eject(each)
+    assert choose_session_factory(dummy_request) is primary
+
+
+def test_writes_stick_the_client_to_the_primary(dummy_request):
+    """Test a request that flushed changes sets the primary cookie."""
+    from .models.replicas import stick_to_primary, PRIMARY_COOKIE
+    dummy_request.registry.settings['replicas.sticky_seconds'] = '5'
+    stick_to_primary(dummy_request, dummy_request.dbsession)
+    dummy_request.dbsession.info['wrote'] = True
+    response = dummy_request.response
+    for callback in dummy_request.response_callbacks:
+        callback(dummy_request, response)
+    assert PRIMARY_COOKIE + '=1' in response.headers['Set-Cookie']
+    assert 'Max-Age=5' in response.headers['Set-Cookie']
+
+
 def test_check_credentials_invalid():
     """Test check credentials returns false for invalid username and pswrd."""
     from .security import check_credentials
@@ -225,6 +686,51 @@ def test_login_view_success_redirect(dummy_request, set_auth_credentials):
 
     assert isinstance(login_view(dummy_request), HTTPFound)
 
+@pytest.mark.parametrize('backend', ['memory', 'sqlite'])
+def test_token_buckets_refill_at_their_rate(backend, tmpdir):
+    """Test a bucket allows its burst, then one attempt per interval."""
+    from .loginguard import buckets_from_settings
+    buckets = buckets_from_settings({
+        'login.throttle_backend': backend,
+        'login.throttle_path': str(tmpdir.join('throttle.sqlite')),
+        'login.client_burst': '3',
+        'login.client_per_minute': '6',
+    }, 'client', 10, 6)
+    assert [buckets.take('a', now=100) for _ in range(3)] == [0, 0, 0]
+    assert buckets.take('a', now=100) == pytest.approx(10)
+    assert buckets.take('b', now=100) == 0
+    assert buckets.take('a', now=110) == 0
+    assert buckets.take('a', now=111) == pytest.approx(9)
+
+
+def test_login_guard_turns_away_attempts_it_cannot_serve():
+    """Test throttled and backed up attempts raise LoginThrottled."""
+    import threading
+    from .loginguard import LoginGuard, LoginThrottled, TokenBuckets
+    release = threading.Event()
+
+    def slow_check(username, password):
+        release.wait(5)
+        return password == 'pass'
+
+    guard = LoginGuard(slow_check, TokenBuckets(100), TokenBuckets(2),
+                       workers=1, queue_limit=1, timeout=0.05)
+    for _ in range(2):
+        with pytest.raises(LoginThrottled) as e:
+            guard.verify('10.0.0.1', 'bill', 'pass')
+        assert e.value.reason == 'password checks are backed up'
+    with pytest.raises(LoginThrottled) as e:
+        guard.verify('10.0.0.1', 'BILL', 'pass')
+    assert e.value.reason == 'too many attempts for bill'
+    with pytest.raises(LoginThrottled) as e:
+        guard.verify('10.0.0.1', 'ann', 'pass')
+    assert e.value.reason == 'password checks are backed up'
+    release.set()
+    # the single worker frees both slots before running anything else
+    guard.executor().submit(int).result()
+    assert guard.verify('10.0.0.1', 'ann', 'pass')
+
+
 # Functional Tests #
 
 
@@ -238,13 +744,22 @@ def testapp(request):
         """The function returns a Pyramid WSGI application."""
         config = Configurator(settings=settings)
         config.include('pyramid_jinja2')
+        config.include('learning_journal.renderers')
         config.include('learning_journal.models')
         config.include('learning_journal.routes')
         config.include('learning_journal.security')
-        config.scan()
+        config.include('learning_journal.cache')
+        config.include('learning_journal.metrics')
+        config.include('learning_journal.shedding')
+        config.include('learning_journal.instrumentation')
+        config.include('learning_journal.assets')
+        config.scan('learning_journal.views')
         return config.make_wsgi_app()
 
-    app = main({}, **{'sqlalchemy.url': 'postgres:///lj_testing'})
+    app = main({}, **{'sqlalchemy.url': 'postgres:///lj_testing',
+                      # the tests log in far more often than people do
+                      'login.client_burst': '1000',
+                      'login.user_burst': '1000'})
     testapp = TestApp(app)
 
     SessionFactory = app.registry["dbsession_factory"]
@@ -264,7 +779,17 @@ def fill_db(testapp):
     session_factory = testapp.app.registry["dbsession_factory"]
     with transaction.manager:
         dbsession = get_tm_session(session_factory, transaction.manager)
-        dbsession.add_all(ENTRIES)
+        dbsession.execute('TRUNCATE models RESTART IDENTITY')
+        dbsession.add_all([Entry(
+            title=entry.title,
+            body=entry.body,
+            creation_date=entry.creation_date,
+            edit_date=entry.edit_date
+        ) for entry in ENTRIES])
+        dbsession.flush()
+        rebuild_archive(dbsession)
+    testapp.app.registry['page_cache'].clear()
+    testapp.app.registry['entry_cache'].clear()
 
     return dbsession
 
@@ -337,10 +862,12 @@ def test_detail_and_update_page_404_redirect(route, testapp):
     assert res[1].text == u'¶∆‰Œ πø† ∫◊µπ¿'
 
 
-def test_home_route_with_data_has_all_articles(testapp, fill_db):
-    """Test all articles are rendered."""
+def test_home_route_with_data_has_first_page(testapp, fill_db):
+    """Test one page of articles is rendered with a link to older ones."""
+    from .views.default import DEFAULT_PAGE_SIZE
     response = testapp.get('/', status=200)
-    assert len(response.html.find_all('article')) == 100
+    assert len(response.html.find_all('article')) == DEFAULT_PAGE_SIZE
+    assert response.html.find('a', {'class': 'older'})
 
 
 def test_detail_page(testapp, fill_db):
@@ -350,6 +877,905 @@ def test_detail_page(testapp, fill_db):
     assert res.find('p').text == 'last airbender'
 
 
+def test_search_page_lists_matches(testapp, fill_db):
+    """Test the search page renders ranked, highlighted results."""
+    html = testapp.get('/search', params={'q': 'airbender'}).html
+    assert html.find('h4').text == 'Boomshakalaka'
+    assert html.find('mark').text == 'airbender'
+
+
+@pytest.mark.parametrize('page', [u'\u00b2', '0', '99999999999999999999999'])
+def test_search_page_past_the_results_lists_the_last_page(testapp, fill_db,
+                                                          page):
+    """Test a page that is not a number, or past the last, lists the last."""
+    html = testapp.get('/search', params={'q': 'airbender',
+                                          'page': page}).html
+    assert html.find('h4').text == 'Boomshakalaka'
+
+
+def test_anonymous_pages_are_cached(testapp, fill_db):
+    """Test a repeated anonymous read is served from the page cache."""
+    testapp.get("/logout")
+    assert testapp.get('/journal/3').headers['X-Cache'] == 'MISS'
+    assert testapp.get('/journal/3').headers['X-Cache'] == 'HIT'
+
+
+def test_cached_pages_are_kept_per_host(testapp, fill_db):
+    """Test a page requested under another host never reaches this one."""
+    testapp.get("/logout")
+    testapp.app.registry['page_cache'].clear()
+    forged = testapp.get('/', headers={'Host': 'evil.example'})
+    assert forged.headers['X-Cache'] == 'MISS'
+    assert 'evil.example' in forged.text
+    response = testapp.get('/')
+    assert response.headers['X-Cache'] == 'MISS'
+    assert 'evil.example' not in response.text
+
+
+def test_cached_pages_miss_once_the_journal_moves(testapp, fill_db):
+    """Test a write the cache was not told about still retires its pages."""
+    from .models.journalmodel import bump_journal_version
+    testapp.get("/logout")
+    testapp.get('/journal/3')
+    assert testapp.get('/journal/3').headers['X-Cache'] == 'HIT'
+    session_factory = testapp.app.registry["dbsession_factory"]
+    with transaction.manager:
+        dbsession = get_tm_session(session_factory, transaction.manager)
+        bump_journal_version(dbsession)
+    assert testapp.get('/journal/3').headers['X-Cache'] == 'MISS'
+
+
+def test_detail_page_revalidates_with_etag(testapp, fill_db):
+    """Test an unchanged entry answers If-None-Match with a 304."""
+    testapp.get("/logout")
+    etag = testapp.get('/journal/4').headers['ETag']
+    assert etag == '"entry-4-1"'
+    response = testapp.get('/journal/4', headers={'If-None-Match': etag},
+                           status=304)
+    assert response.headers['ETag'] == etag
+    assert not response.body
+
+
+def test_home_page_revalidates_until_journal_changes(testapp, fill_db):
+    """Test the home page ETag follows the journal version."""
+    from .models.journalmodel import bump_journal_version
+    testapp.get("/logout")
+    testapp.app.registry['page_cache'].clear()
+    etag = testapp.get('/').headers['ETag']
+    testapp.get('/', headers={'If-None-Match': etag}, status=304)
+    session_factory = testapp.app.registry["dbsession_factory"]
+    with transaction.manager:
+        dbsession = get_tm_session(session_factory, transaction.manager)
+        bump_journal_version(dbsession)
+    testapp.app.registry['page_cache'].clear()
+    testapp.get('/', headers={'If-None-Match': etag}, status=200)
+
+
+def test_server_timing_header_counts_queries(testapp, fill_db):
+    """Test each response reports its SQL and render time."""
+    testapp.app.registry['page_cache'].clear()
+    timing = testapp.get('/journal/5').headers['Server-Timing']
+    assert 'db;dur=' in timing
+    assert 'render;dur=' in timing
+    assert 'app;dur=' in timing
+    assert '"0 queries"' not in timing
+
+
+def test_metrics_endpoint_reports_requests_and_logins(set_auth_credentials,
+                                                     testapp, fill_db):
+    """Test /metrics is for logged in users and counts what they did."""
+    testapp.get('/logout')
+    assert 'lj_http_requests_total' not in testapp.get('/metrics',
+                                                       status=403).text
+    testapp.post('/login', params={'username': 'Bill', 'password': 'no'})
+    testapp.post('/login', params={'username': 'Bill', 'password': 'pass'})
+    testapp.get('/journal/5')
+    testapp.get('/journal/5')
+    response = testapp.get('/metrics')
+    assert response.content_type == 'text/plain'
+    text = response.text
+    assert 'lj_http_requests_total{method="GET",route="detail",' \
+        'status="200"}' in text
+    assert 'lj_logins_total{result="failure"}' in text
+    assert 'lj_logins_total{result="success"}' in text
+    assert 'lj_http_request_duration_seconds_bucket{route="detail",' \
+        'le="+Inf"}' in text
+    assert 'lj_db_pool_wait_seconds_count' in text
+    assert 'lj_template_render_seconds_sum{route="detail"}' in text
+    assert 'lj_cache_hit_ratio{cache="entry_cache"}' in text
+    assert 'lj_db_pool_connections{engine="primary",state="checked_out"}' \
+        in text
+
+
+def test_login_is_rejected_with_429_once_throttled(set_auth_credentials,
+                                                  testapp, monkeypatch):
+    """Test attempts over a client's allowance get 429 and Retry-After."""
+    from .loginguard import LoginGuard, TokenBuckets
+    from .security import check_credentials
+    monkeypatch.setitem(testapp.app.registry, 'login_guard', LoginGuard(
+        check_credentials, TokenBuckets(1, per_minute=1), TokenBuckets()))
+    credentials = {'username': 'Bill', 'password': 'pass'}
+    testapp.post('/login', params=credentials, status=302)
+    response = testapp.post('/login', params=credentials, status=429)
+    assert int(response.headers['Retry-After']) == 60
+    testapp.get('/', status=200)
+    testapp.get('/logout')
+
+
+def test_login_throttle_ignores_forwarded_for(set_auth_credentials, testapp,
+                                             monkeypatch):
+    """Test a client rotating X-Forwarded-For still gets one bucket."""
+    from .loginguard import LoginGuard, TokenBuckets
+    from .security import check_credentials
+    monkeypatch.setitem(testapp.app.registry, 'login_guard', LoginGuard(
+        check_credentials, TokenBuckets(2, per_minute=1), TokenBuckets()))
+    credentials = {'username': 'Bill', 'password': 'wrong'}
+    environ = {'REMOTE_ADDR': '192.0.2.7'}
+    for attempt in range(3):
+        response = testapp.post(
+            '/login', params=credentials, extra_environ=environ,
+            headers={'X-Forwarded-For': '198.51.100.%d' % attempt},
+            status='*')
+    assert response.status_int == 429
+    testapp.post('/login', params=credentials, status=200,
+                 extra_environ={'REMOTE_ADDR': '192.0.2.8'})
+
+
+def test_queue_wait_reads_every_request_start_format():
+    """Test X-Request-Start in seconds, milliseconds and microseconds."""
+    from .shedding import queue_wait
+    now = 1500000000.0
+    assert queue_wait('t=1499999999.5', now) == pytest.approx(0.5)
+    assert queue_wait('1499999998000', now) == pytest.approx(2)
+    assert queue_wait('1499999999750000', now) == pytest.approx(0.25)
+    assert queue_wait('1500000001', now) == 0
+    assert queue_wait('t=nonsense', now) is None
+    assert queue_wait('1000', now) is None
+    assert queue_wait(None, now) is None
+
+
+def test_load_shedder_keeps_the_last_threads_for_cheap_and_admin():
+    """Test expensive requests are turned away first."""
+    from .shedding import LoadShedder, QueueTimingDispatcher
+    shedder = LoadShedder({'admin': 3, 'cheap': 2, 'expensive': 1},
+                          {'admin': 10, 'cheap': 2, 'expensive': 0.5})
+    assert shedder.admit('expensive', None) is None
+    assert shedder.admit('expensive', None) == 'in_flight'
+    assert shedder.admit('cheap', 1.0) is None
+    assert shedder.admit('cheap', None) == 'in_flight'
+    assert shedder.admit('admin', 5.0) is None
+    assert shedder.admit('admin', None) == 'in_flight'
+    shedder.release()
+    assert shedder.admit('expensive', 0.6) == 'queue_wait'
+    stats = shedder.stats()
+    assert (stats['in_flight'], stats['peak_in_flight']) == (2, 3)
+    assert stats['shed']['expensive'] == {'in_flight': 1, 'queue_wait': 1}
+    assert stats['max_queue_wait'] == 5.0
+
+    class Task(object):
+        requests = [type('Request', (), {'headers': {}})(),
+                    type('Request', (), {'headers': {
+                        'X_REQUEST_START': 't=1'}})()]
+
+    QueueTimingDispatcher(trusted_router=True).add_task(Task)
+    assert Task.requests[0].headers['X_REQUEST_START'].startswith('t=1')
+    assert Task.requests[1].headers['X_REQUEST_START'] == 't=1'
+    # a client's own header is replaced unless a router in front is trusted
+    QueueTimingDispatcher().add_task(Task)
+    assert Task.requests[1].headers['X_REQUEST_START'] != 't=1'
+
+
+def test_overloaded_requests_get_a_fast_503(set_auth_credentials, testapp,
+                                            fill_db):
+    """Test long queued expensive pages are shed but cheap pages served."""
+    import time
+    queued = {'X-Request-Start': 't=%.3f' % (time.time() - 1)}
+    testapp.get('/logout')
+    response = testapp.get('/search?q=binary', headers=queued, status=503)
+    assert response.headers['Retry-After'] == '5'
+    testapp.get('/search?q=binary', status=503,
+                headers=dict(queued, **{'If-None-Match': '"search"'}))
+    testapp.get('/', headers=queued, status=200)
+    testapp.post('/login', params={'username': 'Bill', 'password': 'pass'})
+    # signed in, a revalidation renders the whole page
+    testapp.get('/', status=503,
+                headers=dict(queued, **{'If-None-Match': '"home"'}))
+    stats = testapp.get('/_stats').json['load_shedding']
+    assert stats['shed']['expensive']['queue_wait'] >= 2
+    assert stats['in_flight'] == 1
+    testapp.get('/logout')
+
+
+PREFORK_APP = '''
+import os, sys
+from learning_journal.prefork import serve
+
+def app(environ, start_response):
+    start_response('200 OK', [('Content-Type', 'text/plain')])
+    return [str(os.getpid()).encode('ascii')]
+
+serve(app, {'host': '127.0.0.1', 'port': int(sys.argv[1])}, workers=2,
+      max_requests=3, graceful_timeout=5)
+'''
+
+
+def test_prefork_refuses_login_buckets_kept_per_worker(tmpdir):
+    """Test several workers must share their login throttle."""
+    from .loginguard import LoginGuard, SQLiteTokenBuckets, TokenBuckets
+    from .prefork import check_shared_state
+
+    class App(object):
+        registry = {'login_guard': LoginGuard(
+            None, TokenBuckets(), TokenBuckets())}
+
+    check_shared_state(App, 1)
+    with pytest.raises(ValueError):
+        check_shared_state(App, 2)
+    path = str(tmpdir.join('var', 'login_throttle.sqlite'))
+    App.registry['login_guard'] = LoginGuard(
+        None, SQLiteTokenBuckets(path, 'client'),
+        SQLiteTokenBuckets(path, 'user'))
+    check_shared_state(App, 2)
+    assert App.registry['login_guard'].client_buckets.take('10.0.0.1') == 0
+
+
+def test_prefork_recycles_workers_and_stops_gracefully(tmpdir):
+    """Test workers are replaced after max_requests and SIGTERM is clean."""
+    import signal
+    import socket
+    import subprocess
+    import sys
+    import time
+    try:
+        from urllib.request import urlopen
+    except ImportError:  # pragma: no cover - python 2
+        from urllib2 import urlopen
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    script = tmpdir.join('serve.py')
+    script.write(PREFORK_APP)
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    server = subprocess.Popen([sys.executable, str(script), str(port)],
+                              cwd=root, env=dict(os.environ, PYTHONPATH=root))
+    url = 'http://127.0.0.1:%d/' % port
+    try:
+        deadline = time.time() + 30
+        pids = set()
+        while len(pids) < 3:
+            try:
+                pids.add(urlopen(url, timeout=5).read())
+            except IOError:
+                assert time.time() < deadline
+                time.sleep(0.1)
+        assert server.poll() is None
+    finally:
+        server.send_signal(signal.SIGTERM)
+        assert server.wait(30) == 0
+
+
+def test_metrics_add_up_every_process(tmpdir):
+    """Test counts from many threads and processes are summed."""
+    import threading
+    import time
+    from .metrics import Metrics, exposition
+    directory = str(tmpdir)
+    workers = [Metrics(directory), Metrics(directory)]
+    workers[1].started += 1  # another process, as far as the files go
+    workers[1].collectors.append(
+        lambda: [('lj_db_pool_connections', (('state', 'checked_in'),), 3)])
+
+    def work(metrics):
+        for _ in range(1000):
+            metrics.inc('lj_logins_total', (('result', 'failure'),))
+            metrics.observe('lj_db_pool_wait_seconds', 0.02)
+
+    threads = [threading.Thread(target=work, args=(metrics,))
+               for metrics in workers for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    workers[1].flush()
+    text = exposition(workers[0].collect())
+    assert 'lj_logins_total{result="failure"} 8000\n' in text
+    assert 'lj_db_pool_wait_seconds_bucket{le="0.01"} 0\n' in text
+    assert 'lj_db_pool_wait_seconds_bucket{le="0.025"} 8000\n' in text
+    assert 'lj_db_pool_wait_seconds_count 8000\n' in text
+    assert 'lj_db_pool_connections{state="checked_in"} 3\n' in text
+    workers[0].stale_after = 0
+    time.sleep(0.01)
+    text = exposition(workers[0].collect())
+    assert 'lj_logins_total{result="failure"} 8000\n' in text
+    assert 'lj_db_pool_connections' not in text
+
+
+def test_metrics_count_unknown_methods_as_other():
+    """Test made-up request methods share one label value."""
+    from pyramid.request import Request
+    from .instrumentation import RequestTimings
+    from .metrics import Metrics, exposition
+    metrics = Metrics()
+    for method in ('GET', 'BREW', 'WHEN'):
+        request = Request.blank('/', method=method)
+        metrics.record_request(request, None, RequestTimings(), 0.01)
+    text = exposition(metrics.collect())
+    assert 'method="GET"' in text
+    assert 'lj_http_requests_total{method="other",route="none",' \
+        'status="500"} 2\n' in text
+    assert 'BREW' not in text
+
+
+def test_slow_requests_log_their_statements(caplog):
+    """Test a request over the threshold is logged with its SQL."""
+    import logging
+    from .instrumentation import RequestTimings, log_request
+    from pyramid.request import Request
+    request = Request.blank('/journal/5')
+    timings = RequestTimings()
+    timings.add_statement('SELECT 1', 0.2)
+    with caplog.at_level(logging.INFO, logger='learning_journal.timing'):
+        log_request(request, None, timings, 0.1, slow=1.0)
+        log_request(request, None, timings, 2.0, slow=1.0)
+    fast, slow = caplog.records
+    assert fast.levelname == 'INFO' and 'SELECT 1' not in fast.getMessage()
+    assert slow.levelname == 'WARNING' and 'SELECT 1' in slow.getMessage()
+
+
+@pytest.fixture
+def static_dir(tmpdir):
+    """Return a copy of a small static tree."""
+    tmpdir.mkdir('css').join('style.css').write('body { color: red; }\n' * 50)
+    tmpdir.join('logo.png').write_binary(b'\x89PNG')
+    return str(tmpdir)
+
+
+def test_build_assets_hashes_and_compresses(static_dir):
+    """Test the build step writes a manifest and gzip copies."""
+    import gzip
+    import json
+    import os
+    from .assets import MANIFEST_NAME, build_assets
+    manifest = build_assets(static_dir)
+    assert sorted(manifest) == ['css/style.css', 'logo.png']
+    with open(os.path.join(static_dir, MANIFEST_NAME)) as f:
+        assert json.load(f) == manifest
+    style = os.path.join(static_dir, 'css', 'style.css')
+    with gzip.open(style + '.gz') as f, open(style, 'rb') as original:
+        assert f.read() == original.read()
+    assert not os.path.exists(os.path.join(static_dir, 'logo.png.gz'))
+
+
+def test_static_assets_serve_precompressed_variants(static_dir):
+    """Test the gzip copy is served only to clients that accept it."""
+    from pyramid.request import Request
+    from .assets import StaticAssets, build_assets
+    build_assets(static_dir)
+    assets = StaticAssets(static_dir)
+    request = Request.blank('/static/css/style.css',
+                            headers={'Accept-Encoding': 'gzip, deflate'})
+    response = assets.serve(request)
+    assert response.content_encoding == 'gzip'
+    assert response.content_type == 'text/css'
+    assert 'Accept-Encoding' in response.vary
+    plain = assets.serve(Request.blank('/static/css/style.css'))
+    assert plain.content_encoding is None
+    assert len(plain.app_iter.file.read()) > response.content_length
+
+
+def test_static_assets_immutable_only_when_fingerprinted(static_dir):
+    """Test only URLs carrying the current hash are cached for a year."""
+    from pyramid.request import Request
+    from .assets import IMMUTABLE, StaticAssets
+    assets = StaticAssets(static_dir)
+    token = assets.token('css/style.css')
+    response = assets.serve(Request.blank('/static/css/style.css?x=' + token))
+    assert response.headers['Cache-Control'] == IMMUTABLE
+    stale = assets.serve(Request.blank('/static/css/style.css?x=0ld'))
+    assert stale.headers['Cache-Control'] == 'public, max-age=3600'
+    assert assets.serve(Request.blank('/static/../tests.py')) is None
+    assert assets.serve(Request.blank('/static/missing.css')) is None
+
+
+def test_pages_link_fingerprinted_assets(testapp):
+    """Test templates link assets through the content-hash cache buster."""
+    from .assets import IMMUTABLE
+    response = testapp.get('/')
+    link = response.html.find('link', href=lambda h: 'style.css' in h)
+    assert '/static/css/style.css?x=' in link['href']
+    asset = testapp.get(link['href'])
+    assert asset.headers['Cache-Control'] == IMMUTABLE
+
+
+def test_precompile_fills_the_bytecode_cache(tmpdir):
+    """Test templates are compiled under the names views render them by."""
+    settings = {'jinja2.bytecode_caching': 'true',
+                'jinja2.bytecode_caching_directory': str(tmpdir.join('bc')),
+                'templates.precompile': 'true'}
+    config = testing.setUp(settings=settings)
+    try:
+        config.include('pyramid_jinja2')
+        config.include('learning_journal.templating')
+        config.commit()
+        environment = config.get_jinja2_environment()
+    finally:
+        testing.tearDown()
+    from .templating import template_names
+    compiled = tmpdir.join('bc').listdir()
+    # every template, plus layout.jinja2 as loaded by each child
+    assert len(compiled) > len(template_names())
+    cache = environment.bytecode_cache
+    template = environment.get_template(
+        'learning_journal:templates/home.jinja2')
+    bucket = cache.get_bucket(environment, template.name, template.filename,
+                              environment.loader.get_source(
+                                  environment, template.name)[0])
+    assert bucket.code is not None
+
+
+def test_warm_up_renders_pages(testapp, fill_db):
+    """Test warm-up requests render pages but leave the page cache empty."""
+    from .templating import warm_up
+    testapp.app.registry['page_cache'].clear()
+    assert warm_up(testapp.app, ['/', '/journal/1', '/nowhere']) > 0
+    assert testapp.app.registry['page_cache'].stats()['entries'] == 0
+
+
+def test_main_imports_only_what_serving_needs():
+    """Test building the app leaves tests, scripts and passlib unimported."""
+    import subprocess
+    import sys
+    code = (
+        "import sys\n"
+        "from learning_journal import main\n"
+        "main({}, **{'sqlalchemy.url': 'sqlite://'})\n"
+        "print(' '.join(sorted(sys.modules)))\n")
+    modules = subprocess.check_output([sys.executable, '-c', code],
+                                      universal_newlines=True).split()
+    assert 'learning_journal.views.default' in modules
+    for name in ('learning_journal.tests', 'learning_journal.scripts',
+                 'faker', 'passlib', 'pytest', 'webtest', 'markdown',
+                 'bleach'):
+        assert name not in modules
+
+
+def test_api_lists_entries_in_keyset_pages(testapp, fill_db):
+    """Test the entry list pages by id and returns only chosen fields."""
+    page = testapp.get('/api/v1/entries?limit=10&fields=title').json
+    assert [entry['id'] for entry in page['entries']] == list(
+        range(100, 90, -1))
+    assert set(page['entries'][0]) == {'id', 'title'}
+    page = testapp.get(page['next']).json
+    assert [entry['id'] for entry in page['entries']] == list(
+        range(90, 80, -1))
+    assert set(page['entries'][0]) == {'id', 'title'}
+    testapp.get('/api/v1/entries?fields=password', status=400)
+    testapp.get('/api/v1/entries?limit=1000', status=400)
+
+
+def test_api_batch_fetches_ids_in_one_query(testapp, fill_db):
+    """Test ?ids= returns the entries asked for, in order, with one query."""
+    response = testapp.get('/api/v1/entries?ids=5,3,9999,5')
+    assert [entry['id'] for entry in response.json['entries']] == [5, 3]
+    assert response.json['missing'] == [9999]
+    assert '"1 queries"' in response.headers['Server-Timing']
+    testapp.get('/api/v1/entries?ids=5,x', status=400)
+
+
+@pytest.mark.parametrize('query', [
+    {'ids': u'²'},
+    {'ids': '99999999999999999999999'},
+    {'before': u'²'},
+    {'before': '99999999999999999999999'},
+    {'limit': u'²'},
+])
+def test_api_rejects_numbers_that_are_not_entry_ids(testapp, fill_db,
+                                                    query):
+    """Test non-ASCII digits and ids past the id column answer 400."""
+    response = testapp.get('/api/v1/entries', params=query, status=400)
+    assert list(response.json['errors']) == list(query)
+
+
+def test_api_returns_one_entry(testapp, fill_db):
+    """Test an entry is returned with dates as YYYY-MM-DD."""
+    entry = testapp.get('/api/v1/entries/1').json
+    assert entry['title'] == ENTRIES[0].title
+    assert entry['creation_date'] == ENTRIES[0].creation_date.isoformat()
+    assert entry['version'] == 1
+    missing = testapp.get('/api/v1/entries/9999', status=404)
+    assert missing.json == {'errors': {'id': 'No such entry.'}}
+
+
+def test_api_streams_every_entry_as_ndjson(testapp, fill_db):
+    """Test the NDJSON stream has one JSON object per entry."""
+    import json
+    response = testapp.get('/api/v1/entries.ndjson?fields=title')
+    assert response.content_type == 'application/x-ndjson'
+    lines = [json.loads(line) for line in response.text.splitlines()]
+    assert [line['id'] for line in lines] == list(range(1, 101))
+    assert set(lines[0]) == {'id', 'title'}
+
+
+def test_api_writes_share_the_form_validation(set_auth_credentials, testapp,
+                                              fill_db):
+    """Test API writes are validated like the forms and bump versions."""
+    testapp.post('/login', params={'username': 'Bill', 'password': 'pass'})
+    page = testapp.get('/journal/new-entry')
+    headers = {'X-CSRF-Token': page.html.find(
+        'input', {'name': 'csrf_token'})['value']}
+    invalid = testapp.post_json('/api/v1/entries', {'title': ENTRIES[0].title,
+                                                    'body': '',
+                                                    'creation_date': 'soon'},
+                                headers=headers, status=400)
+    assert set(invalid.json['errors']) == {'title', 'body', 'creation_date'}
+    created = testapp.post_json('/api/v1/entries', {'title': 'Via the API',
+                                                    'body': 'Hello'},
+                                headers=headers, status=201)
+    assert created.location.endswith('/api/v1/entries/101')
+    assert created.json['creation_date'] == datetime.date.today().isoformat()
+    updated = testapp.put_json('/api/v1/entries/101',
+                               {'title': 'Via the API', 'body': 'Edited'},
+                               headers=headers).json
+    assert updated['body'] == 'Edited'
+    assert updated['version'] == 2
+
+
+def test_api_writes_reject_fields_that_are_not_text(set_auth_credentials,
+                                                    testapp, fill_db):
+    """Test JSON numbers and lists for text fields answer 400, not 500."""
+    testapp.post('/login', params={'username': 'Bill', 'password': 'pass'})
+    page = testapp.get('/journal/new-entry')
+    headers = {'X-CSRF-Token': page.html.find(
+        'input', {'name': 'csrf_token'})['value']}
+    invalid = testapp.post_json('/api/v1/entries',
+                                {'title': 5, 'body': [],
+                                 'creation_date': 20170102},
+                                headers=headers, status=400)
+    assert set(invalid.json['errors']) == {'title', 'body', 'creation_date'}
+    invalid = testapp.put_json('/api/v1/entries/3',
+                               {'title': ['x'], 'body': {'a': 1}},
+                               headers=headers, status=400)
+    assert invalid.json['errors']['title'] == 'The title must be text.'
+    assert invalid.json['errors']['body'] == 'The body must be text.'
+    testapp.get('/logout')
+
+
+def test_ajax_create_returns_the_rendered_entry(set_auth_credentials,
+                                                testapp, fill_db):
+    """Test a script posting a new entry gets its id and list item back."""
+    testapp.post('/login', params={'username': 'Bill', 'password': 'pass'})
+    token = testapp.get('/').html.find('input', {'name': 'csrf_token'})
+    params = {'csrf_token': token['value'], 'title': 'Made with AJAX',
+              'body': 'No redirect', 'creation_date': '2017-01-02'}
+    xhr = {'X-Requested-With': 'XMLHttpRequest'}
+    for path, headers in [('/', xhr),
+                          ('/journal/new-entry',
+                           {'Accept': 'application/json'})]:
+        params['title'] += '!'
+        response = testapp.post(path, params, headers=headers, status=201)
+        entry_id = response.json['id']
+        assert response.json['url'].endswith('/journal/%d' % entry_id)
+        assert 'href="%s"' % response.json['url'] in response.json['html']
+        assert params['title'] in response.json['html']
+        assert 'Jan 02, 2017' in response.json['html']
+    invalid = testapp.post('/', dict(params, body=''), headers=xhr,
+                           status=400)
+    assert invalid.json['errors']['title']
+    assert invalid.json['errors']['body']
+    testapp.post('/', dict(params, title='Made the old way'), status=302)
+
+
+def test_archive_counts_come_from_the_summary_table(tmpdir):
+    """Test the month counts are kept up by new entries and rebuilds."""
+    from sqlalchemy import create_engine
+    from .models import get_session_factory
+    from .models.archivemodel import count_entry, get_archive
+    engine = create_engine('sqlite:///%s' % tmpdir.join('lj.sqlite'))
+    Base.metadata.create_all(engine)
+    session = get_session_factory(engine)()
+    for day in (1, 2, 3):
+        session.add(Entry(title=u'Entry %d' % day, body=u'x',
+                          creation_date=datetime.date(2016, 12, day)))
+    session.add(Entry(title=u'New year', body=u'x',
+                      creation_date=datetime.date(2017, 1, 1)))
+    session.flush()
+    assert rebuild_archive(session) == 2
+    count_entry(session, datetime.date(2017, 1, 9))
+    count_entry(session, datetime.date(2017, 3, 9))
+    assert get_archive(session) == [(2017, [(3, 1), (1, 2)]),
+                                    (2016, [(12, 3)])]
+    assert get_archive(session, 2016) == [(2016, [(12, 3)])]
+    session.close()
+
+
+def test_archive_pages_list_months_and_entries(set_auth_credentials,
+                                               testapp, fill_db):
+    """Test a new entry shows in its month's page and in the calendar."""
+    testapp.post('/login', params={'username': 'Bill', 'password': 'pass'})
+    token = testapp.get('/').html.find('input', {'name': 'csrf_token'})
+    testapp.post('/', {'csrf_token': token['value'],
+                       'title': 'Moon landing',
+                       'body': 'One small step',
+                       'creation_date': '1969-07-20'}, status=302)
+    testapp.get('/logout')
+    home = testapp.get('/')
+    assert home.html.find('a', href='http://localhost/archive/1969/07')
+    year = testapp.get('/archive/1969')
+    assert 'July</a> (1 entry)' in year.text
+    month = testapp.get('/archive/1969/07')
+    assert 'Moon landing' in month.text
+    assert 'One small step' in month.text
+    testapp.get('/archive/1969/06', status=404)
+    testapp.get('/archive/1969/13', status=404)
+    testapp.get('/archive/1968', status=404)
+    unchanged = testapp.get('/archive/1969/07', headers={
+        'If-None-Match': month.headers['ETag']}, status=304)
+    assert unchanged.headers['ETag'] == month.headers['ETag']
+
+
+def test_feed_cache_keeps_only_the_latest_version():
+    """Test a newer version replaces the cached feeds, an older one not."""
+    from .cache import FeedCache
+    cache = FeedCache()
+    cache.set(2, 'atom', b'two')
+    assert cache.get(2, 'atom') == b'two'
+    cache.set(1, 'atom', b'one')
+    assert cache.get(1, 'atom') is None
+    cache.set(3, 'rss', b'three')
+    assert cache.get(2, 'atom') is None
+    assert cache.get(3, 'rss') == b'three'
+
+
+def test_feeds_list_the_latest_entries(testapp, fill_db):
+    """Test both feeds list the newest entries, newest first."""
+    from xml.etree import ElementTree
+    atom = testapp.get('/feed.atom')
+    assert atom.content_type == 'application/atom+xml'
+    ns = {'atom': 'http://www.w3.org/2005/Atom'}
+    entries = ElementTree.fromstring(atom.body).findall('atom:entry', ns)
+    assert len(entries) == 20
+    assert entries[0].find('atom:title', ns).text == ENTRIES[-1].title
+    assert entries[0].find('atom:id', ns).text.endswith('/journal/100')
+    rss = testapp.get('/feed.rss')
+    assert rss.content_type == 'application/rss+xml'
+    items = ElementTree.fromstring(rss.body).findall('channel/item')
+    assert items[-1].find('link').text.endswith('/journal/81')
+
+
+def test_feed_is_rendered_once_per_journal_version(testapp, fill_db):
+    """Test polling gets 304s and cached XML until an entry changes."""
+    from .models.journalmodel import bump_journal_version
+    testapp.get('/logout')
+    first = testapp.get('/feed.atom')
+    etag = first.headers['ETag']
+    testapp.get('/feed.atom', headers={'If-None-Match': etag}, status=304)
+    again = testapp.get('/feed.atom')
+    assert again.body == first.body
+    # the journal version is the only query for a cached feed
+    assert '"1 queries"' in again.headers['Server-Timing']
+    session_factory = testapp.app.registry['dbsession_factory']
+    with transaction.manager:
+        dbsession = get_tm_session(session_factory, transaction.manager)
+        dbsession.add(Entry(title=u'Fresh off the press', body=u'News',
+                            creation_date=datetime.date(2017, 1, 9)))
+        bump_journal_version(dbsession)
+    changed = testapp.get('/feed.atom', headers={'If-None-Match': etag})
+    assert changed.status_int == 200
+    assert changed.headers['ETag'] != etag
+    assert b'Fresh off the press' in changed.body
+
+
+LEGACY_SCHEMA = [
+    "CREATE TABLE models (id INTEGER NOT NULL PRIMARY KEY, title VARCHAR, "
+    "body VARCHAR, creation_date DATE, edit_date DATE, "
+    "version INTEGER NOT NULL)",
+    "CREATE UNIQUE INDEX my_index ON models (title)",
+    "CREATE TABLE journal_state (id INTEGER NOT NULL PRIMARY KEY, "
+    "version INTEGER NOT NULL, modified DATETIME NOT NULL)",
+    "INSERT INTO models VALUES (1, 'Kept', NULL, NULL, '2017-01-03', 1)",
+    "INSERT INTO models VALUES (2, NULL, 'No title', '2017-01-04', NULL, 1)",
+]
+
+
+# the first release's schema, without entry versions or journal_state
+FIRST_RELEASE_SCHEMA = [
+    "CREATE TABLE models (id INTEGER NOT NULL PRIMARY KEY, title VARCHAR, "
+    "body VARCHAR, creation_date DATE, edit_date DATE)",
+    "CREATE UNIQUE INDEX my_index ON models (title)",
+    "INSERT INTO models VALUES (1, 'First post', 'Hello from 2016', "
+    "'2016-12-19', NULL)",
+]
+
+
+def test_migrations_build_the_schema_the_models_describe(tmpdir):
+    """Test upgrading an empty database leaves nothing for autogenerate."""
+    from alembic.autogenerate import compare_metadata
+    from alembic.runtime.migration import MigrationContext
+    from sqlalchemy import create_engine
+    from .migrations import include_object, upgrade
+    engine = create_engine('sqlite:///%s' % tmpdir.join('new.sqlite'))
+    with engine.connect() as connection:
+        upgrade(connection)
+        context = MigrationContext.configure(
+            connection, opts={'include_object': include_object})
+        assert compare_metadata(context, Base.metadata) == []
+
+
+def test_migrations_adopt_and_fix_a_create_all_database(tmpdir):
+    """Test a pre-migration database is upgraded in place, data and all."""
+    from sqlalchemy import create_engine, inspect
+    from .migrations import current_revision, upgrade
+    from .models import get_session_factory
+    from .models.search import search_entries
+    engine = create_engine('sqlite:///%s' % tmpdir.join('old.sqlite'))
+    with engine.connect() as connection:
+        for statement in LEGACY_SCHEMA:
+            connection.execute(statement)
+        upgrade(connection)
+        assert current_revision(connection) == '7b3f9e60d2c4'
+        indexes = [index['name'] for index in
+                   inspect(connection).get_indexes('models')]
+        assert 'ix_models_creation_date' in indexes
+        assert 'ix_models_edit_date' in indexes
+    session = get_session_factory(engine)()
+    kept, untitled = session.query(Entry).order_by(Entry.id).all()
+    assert (kept.body, kept.creation_date) == (u'', datetime.date(2017, 1, 3))
+    assert untitled.title == u'Untitled entry 2'
+    # the search triggers survived SQLite rebuilding the table
+    session.add(Entry(title=u'Migrated', body=u'alembic batch mode',
+                      creation_date=datetime.date(2017, 1, 5)))
+    session.commit()
+    assert [hit.title for hit in search_entries(session, 'alembic')] == [
+        u'Migrated']
+    session.close()
+
+
+def test_migrations_upgrade_a_first_release_database(tmpdir, monkeypatch):
+    """Test a database built by the first release is upgraded and served."""
+    from sqlalchemy import create_engine
+    from webtest import TestApp
+    from . import main
+    from .migrations import BASELINE, current_revision, legacy_revision
+    from .migrations import upgrade
+    url = 'sqlite:///%s' % tmpdir.join('first.sqlite')
+    engine = create_engine(url)
+    with engine.connect() as connection:
+        for statement in FIRST_RELEASE_SCHEMA:
+            connection.execute(statement)
+        assert legacy_revision(connection) == BASELINE
+        upgrade(connection)
+        assert current_revision(connection) == '7b3f9e60d2c4'
+    engine.dispose()
+    monkeypatch.delenv('DATABASE_URL', raising=False)
+    app = TestApp(main({}, **{'sqlalchemy.url': url}))
+    assert 'First post' in app.get('/').text
+    assert 'First post' in app.get('/journal/1').text
+    results = app.get('/search', params={'q': 'hello'}).html
+    assert results.find('h4').text == 'First post'
+
+
+def test_initializedb_keeps_existing_entries(tmpdir):
+    """Test re-running initialize_db migrates without losing data."""
+    from .models import get_engine, get_session_factory
+    from .scripts.initializedb import main, seed_entries
+    SEED = seed_entries()
+    db = tmpdir.join('journal.sqlite')
+    ini = tmpdir.join('test.ini')
+    ini.write('[app:main]\nuse = egg:learning_journal\n'
+              'sqlalchemy.url = sqlite:///%s\n' % db)
+    environ = dict(os.environ)
+    os.environ.pop('DATABASE_URL', None)
+    try:
+        main(['initialize_db', str(ini)])
+        session = get_session_factory(
+            get_engine({'sqlalchemy.url': 'sqlite:///%s' % db}))()
+        session.query(Entry).filter(Entry.id == 1).update(
+            {'body': u'Edited since seeding'})
+        session.commit()
+        main(['initialize_db', str(ini)])
+        assert session.query(Entry).count() == len(SEED)
+        assert session.query(Entry).get(1).body == u'Edited since seeding'
+        session.close()
+    finally:
+        os.environ.clear()
+        os.environ.update(environ)
+
+
+def test_generate_loads_reproducible_entries_in_parallel(tmpdir):
+    """Test generated entries depend on the seed, not on the processes."""
+    from sqlalchemy import create_engine
+    from .scripts.generate import generate, synthetic_entries
+    url = 'sqlite:///%s' % tmpdir.join('generated.sqlite')
+    shape = {'body_words': 12, 'distribution': 'fixed'}
+    assert generate({'sqlalchemy.url': url}, 25, seed=4, processes=2,
+                    chunk_size=10, **shape) == 25
+    expected = list(synthetic_entries(25, seed=4, chunk_size=10, **shape))
+    assert expected == list(synthetic_entries(25, seed=4, chunk_size=10,
+                                              **shape))
+    assert expected != list(synthetic_entries(25, seed=5, chunk_size=10,
+                                              **shape))
+    # an entry does not depend on the range or chunks it was made in
+    assert expected[13:23] == list(synthetic_entries(10, seed=4, start=13,
+                                                     chunk_size=7, **shape))
+    generate({'sqlalchemy.url': url}, 25, seed=4, processes=1,
+             chunk_size=10, **shape)
+    engine = create_engine(url)
+    with engine.connect() as connection:
+        rows = connection.execute(
+            'SELECT title, body, word_count, version FROM models '
+            'ORDER BY title').fetchall()
+        months = connection.execute(
+            'SELECT sum(entries) FROM archive_months').scalar()
+    assert [(row.title, row.body) for row in rows] == sorted(
+        (entry['title'], entry['body']) for entry in expected)
+    assert set(row.word_count for row in rows) == {12}
+    assert set(row.version for row in rows) == {2}
+    assert months == 25
+
+
+def test_generated_entries_carry_their_rendered_fields():
+    """Test generated entries are rendered as the renderer would."""
+    from .models.rendering import RENDERED_FIELDS, rendered_fields
+    from .scripts.generate import synthetic_entries
+    for entry in synthetic_entries(20, seed=1, body_words=90,
+                                   distribution='pareto'):
+        rendered = rendered_fields(entry['body'])
+        assert dict((name, entry[name]) for name in RENDERED_FIELDS) == rendered
+
+
+def test_snapshot_renders_only_what_changed(tmpdir):
+    """Test a snapshot export, then exports of only the changed pages."""
+    from .models import get_engine, get_session_factory
+    from .scripts.initializedb import main, seed_entries
+    SEED = seed_entries()
+    from .snapshot import build_snapshot, load_manifest
+    db = tmpdir.join('journal.sqlite')
+    ini = tmpdir.join('test.ini')
+    ini.write('[app:main]\nuse = egg:learning_journal\n'
+              'sqlalchemy.url = sqlite:///%s\n' % db)
+    site = tmpdir.join('site')
+    environ = dict(os.environ)
+    os.environ.pop('DATABASE_URL', None)
+    try:
+        main(['initialize_db', str(ini)])
+        summary = build_snapshot(str(ini), str(site), processes=2,
+                                 chunk_size=10)
+        manifest = load_manifest(str(site))
+        assert summary['full']
+        assert summary['rendered'] == (
+            len(SEED) + len(manifest['archive']) + 4)
+        assert site.join('journal', '1.html').check()
+        assert 'href="http://localhost/journal/%d"' % len(SEED) in site.join(
+            'index.html').read_text('utf-8')
+        assert site.join('404.html').check()
+        assert site.join('feed.atom').check()
+        assert site.join('static', 'css', 'style.css').check()
+        assert build_snapshot(str(ini), str(site))['rendered'] == 0
+        session = get_session_factory(
+            get_engine({'sqlalchemy.url': 'sqlite:///%s' % db}))()
+        # changed behind the app's back, so not picked up
+        session.query(Entry).filter(Entry.id == 2).update(
+            {'body_html': u'Unnoticed'})
+        edited = session.query(Entry).get(1)
+        edited.body = u'Edited since the export'
+        edited.edit_date = datetime.date.today()
+        session.query(Entry).filter(Entry.id == 3).delete()
+        session.commit()
+        session.close()
+        summary = build_snapshot(str(ini), str(site), processes=1)
+        assert not summary['full']
+        assert summary['removed'] == 1
+        assert 'Edited since the export' in site.join(
+            'journal', '1.html').read_text('utf-8')
+        assert 'Unnoticed' not in site.join(
+            'journal', '2.html').read_text('utf-8')
+        assert not site.join('journal', '3.html').check()
+    finally:
+        os.environ.clear()
+        os.environ.update(environ)
+
+
 def test_logout_removes_authentication(testapp):
     """Foo."""
     testapp.get("/logout")
@@ -0,0 +1,217 @@
+"""Versioned JSON API for journal entries.
+
+    GET  /api/v1/entries            newest first, ?before=<id>&limit=<n>
+    GET  /api/v1/entries?ids=1,2,3  batch fetch in one query
+    GET  /api/v1/entries.ndjson     every entry, oldest first, streamed
+    GET  /api/v1/entries/{id}
+    POST /api/v1/entries            create (admin)
+    PUT  /api/v1/entries/{id}       update (admin)
+
+Entries carry their Markdown ``body`` and the ``body_html``, ``excerpt``
+and ``word_count`` rendered from it when it was written. Every read
+takes ?fields=id,title,... to leave out what the client does not need,
+such as the body. Writes take a JSON object (or a form) with
+the fields of the HTML forms. They need the login cookie and the
+session's CSRF token in an X-CSRF-Token header, and are validated the
+same way as the forms.
+"""
+from datetime import date
+
+from pyramid.httpexceptions import HTTPBadRequest, HTTPNotFound
+from pyramid.response import Response
+from pyramid.view import view_config
+
+from ..models import Entry, iter_entries
+from ..models.entrymodel import FIELDS
+from ..renderers import dumps
+from .default import (
+    InvalidEntry,
+    entry_changed,
+    parse_number,
+    validate_entry,
+)
+
+API_FIELDS = FIELDS + ('version', 'body_html', 'excerpt', 'word_count')
+DEFAULT_LIMIT = 20
+MAX_LIMIT = 100
+MAX_IDS = 100
+# rows fetched per round trip, and per chunk sent, when streaming
+STREAM_BATCH = 500
+
+
+def api_error(exception_class, errors):
+    """Return an HTTP error response carrying a JSON errors object."""
+    return exception_class(json_body={'errors': errors})
+
+
+def get_fields(request):
+    """Return the fields asked for with ?fields=, id always included."""
+    requested = request.params.get('fields')
+    if not requested:
+        return API_FIELDS
+    fields = [name.strip() for name in requested.split(',') if name.strip()]
+    unknown = [name for name in fields if name not in API_FIELDS]
+    if unknown or not fields:
+        raise api_error(HTTPBadRequest, {
+            'fields': 'Choose from %s.' % ', '.join(API_FIELDS)})
+    return tuple(['id'] + [name for name in fields if name != 'id'])
+
+
+def get_limit(request):
+    limit = request.params.get('limit', '')
+    if not limit:
+        return DEFAULT_LIMIT
+    number = parse_number(limit, MAX_LIMIT)
+    if not number:
+        raise api_error(HTTPBadRequest, {
+            'limit': 'Use a number from 1 to %d.' % MAX_LIMIT})
+    return number
+
+
+def get_before(request):
+    """Return the ?before= cursor, or None for the newest page."""
+    before = request.params.get('before', '')
+    if not before:
+        return None
+    cursor = parse_number(before)
+    if cursor is None:
+        raise api_error(HTTPBadRequest, {'before': 'Use an entry id.'})
+    return cursor
+
+
+def get_ids(request):
+    """Return the distinct ids asked for with ?ids=, in order."""
+    ids = []
+    for value in request.params['ids'].split(','):
+        entry_id = parse_number(value.strip())
+        if entry_id is None:
+            raise api_error(HTTPBadRequest, {
+                'ids': 'Use a comma-separated list of entry ids.'})
+        if entry_id not in ids:
+            ids.append(entry_id)
+    if len(ids) > MAX_IDS:
+        raise api_error(HTTPBadRequest, {
+            'ids': 'Ask for at most %d entries at a time.' % MAX_IDS})
+    return ids
+
+
+def entry_record(row, fields):
+    """Return the chosen fields of an entry or row as a dict."""
+    return dict((name, getattr(row, name)) for name in fields)
+
+
+def query_fields(request, fields):
+    return request.dbsession.query(*[getattr(Entry, name)
+                                     for name in fields])
+
+
+def submitted_values(request, entry=None):
+    """Validate the submitted entry, answering 400 if it is invalid."""
+    try:
+        data = request.json_body if request.content_type == \
+            'application/json' else request.POST
+    except ValueError:
+        raise api_error(HTTPBadRequest, {'body': 'Send a JSON object.'})
+    if not hasattr(data, 'get'):
+        raise api_error(HTTPBadRequest, {'body': 'Send a JSON object.'})
+    try:
+        return validate_entry(request.dbsession, data, entry)
+    except InvalidEntry as e:
+        raise api_error(HTTPBadRequest, e.errors)
+
+
+@view_config(route_name='api_entries', request_method='GET',
+             renderer='json')
+def list_entries(request):
+    """List a page of entries, or the entries named by ?ids=."""
+    fields = get_fields(request)
+    query = query_fields(request, fields)
+    if 'ids' in request.params:
+        ids = get_ids(request)
+        found = {}
+        if ids:
+            found = dict((row.id, row)
+                         for row in query.filter(Entry.id.in_(ids)))
+        return {
+            'entries': [entry_record(found[i], fields)
+                        for i in ids if i in found],
+            'missing': [i for i in ids if i not in found],
+        }
+    limit = get_limit(request)
+    before = get_before(request)
+    query = query.order_by(Entry.id.desc())
+    if before is not None:
+        query = query.filter(Entry.id < before)
+    rows = query.limit(limit + 1).all()
+    next_page = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        params = {'before': rows[-1].id, 'limit': limit}
+        if 'fields' in request.params:
+            params['fields'] = ','.join(fields)
+        next_page = request.route_url('api_entries', _query=params)
+    return {'entries': [entry_record(row, fields) for row in rows],
+            'next': next_page}
+
+
+@view_config(route_name='api_entry', request_method='GET', renderer='json')
+def get_entry(request):
+    """Return one entry."""
+    fields = get_fields(request)
+    row = query_fields(request, fields).filter(
+        Entry.id == int(request.matchdict['id'])).first()
+    if row is None:
+        return api_error(HTTPNotFound, {'id': 'No such entry.'})
+    return entry_record(row, fields)
+
+
+@view_config(route_name='api_entries_stream', request_method='GET')
+def stream_entries(request):
+    """Stream every entry as newline-delimited JSON.
+
+    The rows are read through a server-side cursor on a connection of
+    the streaming response's own, since the request's session is closed
+    before the body is sent.
+    """
+    fields = get_fields(request)
+    engine = request.dbsession.bind
+
+    def generate():
+        with engine.connect() as connection:
+            chunk = []
+            for row in iter_entries(connection, STREAM_BATCH, fields):
+                chunk.append(dumps(entry_record(row, fields)))
+                if len(chunk) >= STREAM_BATCH:
+                    yield b'\n'.join(chunk) + b'\n'
+                    chunk = []
+            if chunk:
+                yield b'\n'.join(chunk) + b'\n'
+
+    return Response(content_type='application/x-ndjson', app_iter=generate())
+
+
+@view_config(route_name='api_entries', request_method='POST',
+             permission='admin', renderer='json')
+def create_entry(request):
+    """Add an entry; answer 201 with the entry."""
+    entry = Entry(**submitted_values(request))
+    request.dbsession.add(entry)
+    entry_changed(request, entry, created=True)
+    request.response.status = 201
+    request.response.location = request.route_url('api_entry', id=entry.id)
+    return entry_record(entry, API_FIELDS)
+
+
+@view_config(route_name='api_entry', request_method='PUT',
+             permission='admin', renderer='json')
+def update_entry(request):
+    """Replace an entry's title and body."""
+    entry = request.dbsession.query(Entry).get(int(request.matchdict['id']))
+    if entry is None:
+        return api_error(HTTPNotFound, {'id': 'No such entry.'})
+    values = submitted_values(request, entry)
+    entry.title = values['title']
+    entry.body = values['body']
+    entry.edit_date = date.today()
+    entry_changed(request, entry)
+    return entry_record(entry, API_FIELDS)
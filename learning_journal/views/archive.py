@@ -0,0 +1,77 @@
+"""Archive pages listing entries by year and month."""
+from calendar import month_name
+from datetime import date
+
+from pyramid.httpexceptions import HTTPNotFound
+from pyramid.view import view_config
+
+from ..cache import cached_page
+from ..conditional import conditional_response
+from ..models import Entry
+from ..models.archivemodel import get_archive
+from ..models.journalmodel import get_journal_state
+
+
+def month_range(year, month):
+    """Return the first day of the month and of the month after."""
+    if month == 12:
+        return date(year, 12, 1), date(year + 1, 1, 1)
+    return date(year, month, 1), date(year, month + 1, 1)
+
+
+def calendar_context(dbsession):
+    """Return what the calendar.jinja2 sidebar needs to render."""
+    return {'calendar': get_archive(dbsession), 'month_name': month_name}
+
+
+def archive_unchanged(request, page):
+    """Validate an archive page against the journal version."""
+    version, modified = get_journal_state(request.dbsession)
+    return conditional_response(
+        request, 'archive-%d-%s' % (version, page), modified)
+
+
+@view_config(route_name='archive_year',
+             renderer='learning_journal:templates/archive.jinja2',
+             decorator=cached_page)
+def archive_year_view(request):
+    """List the months of a year with their entry counts."""
+    year = int(request.matchdict['year'])
+    unchanged = archive_unchanged(request, year)
+    if unchanged:
+        return unchanged
+    values = calendar_context(request.dbsession)
+    months = dict(values['calendar']).get(year)
+    if not months:
+        raise HTTPNotFound(detail="Nothing was written in %d" % year)
+    values.update(year=year, month=None, months=months, entries=[])
+    return values
+
+
+@view_config(route_name='archive_month',
+             renderer='learning_journal:templates/archive.jinja2',
+             decorator=cached_page)
+def archive_month_view(request):
+    """List a month's entries, newest first."""
+    year = int(request.matchdict['year'])
+    month = int(request.matchdict['month'])
+    if not 1 <= month <= 12:
+        raise HTTPNotFound(detail="There is no month %d" % month)
+    unchanged = archive_unchanged(request, '%d-%02d' % (year, month))
+    if unchanged:
+        return unchanged
+    start, end = month_range(year, month)
+    # a range scan of ix_models_creation_date, read backwards
+    entries = request.dbsession.query(
+        Entry.id, Entry.title, Entry.creation_date, Entry.edit_date,
+        Entry.excerpt, Entry.word_count
+    ).filter(
+        Entry.creation_date >= start, Entry.creation_date < end
+    ).order_by(Entry.creation_date.desc(), Entry.id.desc()).all()
+    if not entries:
+        raise HTTPNotFound(detail="Nothing was written in %s %d"
+                           % (month_name[month], year))
+    values = calendar_context(request.dbsession)
+    values.update(year=year, month=month, entries=entries,
+                  months=dict(values['calendar']).get(year, []))
+    return values
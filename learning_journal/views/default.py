@@ -1,43 +1,222 @@
 """View handlers."""
+from pyramid.renderers import render, render_to_response
 from pyramid.view import view_config, forbidden_view_config
-from pyramid.httpexceptions import HTTPFound, HTTPNotFound
+from pyramid.httpexceptions import (
+    HTTPBadRequest,
+    HTTPFound,
+    HTTPNotFound,
+    HTTPTooManyRequests,
+)
 from datetime import date, datetime
+import re
 # from sqlalchemy.exc import DBAPIError
 from pyramid.security import remember, forget
-from ..security import check_credentials
+from ..cache import cached_page, entry_record
+from ..conditional import conditional_response, is_conditional
+from ..events import EntryChanged
+from ..metrics import count
+from ..security import verify_login
 from ..models import Entry
+from ..models.journalmodel import get_journal_state
+from .archive import calendar_context
 
+DEFAULT_PAGE_SIZE = 20
+# the largest value the Integer id column holds
+MAX_INTEGER = 2 ** 31 - 1
+DIGITS = re.compile(r'[0-9]+\Z')
 
-@view_config(route_name='home', renderer='../templates/home.jinja2')
+
+@view_config(route_name='home',
+             renderer='learning_journal:templates/home.jinja2',
+             decorator=cached_page)
 def home_view(request):
     """Grab homepage data from db and send it to jinja."""
     if request.method == "POST":
-        title = request.POST['title']
-        body = request.POST['body']
-        creation_date = datetime.strptime(request.POST['creation_date'], "%Y-%m-%d")
-        entry = Entry(title=title, body=body, creation_date=creation_date)
+        entry = Entry(**form_entry(request))
         request.dbsession.add(entry)
+        entry_changed(request, entry, created=True)
+        if wants_fragment(request):
+            return entry_fragment(request, entry)
         return HTTPFound(location=request.route_url('home'))
-    entries = request.dbsession.query(Entry).order_by(Entry.id).all()[::-1]
+    page_size = get_page_size(request)
+    cursor = parse_number(request.params.get('before', ''))
+    before = '' if cursor is None else str(cursor)
+    version, modified = get_journal_state(request.dbsession)
+    unchanged = conditional_response(
+        request, 'home-%d-%s-%d' % (version, before, page_size), modified)
+    if unchanged:
+        return unchanged
+    query = request.dbsession.query(
+        Entry.id, Entry.title, Entry.creation_date, Entry.edit_date,
+        Entry.excerpt, Entry.word_count
+    ).order_by(Entry.id.desc())
+    if cursor is not None:
+        query = query.filter(Entry.id < cursor)
+    entries = query.limit(page_size + 1).all()
+    older = None
+    if len(entries) > page_size:
+        entries = entries[:page_size]
+        older = request.route_url('home', _query={'before': entries[-1].id})
+    newer = None
+    if entries and cursor is not None:
+        newer_ids = [row.id for row in request.dbsession.query(Entry.id)
+                     .filter(Entry.id > entries[0].id)
+                     .order_by(Entry.id.asc())
+                     .limit(page_size + 1)]
+        if len(newer_ids) > page_size:
+            newer = request.route_url(
+                'home', _query={'before': newer_ids[page_size - 1] + 1})
+        elif newer_ids:
+            newer = request.route_url('home')
     latest = entries[0] if entries else ""
-    left_entries, right_entries = [], []
-    for i in range(1, len(entries)):
-        if i % 2:
-            left_entries.append(entries[i])
+    values = {'latest': latest,
+              'left_entries': entries[1::2],
+              'right_entries': entries[2::2],
+              'older': older,
+              'newer': newer,
+              "creation_date": date.today()}
+    values.update(calendar_context(request.dbsession))
+    return values
+
+
+def entry_changed(request, entry, created=False):
+    """Flush a new or edited entry and let subscribers know about it."""
+    request.dbsession.flush()
+    request.registry.notify(EntryChanged(request, entry, created))
+
+
+class InvalidEntry(ValueError):
+    """Raised with a dict of field errors when entry data is invalid."""
+
+    def __init__(self, errors):
+        super(InvalidEntry, self).__init__(errors)
+        self.errors = errors
+
+
+def validate_entry(dbsession, data, entry=None):
+    """Check submitted entry data and return the cleaned values.
+
+    New entries take a title, body and optional creation_date
+    (YYYY-MM-DD, today if missing); edits take a title and body, both
+    text. Titles are unique. Raises InvalidEntry listing every problem.
+    """
+    errors = {}
+    title = data.get('title') or ''
+    body = data.get('body') or ''
+    if not isinstance(title, str):
+        errors['title'] = 'The title must be text.'
+    elif not title.strip():
+        errors['title'] = 'A title is required.'
+    else:
+        title = title.strip()
+    if 'title' not in errors and dbsession.query(Entry.id).filter(
+            Entry.title == title,
+            Entry.id != (entry.id if entry is not None else None)).first():
+        errors['title'] = 'Another entry already has this title.'
+    if not isinstance(body, str):
+        errors['body'] = 'The body must be text.'
+    elif not body.strip():
+        errors['body'] = 'A body is required.'
+    values = {'title': title, 'body': body}
+    if entry is None:
+        creation_date = data.get('creation_date')
+        if not creation_date:
+            values['creation_date'] = date.today()
         else:
-            right_entries.append(entries[i])
-    return {'latest': latest,
-            'left_entries': left_entries,
-            'right_entries': right_entries,
-            "creation_date": date.today()}
+            try:
+                values['creation_date'] = datetime.strptime(
+                    creation_date, "%Y-%m-%d").date()
+            except (TypeError, ValueError):
+                errors['creation_date'] = 'Use the YYYY-MM-DD format.'
+    if errors:
+        raise InvalidEntry(errors)
+    return values
+
+
+def form_entry(request, entry=None):
+    """Validate the posted entry form, answering 400 if it is invalid."""
+    try:
+        return validate_entry(request.dbsession, request.POST, entry)
+    except InvalidEntry as e:
+        if wants_fragment(request):
+            raise HTTPBadRequest(json_body={'errors': e.errors})
+        raise HTTPBadRequest(detail=' '.join(
+            e.errors[name] for name in sorted(e.errors)))
+
 
+def wants_fragment(request):
+    """Return True for script requests that want JSON, not a redirect."""
+    if request.headers.get('X-Requested-With') == 'XMLHttpRequest':
+        return True
+    accept = request.headers.get('Accept', '')
+    return 'application/json' in accept and 'text/html' not in accept
 
-@view_config(route_name='detail', renderer='../templates/detail.jinja2')
+
+def entry_fragment(request, entry):
+    """Answer 201 with the new entry's id and its rendered list item."""
+    html = render('learning_journal:templates/entry_fragment.jinja2',
+                  {'entry': entry}, request=request)
+    response = render_to_response('json', {
+        'id': entry.id,
+        'url': request.route_url('detail', id=entry.id),
+        'html': html,
+    }, request=request)
+    response.status = 201
+    return response
+
+
+def entry_etag(entry_id, version):
+    """Return the ETag of an entry's detail page."""
+    return 'entry-%d-%d' % (entry_id, version)
+
+
+def parse_number(value, maximum=MAX_INTEGER):
+    """Return value as a whole number up to maximum, or None.
+
+    Only ASCII digits are accepted: ``str.isdigit`` also passes
+    superscript digits, which int() rejects.
+    """
+    if not DIGITS.match(value):
+        return None
+    try:
+        number = int(value)
+    except ValueError:
+        return None
+    return number if number <= maximum else None
+
+
+def get_page_size(request):
+    """Return the number of entries listed per page, at least one."""
+    settings = request.registry.settings or {}
+    return max(1, int(settings.get('journal.page_size', DEFAULT_PAGE_SIZE)))
+
+
+@view_config(route_name='detail',
+             renderer='learning_journal:templates/detail.jinja2',
+             decorator=cached_page)
 def detail_view(request):
     """Grab detail data from db and hand it off to jinja."""
-    e = request.dbsession.query(Entry).get(int(request.matchdict['id']))
+    entry_id = int(request.matchdict['id'])
+    e = entry_record(request, entry_id, load=False)
+    if e is None and is_conditional(request):
+        # answer revalidations without loading the body
+        stamp = request.dbsession.query(
+            Entry.version, Entry.creation_date, Entry.edit_date
+        ).filter(Entry.id == entry_id).first()
+        if stamp:
+            unchanged = conditional_response(
+                request, entry_etag(entry_id, stamp.version),
+                stamp.edit_date or stamp.creation_date)
+            if unchanged:
+                return unchanged
+    if e is None:
+        e = entry_record(request, entry_id)
     if not e:
         raise HTTPNotFound(detail="This entry does not exist...yet")
+    unchanged = conditional_response(request, entry_etag(e.id, e.version),
+                                     e.edit_date or e.creation_date)
+    if unchanged:
+        return unchanged
     edit_date = None
     if e.edit_date:
         edit_date = e.edit_date.strftime("%b %d, %Y")
@@ -46,17 +225,22 @@ def detail_view(request):
 
 @view_config(route_name='update',
              permission='admin',
-             renderer='../templates/update.jinja2')
+             renderer='learning_journal:templates/update.jinja2')
 def update_view(request):
     """Handle get and post requests for editing entries."""
-    e = request.dbsession.query(Entry).get(int(request.matchdict['id']))
+    entry_id = int(request.matchdict['id'])
+    if request.method == "POST":
+        e = request.dbsession.query(Entry).get(entry_id)
+    else:
+        e = entry_record(request, entry_id)
     if not e:
         raise HTTPNotFound(detail="You cannot edit that which does not exist")
     if request.method == "POST":
-        e.title = request.POST['title']
-        e.body = request.POST['body']
+        values = form_entry(request, e)
+        e.title = values['title']
+        e.body = values['body']
         e.edit_date = date.today()
-        request.dbsession.flush()
+        entry_changed(request, e)
         return HTTPFound(location=request.route_url('detail', id=e.id),)
     if request.method == "GET":
         return {'title': e.title, 'body': e.body}
@@ -64,15 +248,15 @@ def update_view(request):
 
 @view_config(route_name='create',
              permission='admin',
-             renderer='../templates/create.jinja2')
+             renderer='learning_journal:templates/create.jinja2')
 def create_view(request):
     """Return new entry form and/or add new entry to db with form data."""
     if request.method == "POST":
-        title = request.POST['title']
-        body = request.POST['body']
-        creation_date = datetime.strptime(request.POST['creation_date'], "%Y-%m-%d")
-        entry = Entry(title=title, body=body, creation_date=creation_date)
+        entry = Entry(**form_entry(request))
         request.dbsession.add(entry)
+        entry_changed(request, entry, created=True)
+        if wants_fragment(request):
+            return entry_fragment(request, entry)
         return HTTPFound(location=request.route_url('home'))
     if request.method == "GET":
         today = date.today()
@@ -80,19 +264,26 @@ def create_view(request):
 
 
 @view_config(route_name="login",
-             renderer='../templates/login.jinja2',
+             renderer='learning_journal:templates/login.jinja2',
              require_csrf=False)
 def login_view(request):
     """Return login form and/or attempt login with form data."""
     if request.method == "POST":
         username = request.POST["username"]
         password = request.POST["password"]
-        if check_credentials(username, password):
+        try:
+            valid = verify_login(request, username, password)
+        except HTTPTooManyRequests:
+            count(request, 'lj_logins_total', (('result', 'throttled'),))
+            raise
+        if valid:
+            count(request, 'lj_logins_total', (('result', 'success'),))
             auth_head = remember(request, username)
             return HTTPFound(
                 request.route_url('home'),
                 headers=auth_head
             )
+        count(request, 'lj_logins_total', (('result', 'failure'),))
 
     return {}
 
@@ -104,7 +295,8 @@ def logout_view(request):
     return HTTPFound(request.route_url('home'), headers=auth_head)
 
 
-@forbidden_view_config(renderer='../templates/forbidden.jinja2')
+@forbidden_view_config(renderer='learning_journal:templates/forbidden.jinja2')
 def forbidden_view(request):
     """Return 403 forbidden page."""
+    request.response.status = 403
     return {}
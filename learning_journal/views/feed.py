@@ -0,0 +1,79 @@
+"""Atom and RSS feeds of the latest entries."""
+from datetime import datetime
+
+from pyramid.renderers import render
+from pyramid.view import view_config
+from webob.datetime_utils import serialize_date
+
+from ..conditional import as_http_date, is_conditional, is_fresh, not_modified
+from ..models import Entry
+from ..models.journalmodel import get_journal_state
+
+DEFAULT_FEED_SIZE = 20
+
+FEEDS = {
+    'atom': ('learning_journal:templates/feed.atom.jinja2',
+             'application/atom+xml'),
+    'rss': ('learning_journal:templates/feed.rss.jinja2',
+            'application/rss+xml'),
+}
+
+
+def get_feed_size(request):
+    """Return the number of entries listed in the feeds."""
+    settings = request.registry.settings or {}
+    return int(settings.get('feed.size', DEFAULT_FEED_SIZE))
+
+
+def atom_date(value):
+    return as_http_date(value).strftime('%Y-%m-%dT%H:%M:%SZ')
+
+
+def feed_entries(request, size):
+    """Return the latest size entries, newest first, ready to render."""
+    entries = request.dbsession.query(Entry).order_by(
+        Entry.id.desc()).limit(size)
+    return [{
+        'title': entry.title,
+        'url': request.route_url('detail', id=entry.id),
+        'body': entry.body,
+        'html': entry.body_html,
+        'published': atom_date(entry.creation_date),
+        'updated': atom_date(entry.edit_date or entry.creation_date),
+        'pub_date': serialize_date(as_http_date(entry.creation_date)),
+    } for entry in entries]
+
+
+@view_config(route_name='feed')
+def feed_view(request):
+    """Serve the Atom or RSS feed, rendered once per journal version.
+
+    The journal version is the ETag, so polling aggregators get a 304
+    from a single-row query until an entry is created or edited.
+    """
+    kind = request.matchdict['kind']
+    template, content_type = FEEDS[kind]
+    version, modified = get_journal_state(request.dbsession)
+    response = request.response
+    response.content_type = content_type
+    response.charset = 'utf-8'
+    response.etag = 'feed-%s-%d' % (kind, version)
+    response.last_modified = as_http_date(modified)
+    response.cache_control = 'no-cache'
+    if is_conditional(request) and is_fresh(request, response.etag,
+                                            modified):
+        return not_modified(response)
+    cache = request.registry['feed_cache']
+    # links in the feed are absolute, so keep one copy per host
+    key = (kind, request.application_url)
+    body = cache.get(version, key)
+    if body is None:
+        updated = modified or datetime.utcnow()
+        body = render(template, {
+            'entries': feed_entries(request, get_feed_size(request)),
+            'updated': atom_date(updated),
+            'pub_date': serialize_date(as_http_date(updated)),
+        }, request=request).encode('utf-8')
+        cache.set(version, key, body)
+    response.body = body
+    return response
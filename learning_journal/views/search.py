@@ -0,0 +1,37 @@
+"""Full-text search view."""
+from pyramid.view import view_config
+
+from ..models.search import count_matches, highlight, search_entries
+from .default import get_page_size, parse_number
+
+
+@view_config(route_name='search',
+             renderer='learning_journal:templates/search.jinja2')
+def search_view(request):
+    """Rank entries matching ?q= and hand one page of them to jinja."""
+    terms = request.params.get('q', '').strip()
+    page = parse_number(request.params.get('page', '1')) or 1
+    page_size = get_page_size(request)
+    if page > 1:
+        # past the last page, show the last page
+        pages = -(-count_matches(request.dbsession, terms) // page_size)
+        page = max(1, min(page, pages))
+    rows = search_entries(request.dbsession, terms,
+                          limit=page_size + 1,
+                          offset=(page - 1) * page_size)
+    results = [{'id': row.id,
+                'title': row.title,
+                'creation_date': row.creation_date,
+                'snippet': highlight(row.snippet)}
+               for row in rows[:page_size]]
+    previous_page = next_page = None
+    if page > 1:
+        previous_page = request.route_url(
+            'search', _query={'q': terms, 'page': page - 1})
+    if len(rows) > page_size:
+        next_page = request.route_url(
+            'search', _query={'q': terms, 'page': page + 1})
+    return {'q': terms,
+            'results': results,
+            'newer': previous_page,
+            'older': next_page}
@@ -0,0 +1,41 @@
+"""Runtime statistics for operators."""
+from pyramid.httpexceptions import HTTPNotFound
+from pyramid.response import Response
+from pyramid.view import view_config
+
+from ..metrics import CONTENT_TYPE, exposition
+from ..models import pool_status
+
+
+@view_config(route_name='stats', renderer='json', permission='admin')
+def stats_view(request):
+    """Report cache, pool, replica and load shedding statistics as JSON."""
+    stats = {}
+    engine = request.registry.get('dbengine')
+    if engine is not None:
+        stats['db_pool'] = pool_status(engine)
+    replicas = request.registry.get('dbreplicas')
+    if replicas is not None:
+        stats['db_replicas'] = [
+            dict(replica, pool=pool_status(engine))
+            for replica, engine in zip(replicas.stats(), replicas.engines)]
+    cache = request.registry.get('page_cache')
+    if cache is not None:
+        stats['page_cache'] = cache.stats()
+    entry_cache = request.registry.get('entry_cache')
+    if entry_cache is not None:
+        stats['entry_cache'] = entry_cache.stats()
+    shedder = request.registry.get('load_shedder')
+    if shedder is not None:
+        stats['load_shedding'] = shedder.stats()
+    return stats
+
+
+@view_config(route_name='metrics', permission='admin')
+def metrics_view(request):
+    """Report the metrics of every worker in the Prometheus text format."""
+    metrics = request.registry.get('metrics')
+    if metrics is None:
+        raise HTTPNotFound()
+    return Response(exposition(metrics.collect()), charset=None,
+                    content_type=CONTENT_TYPE)
@@ -1,10 +1,42 @@
+"""Serve production.ini from pre-forked waitress workers, as ``run`` does.
+
+waitress takes its options (threads, connection_limit, backlog, ...) from
+the ``[server:main]`` section, and PORT overrides the port. The
+``[prefork]`` section sets the number of worker processes (``workers``,
+or WEB_CONCURRENCY), ``max_requests``, ``max_requests_jitter`` and
+``graceful_timeout``; see ``learning_journal.prefork``. The app is loaded
+once, before the workers are forked. Send SIGHUP to restart gracefully.
+"""
 import os
+import tempfile
 
 from paste.deploy import loadapp
-from waitress import serve
+from plaster import get_settings
+
+from learning_journal.prefork import serve
+
+CONFIG = 'production.ini'
 
-if __name__ == "__main__":
-    port = int(os.environ.get("PORT", 5000))
-    app = loadapp('config:production.ini', relative_to='.')
 
-    serve(app, host='0.0.0.0', port=port)
\ No newline at end of file
+def server_options(config_uri, port=None):
+    """Return the waitress and the runner options of config_uri."""
+    options = dict(get_settings(config_uri, 'server:main'))
+    options.pop('use', None)
+    if port:
+        options['port'] = port
+    prefork = dict((name, int(value)) for name, value
+                   in get_settings(config_uri, 'prefork').items())
+    if os.environ.get('WEB_CONCURRENCY'):
+        prefork['workers'] = int(os.environ['WEB_CONCURRENCY'])
+    return options, prefork
+
+
+if __name__ == "__main__":
+    config_uri = os.path.abspath(CONFIG)
+    options, prefork = server_options(config_uri,
+                                      os.environ.get('PORT', 5000))
+    if prefork.get('workers', 1) > 1 and not os.environ.get('METRICS_DIR'):
+        # let /metrics add up every worker; kept across restarts
+        os.environ['METRICS_DIR'] = tempfile.mkdtemp(prefix='lj-metrics-')
+    app = loadapp('config:' + config_uri)
+    serve(app, options, **prefork)
@@ -9,6 +9,9 @@ from setuptools import setup, find_packages
 #     CHANGES = f.read()
 
 requires = [
+    'alembic',
+    'bleach',
+    'Markdown',
     'pyramid',
     'pyramid_jinja2',
     'pyramid_debugtoolbar',
@@ -50,6 +53,8 @@ setup(name='learning_journal',
       zip_safe=False,
       extras_require={
           'testing': tests_require,
+          # optional: faster JSON for the API
+          'speedups': ['orjson'],
       },
       install_requires=requires,
       entry_points="""\
@@ -57,5 +62,12 @@ setup(name='learning_journal',
       main = learning_journal:main
       [console_scripts]
       initialize_db = learning_journal.scripts.initializedb:main
+      export_entries = learning_journal.scripts.transfer:export_main
+      import_entries = learning_journal.scripts.transfer:import_main
+      build_assets = learning_journal.scripts.buildassets:main
+      render_entries = learning_journal.scripts.render:main
+      rebuild_archive = learning_journal.scripts.archive:main
+      export_snapshot = learning_journal.scripts.snapshot:main
+      generate = learning_journal.scripts.generate:main
       """,
       )